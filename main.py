@@ -5,6 +5,7 @@
 主程序入口
 """
 
+import argparse
 import logging
 import sys
 import uvicorn
@@ -23,8 +24,28 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def backfill_features():
+    """一次性补齐两库缺失的配方匹配特征后退出"""
+    from src.backend.dependencies import backfill_match_features
+    try:
+        counts = backfill_match_features()
+        print(f"✅ 匹配特征补齐完成: 参考配方库 {counts['reference']} 个，待匹配配方库 {counts['to_be_matched']} 个")
+    except Exception as e:
+        logger.error(f"补齐匹配特征失败: {e}")
+        print(f"❌ 补齐匹配特征失败: {e}")
+        sys.exit(1)
+
+
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="化妆品配方表匹配系统")
+    parser.add_argument("--backfill-features", action="store_true",
+                        help="补齐两库缺失或规则版本过期的配方匹配特征后退出（升级后单进程执行一次）")
+    args = parser.parse_args()
+    if args.backfill_features:
+        backfill_features()
+        return
+
     try:
         # 创建应用实例
         app = get_app()
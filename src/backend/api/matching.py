@@ -4,24 +4,29 @@
 配方匹配和上传API路由
 """
 
-import os
 import json
-import tempfile
-import shutil
 import logging
+from dataclasses import replace
 from decimal import Decimal
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
 
-from src.backend.dependencies import get_db, require_login, get_matching_engine
+from src.backend.dependencies import (
+    get_db, require_login, require_admin, get_matching_engine, get_match_job_manager, get_catalog_resolver,
+    get_parse_cache, initialize_database
+)
 from src.backend.sql.mysql_models import (
     Formulas, FormulaIngredients, FormulasToBeMatched, FormulaIngredientsToBeMatched,
     IngredientCatalog, FormulaMatchRecord, Users, DualFormulaLibraryHandler
 )
 from src.backend.formula_parser import FormulaParser
+from src.backend.dual_library_matching_engine import (
+    LSH_RECALL_MAX_SAMPLE_SIZE, MAX_RESULTS_LIMIT, PROGRESS_PARTITION_SIZE, RETRIEVAL_MODES
+)
+from src.backend.matching_lsh import LSHParameters, MAX_NUM_PERMUTATIONS
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/v1", tags=["配方匹配"])
@@ -45,6 +50,13 @@ class BatchDeleteRequest(BaseModel):
     formula_ids: List[int]
 
 
+class BatchMatchRequest(BaseModel):
+    source_formula_ids: List[int]
+    strict_mode: bool = False
+    retrieval_mode: Optional[str] = None
+    max_results: Optional[int] = None
+
+
 @router.get("/to-match-formulas")
 async def get_to_match_formulas(db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
     """获取待匹配配方列表"""
@@ -126,7 +138,9 @@ async def batch_delete_to_match_formulas(request: BatchDeleteRequest, db: Sessio
             ).count()
             total_ingredients_deleted += ingredients_count
 
-            # 3. 删除配方（成分会通过外键级联删除）
+            # 3. 删除配方（成分会通过外键级联删除）及其匹配特征、来源文件指纹
+            DualFormulaLibraryHandler.delete_match_features(db, 'to_be_matched', [formula_id])
+            DualFormulaLibraryHandler.delete_source_files(db, 'to_be_matched', [formula_id])
             db.delete(formula)
             deleted_formulas.append({
                 "id": formula_id,
@@ -186,7 +200,9 @@ async def delete_to_match_formula(formula_id: int, db: Session = Depends(get_db)
             FormulaIngredientsToBeMatched.formula_id == formula_id
         ).count()
 
-        # 3. 删除配方
+        # 3. 删除配方及其匹配特征、来源文件指纹
+        DualFormulaLibraryHandler.delete_match_features(db, 'to_be_matched', [formula_id])
+        DualFormulaLibraryHandler.delete_source_files(db, 'to_be_matched', [formula_id])
         db.delete(formula)
         db.commit()
 
@@ -225,105 +241,140 @@ async def upload_formula_unified(
         if not file.filename.lower().endswith(('.xlsx', '.xls')):
             raise HTTPException(status_code=400, detail="只支持Excel格式文件(.xlsx, .xls)")
 
-        # 保存临时文件
+        # 按内容指纹解析：相同内容的文件已解析过时直接使用缓存的解析结果
         file_extension = '.xlsx' if file.filename.lower().endswith('.xlsx') else '.xls'
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
-            tmp_path = tmp_file.name
+        content = await file.read()
+        parser = FormulaParser()
+        content_hash, parsed_result, parse_cache_hit = parser.parse_content(
+            content, file_extension, cache=get_parse_cache()
+        )
 
-        try:
-            # 使用FormulaParser解析Excel文件
-            parser = FormulaParser()
-            parsed_result = parser.parse_file(tmp_path)
-
-            logger.info(
-                f"解析Excel文件: {file.filename}, 成分数: {parsed_result['total_ingredients']}, 目标库: {target_library}")
-
-            # 使用用户输入的配方名称，如果没有则使用解析出的名称
-            final_formula_name = formula_name or parsed_result['name']
-
-            # 同名校验：检查目标库中是否已存在同名配方
-            if target_library == 'reference':
-                existing_formula = db.query(Formulas).filter(
-                    Formulas.formula_name == final_formula_name
-                ).first()
-                if existing_formula:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"参考配方库中已存在名为 '{final_formula_name}' 的配方，请使用不同的名称"
-                    )
-            else:
-                existing_formula = db.query(FormulasToBeMatched).filter(
-                    FormulasToBeMatched.formula_name == final_formula_name
-                ).first()
-                if existing_formula:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"待匹配配方库中已存在名为 '{final_formula_name}' 的配方，请使用不同的名称"
-                    )
+        logger.info(
+            f"解析Excel文件: {file.filename}, 成分数: {parsed_result['total_ingredients']}, 目标库: {target_library}")
+
+        # 由相同内容文件创建的已有配方（两个配方库）
+        same_file_formulas = DualFormulaLibraryHandler.find_formulas_by_source_hashes(
+            db, [content_hash]
+        ).get(content_hash, [])
+
+        # 使用用户输入的配方名称，如果没有则使用解析出的名称
+        final_formula_name = formula_name or parsed_result['name']
+
+        # 同名校验：检查目标库中是否已存在同名配方
+        if target_library == 'reference':
+            existing_formula = db.query(Formulas).filter(
+                Formulas.formula_name == final_formula_name
+            ).first()
+            if existing_formula:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"参考配方库中已存在名为 '{final_formula_name}' 的配方，请使用不同的名称"
+                )
+        else:
+            existing_formula = db.query(FormulasToBeMatched).filter(
+                FormulasToBeMatched.formula_name == final_formula_name
+            ).first()
+            if existing_formula:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"待匹配配方库中已存在名为 '{final_formula_name}' 的配方，请使用不同的名称"
+                )
 
-            # 根据目标库选择不同的模型和处理逻辑
-            if target_library == 'reference':
-                # 创建参考配方记录
-                new_formula = Formulas(
-                    formula_name=final_formula_name,
-                    product_type=product_type,
-                    customer=customer,
-                    user_id=current_user.id
+        # 根据目标库选择不同的模型和处理逻辑
+        if target_library == 'reference':
+            # 创建参考配方记录
+            new_formula = Formulas(
+                formula_name=final_formula_name,
+                product_type=product_type,
+                customer=customer,
+                user_id=current_user.id
+            )
+            formula_model = Formulas
+            ingredient_model = FormulaIngredients
+            library_name = "参考配方库"
+        else:
+            # 创建待匹配配方记录
+            new_formula = FormulasToBeMatched(
+                formula_name=final_formula_name,
+                product_type=product_type,
+                customer=customer,
+                user_id=current_user.id
+            )
+            formula_model = FormulasToBeMatched
+            ingredient_model = FormulaIngredientsToBeMatched
+            library_name = "待匹配配方库"
+
+        db.add(new_formula)
+        db.flush()  # 获取ID
+
+        # 记录来源文件指纹
+        table_type = 'reference' if target_library == 'reference' else 'to_be_matched'
+        DualFormulaLibraryHandler.save_source_files(db, table_type, {new_formula.id: (content_hash, file.filename)})
+
+        # 解析配方成分
+        ingredients_created = 0
+        parsed_ingredients = parsed_result['ingredients']
+
+        # 一次解析全部成分对应的原料目录条目（精确 → 规范化 → INCI → 模糊）
+        catalog_resolver = get_catalog_resolver(db)
+        catalog_keys = [(ing['chinese_name'], ing['inci_name']) for ing in parsed_ingredients]
+        catalog_matches = catalog_resolver.resolve_many(catalog_keys)
+        catalog_lookup = dict(zip(catalog_keys, catalog_matches))
+
+        # 按序号分组，检测复配
+        ingredient_groups = {}
+        for ingredient in parsed_ingredients:
+            seq = ingredient['sequence']
+            if seq not in ingredient_groups:
+                ingredient_groups[seq] = []
+            ingredient_groups[seq].append(ingredient)
+
+        # 处理每个成分组
+        for seq, group in ingredient_groups.items():
+            if len(group) == 1:
+                # 单配成分
+                ing = group[0]
+
+                # 原料目录匹配结果
+                catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
+
+                # 使用Excel文件中的原始使用目的字段
+                purpose = ing.get('purpose', '').strip() or '未填写'
+
+                # 创建成分记录
+                ingredient = ingredient_model(
+                    formula_id=new_formula.id,
+                    ingredient_id=seq,
+                    ingredient_sequence=1,  # 单配序号为1
+                    standard_chinese_name=ing['chinese_name'],
+                    inci_name=ing['inci_name'] or None,
+                    ingredient_content=ing['percentage'],
+                    catalog_id=catalog_match.catalog_id if catalog_match else None,
+                    component_content=ing.get('ingredient_percentage', 100.0),
+                    actual_component_content=ing.get('actual_percentage', ing['percentage']),
+                    purpose=purpose  # 添加使用目的
                 )
-                formula_model = Formulas
-                ingredient_model = FormulaIngredients
-                library_name = "参考配方库"
+                db.add(ingredient)
+                ingredients_created += 1
+
             else:
-                # 创建待匹配配方记录
-                new_formula = FormulasToBeMatched(
-                    formula_name=final_formula_name,
-                    product_type=product_type,
-                    customer=customer,
-                    user_id=current_user.id
-                )
-                formula_model = FormulasToBeMatched
-                ingredient_model = FormulaIngredientsToBeMatched
-                library_name = "待匹配配方库"
-
-            db.add(new_formula)
-            db.flush()  # 获取ID
-
-            # 解析配方成分
-            ingredients_created = 0
-            parsed_ingredients = parsed_result['ingredients']
-
-            # 按序号分组，检测复配
-            ingredient_groups = {}
-            for ingredient in parsed_ingredients:
-                seq = ingredient['sequence']
-                if seq not in ingredient_groups:
-                    ingredient_groups[seq] = []
-                ingredient_groups[seq].append(ingredient)
-
-            # 处理每个成分组
-            for seq, group in ingredient_groups.items():
-                if len(group) == 1:
-                    # 单配成分
-                    ing = group[0]
-
-                    # 尝试匹配原料目录
-                    catalog_match = db.query(IngredientCatalog).filter(
-                        IngredientCatalog.chinese_name == ing['chinese_name']
-                    ).first()
+                # 复配成分
+                for sub_seq, ing in enumerate(group, 1):
+                    # 原料目录匹配结果
+                    catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
 
                     # 使用Excel文件中的原始使用目的字段
                     purpose = ing.get('purpose', '').strip() or '未填写'
 
-                    # 创建成分记录
+                    # 创建复配成分记录
                     ingredient = ingredient_model(
                         formula_id=new_formula.id,
-                        ingredient_id=seq,
-                        ingredient_sequence=1,  # 单配序号为1
+                        ingredient_id=seq,  # 相同的配料ID表示复配
+                        ingredient_sequence=sub_seq,  # 不同的序号表示复配中的不同成分
                         standard_chinese_name=ing['chinese_name'],
                         inci_name=ing['inci_name'] or None,
-                        ingredient_content=ing['percentage'],
-                        catalog_id=catalog_match.id if catalog_match else None,
+                        ingredient_content=ing['percentage'],  # 在复配中的比例
+                        catalog_id=catalog_match.catalog_id if catalog_match else None,
                         component_content=ing.get('ingredient_percentage', 100.0),
                         actual_component_content=ing.get('actual_percentage', ing['percentage']),
                         purpose=purpose  # 添加使用目的
@@ -331,58 +382,40 @@ async def upload_formula_unified(
                     db.add(ingredient)
                     ingredients_created += 1
 
-                else:
-                    # 复配成分
-                    for sub_seq, ing in enumerate(group, 1):
-                        # 尝试匹配原料目录
-                        catalog_match = db.query(IngredientCatalog).filter(
-                            IngredientCatalog.chinese_name == ing['chinese_name']
-                        ).first()
-
-                        # 使用Excel文件中的原始使用目的字段
-                        purpose = ing.get('purpose', '').strip() or '未填写'
-
-                        # 创建复配成分记录
-                        ingredient = ingredient_model(
-                            formula_id=new_formula.id,
-                            ingredient_id=seq,  # 相同的配料ID表示复配
-                            ingredient_sequence=sub_seq,  # 不同的序号表示复配中的不同成分
-                            standard_chinese_name=ing['chinese_name'],
-                            inci_name=ing['inci_name'] or None,
-                            ingredient_content=ing['percentage'],  # 在复配中的比例
-                            catalog_id=catalog_match.id if catalog_match else None,
-                            component_content=ing.get('ingredient_percentage', 100.0),
-                            actual_component_content=ing.get('actual_percentage', ing['percentage']),
-                            purpose=purpose  # 添加使用目的
-                        )
-                        db.add(ingredient)
-                        ingredients_created += 1
-
-            db.commit()
-
-            # 构建返回结果
-            validation = parsed_result.get('validation', {})
-            result = {
-                "success": True,
-                "formula_id": new_formula.id,
-                "formula_name": final_formula_name,
-                "ingredients_count": ingredients_created,
-                "total_percentage": validation.get('total_percentage', 0),
-                "compound_count": validation.get('compound_count', 0),
-                "validation_warnings": validation.get('warnings', []),
-                "validation_errors": validation.get('errors', []),
-                "is_valid": validation.get('is_valid', True),
-                "target_library": target_library,
-                "library_name": library_name,
-                "message": f"成功上传配方到{library_name}，解析了{ingredients_created}个成分"
-            }
+        if target_library == 'reference':
+            DualFormulaLibraryHandler.bump_library_version(db)
+        db.commit()
+
+        # 入库时计算并保存匹配特征；参考配方库已变更，增量更新匹配索引
+        matching_engine = get_matching_engine(db)
+        matching_engine.refresh_match_features(db, [new_formula.id], table_type)
+        if target_library == 'reference':
+            matching_engine.apply_library_changes(db, upserted_ids=[new_formula.id])
 
-            return JSONResponse(content=result)
+        # 构建返回结果
+        validation = parsed_result.get('validation', {})
+        result = {
+            "success": True,
+            "formula_id": new_formula.id,
+            "formula_name": final_formula_name,
+            "ingredients_count": ingredients_created,
+            "total_percentage": validation.get('total_percentage', 0),
+            "compound_count": validation.get('compound_count', 0),
+            "validation_warnings": validation.get('warnings', []),
+            "validation_errors": validation.get('errors', []),
+            "is_valid": validation.get('is_valid', True),
+            "target_library": target_library,
+            "library_name": library_name,
+            "catalog_matching": catalog_resolver.summarize(catalog_keys, catalog_matches),
+            "content_hash": content_hash,
+            "parse_cache_hit": parse_cache_hit,
+            "same_file_formulas": same_file_formulas,
+            "message": f"成功上传配方到{library_name}，解析了{ingredients_created}个成分"
+        }
+        if same_file_formulas:
+            result["message"] += f"（与已有的 {len(same_file_formulas)} 个配方来自相同的文件）"
 
-        finally:
-            # 清理临时文件
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        return JSONResponse(content=result)
 
     except Exception as e:
         db.rollback()
@@ -390,13 +423,79 @@ async def upload_formula_unified(
         raise HTTPException(status_code=500, detail=f"上传配方失败: {str(e)}")
 
 
+def _build_match_response(matching_engine, source_formula, match_results, parameters, retrieval_mode) -> dict:
+    """构建匹配接口的返回内容"""
+    formatted_results = []
+    for result in match_results:
+        formatted_results.append({
+            "target_formula_id": result.target_formula_id,
+            "target_formula_name": result.target_formula_name,
+            "similarity_score": round(result.similarity_score, 10),
+            "composition_similarity": round(result.composition_similarity, 10),
+            "proportion_similarity": round(result.proportion_similarity, 10),
+            "common_ingredients": result.common_ingredients,
+            "common_ingredients_count": result.common_ingredients_count,
+            "total_ingredients_count": result.total_ingredients_count,
+            "category_similarities": {k: round(v, 10) for k, v in result.category_similarities.items()},
+            "match_details": result.match_details
+        })
+
+    # 获取匹配统计
+    statistics = matching_engine.get_matching_statistics(match_results)
+
+    return {
+        "success": True,
+        "source_formula_id": source_formula.id,
+        "source_formula_name": source_formula.formula_name,
+        "match_results": formatted_results,
+        "total_matches": len(match_results),
+        "statistics": statistics,
+        "algorithm": "dual_library_v1.0",
+        "parameters": {
+            "composition_weight": parameters.composition_weight,
+            "proportion_weight": parameters.proportion_weight,
+            "category_weights": parameters.category_weights,
+            "max_results": parameters.max_results,
+            "retrieval_mode": retrieval_mode or matching_engine.retrieval_mode
+        }
+    }
+
+
+def _validate_max_results(max_results: Optional[int]):
+    """校验单次请求指定的结果数量"""
+    if max_results is not None and not 1 <= max_results <= MAX_RESULTS_LIMIT:
+        raise HTTPException(status_code=400, detail=f"max_results必须在1到{MAX_RESULTS_LIMIT}之间")
+
+
+def _request_parameters(matching_engine, db: Session, max_results: Optional[int]):
+    """本次请求的参数快照：未指定max_results时使用系统配置的默认结果数量"""
+    parameters = matching_engine.get_parameters(db)
+    if max_results is not None and max_results != parameters.max_results:
+        parameters = replace(parameters, max_results=max_results)
+    return parameters
+
+
 @router.post("/match-formula/{formula_id}")
-async def match_formula(
+def match_formula(
         formula_id: int,
         strict_mode: bool = False,
+        retrieval_mode: Optional[str] = None,
+        max_results: Optional[int] = None,
+        with_cursor: bool = False,
         db: Session = Depends(get_db)
 ):
-    """执行配方匹配"""
+    """
+    执行配方匹配（retrieval_mode 可选 exact/lsh，缺省使用配置文件中的召回模式）
+
+    max_results 指定本次返回的结果数量，缺省使用系统配置；with_cursor=true 时排名暂存在服务端，
+    返回内容中的 cursor 可交给 /match-results/next-page 继续读取后续结果（不重新打分）
+
+    匹配为CPU密集的同步计算，定义为普通函数由FastAPI放入线程池执行，多个匹配请求可并发进行
+    """
+    if retrieval_mode is not None and retrieval_mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"不支持的召回模式: {retrieval_mode}")
+    _validate_max_results(max_results)
+
     try:
         # 检查待匹配配方是否存在
         source_formula = db.query(FormulasToBeMatched).filter(
@@ -408,83 +507,136 @@ async def match_formula(
 
         logger.info(f"开始匹配配方: {source_formula.formula_name} (ID: {formula_id}), 严格模式: {strict_mode}")
 
-        # 获取匹配引擎
+        # 获取匹配引擎及本次匹配的参数快照
         matching_engine = get_matching_engine(db)
+        parameters = _request_parameters(matching_engine, db, max_results)
 
         # 执行匹配，传递严格范围匹配参数
-        match_results = matching_engine.match_formula_against_library(
-            source_formula_id=formula_id,
-            session=db,
-            strict_mode=strict_mode
-        )
+        cursor = None
+        if with_cursor:
+            page = matching_engine.match_formula_page(
+                formula_id, db, parameters.max_results, strict_mode=strict_mode,
+                retrieval_mode=retrieval_mode, parameters=parameters
+            )
+            match_results, cursor = page.results, page.next_cursor
+        else:
+            match_results = matching_engine.match_formula_against_library(
+                source_formula_id=formula_id,
+                session=db,
+                strict_mode=strict_mode,
+                retrieval_mode=retrieval_mode,
+                parameters=parameters
+            )
 
         logger.info(f"匹配完成，找到 {len(match_results)} 个结果")
 
         # 保存匹配记录
-        for result in match_results:
-            match_record = FormulaMatchRecord(
-                source_formula_id=formula_id,
-                target_formula_id=result.target_formula_id,
-                similarity_score=result.similarity_score,
-                composition_similarity=result.composition_similarity,
-                proportion_similarity=result.proportion_similarity,
-                common_ingredients_count=result.common_ingredients_count,
-                total_ingredients_count=result.total_ingredients_count,
-                match_details=json.dumps({
-                    "composition_similarity": result.composition_similarity,
-                    "proportion_similarity": result.proportion_similarity,
-                    "category_similarities": result.category_similarities,
-                    "common_ingredients": result.common_ingredients,
-                    "common_ingredients_count": result.common_ingredients_count,
-                    "total_ingredients_count": result.total_ingredients_count,
-                    "match_details": result.match_details
-                }, ensure_ascii=False),
-                algorithm_version="dual_library_v1.0"
-            )
-            db.add(match_record)
-
+        DualFormulaLibraryHandler.save_match_records(db, formula_id, match_results)
         db.commit()
 
-        # 构建返回结果
-        formatted_results = []
-        for result in match_results:
-            formatted_results.append({
-                "target_formula_id": result.target_formula_id,
-                "target_formula_name": result.target_formula_name,
-                "similarity_score": round(result.similarity_score, 10),
-                "composition_similarity": round(result.composition_similarity, 10),
-                "proportion_similarity": round(result.proportion_similarity, 10),
-                "common_ingredients": result.common_ingredients,
-                "common_ingredients_count": result.common_ingredients_count,
-                "total_ingredients_count": result.total_ingredients_count,
-                "category_similarities": {k: round(v, 10) for k, v in result.category_similarities.items()},
-                "match_details": result.match_details
-            })
-
-        # 获取匹配统计
-        statistics = matching_engine.get_matching_statistics(match_results)
-
-        return JSONResponse(content={
-            "success": True,
-            "source_formula_id": formula_id,
-            "source_formula_name": source_formula.formula_name,
-            "match_results": formatted_results,
-            "total_matches": len(match_results),
-            "statistics": statistics,
-            "algorithm": "dual_library_v1.0",
-            "parameters": {
-                "composition_weight": matching_engine.parameters.composition_weight,
-                "proportion_weight": matching_engine.parameters.proportion_weight,
-                "category_weights": matching_engine.parameters.category_weights,
-                "max_results": matching_engine.parameters.max_results
-            }
-        })
+        content = _build_match_response(matching_engine, source_formula, match_results, parameters, retrieval_mode)
+        if with_cursor:
+            content["cursor"] = cursor
+        return JSONResponse(content=content)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"配方匹配失败: {e}")
         raise HTTPException(status_code=500, detail=f"配方匹配失败: {str(e)}")
 
 
+@router.get("/match-results/next-page")
+def get_next_match_page(
+        cursor: str,
+        page_size: Optional[int] = None,
+        db: Session = Depends(get_db),
+        current_user: Users = Depends(require_login)
+):
+    """
+    按游标读取分页匹配的下一页（切片服务端暂存的排名，不重新打分，也不保存匹配记录）
+
+    page_size 缺省与首次匹配的结果数量相同；游标过期时返回410，需重新发起匹配
+    """
+    _validate_max_results(page_size)
+    matching_engine = get_matching_engine(db)
+    try:
+        page = matching_engine.next_match_page(cursor, db, page_size)
+    except ValueError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except Exception as e:
+        logger.error(f"读取匹配结果分页失败: {e}")
+        raise HTTPException(status_code=500, detail=f"读取匹配结果分页失败: {str(e)}")
+
+    source_formula = db.query(FormulasToBeMatched).filter(FormulasToBeMatched.id == page.source_formula_id).first()
+    content = _build_match_response(
+        matching_engine, source_formula, page.results, page.parameters, page.retrieval_mode
+    )
+    content["offset"] = page.offset
+    content["cursor"] = page.next_cursor
+    return JSONResponse(content=content)
+
+
+@router.post("/match-formula/{formula_id}/stream")
+def match_formula_stream(
+        formula_id: int,
+        strict_mode: bool = False,
+        retrieval_mode: Optional[str] = None,
+        max_results: Optional[int] = None,
+        db: Session = Depends(get_db)
+):
+    """
+    渐进式配方匹配（NDJSON流，每行一个JSON事件）
+
+    按分区对配方库打分，每个分区完成后推送一次临时前N名（progress事件），
+    最后推送与 /match-formula/{formula_id} 返回内容相同的最终结果（final事件）并保存匹配记录；
+    匹配出错时推送error事件
+    """
+    if retrieval_mode is not None and retrieval_mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"不支持的召回模式: {retrieval_mode}")
+    _validate_max_results(max_results)
+
+    source_formula = db.query(FormulasToBeMatched).filter(
+        FormulasToBeMatched.id == formula_id
+    ).first()
+    if not source_formula:
+        raise HTTPException(status_code=404, detail="待匹配配方不存在")
+
+    matching_engine = get_matching_engine(db)
+    parameters = _request_parameters(matching_engine, db, max_results)
+    logger.info(f"开始渐进式匹配配方: {source_formula.formula_name} (ID: {formula_id}), 严格模式: {strict_mode}")
+
+    def event_stream():
+        # 流式响应在请求处理函数返回后才开始迭代，使用独立的数据库会话
+        _, SessionLocal = initialize_database()
+        with SessionLocal() as stream_db:
+            try:
+                for event in matching_engine.iter_match_progress(
+                        formula_id, stream_db, strict_mode=strict_mode, retrieval_mode=retrieval_mode,
+                        parameters=parameters, partition_size=PROGRESS_PARTITION_SIZE
+                ):
+                    if event['event'] == 'progress':
+                        yield json.dumps(event, ensure_ascii=False) + "\n"
+                        continue
+
+                    match_results = event['results']
+                    DualFormulaLibraryHandler.save_match_records(stream_db, formula_id, match_results)
+                    stream_db.commit()
+                    logger.info(f"渐进式匹配完成，找到 {len(match_results)} 个结果")
+
+                    content = _build_match_response(
+                        matching_engine, source_formula, match_results, parameters, retrieval_mode
+                    )
+                    content['event'] = 'final'
+                    yield json.dumps(content, ensure_ascii=False) + "\n"
+            except Exception as e:
+                stream_db.rollback()
+                logger.error(f"渐进式配方匹配失败: {e}")
+                yield json.dumps({"event": "error", "detail": f"配方匹配失败: {str(e)}"}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
 @router.get("/formula-detail/{formula_id}")
 async def get_formula_detail(
         formula_id: int,
@@ -511,10 +663,17 @@ async def get_formula_detail(
         
         logger.info(f"找到配方: {formula.formula_name}")
 
-        # 获取配方结构 - 增加错误处理
+        # 获取成分详细信息（一次查询，同时用于构建配方结构）
+        ingredients = db.query(IngredientModel).filter(
+            IngredientModel.formula_id == formula_id
+        ).order_by(IngredientModel.ingredient_id, IngredientModel.ingredient_sequence).all()
+        
+        logger.info(f"找到 {len(ingredients)} 个成分记录")
+
+        # 构建配方结构 - 增加错误处理
         try:
-            formula_structure = DualFormulaLibraryHandler.get_formula_structure(
-                formula_id, db, formula_type
+            formula_structure = DualFormulaLibraryHandler.build_formula_structure(
+                formula_id, ingredients, formula_type
             )
             logger.info(f"配方结构获取成功，包含 {len(formula_structure.get('ingredients', []))} 个成分")
         except Exception as e:
@@ -528,32 +687,29 @@ async def get_formula_detail(
                 'single_ingredients': []
             }
 
-        # 获取成分详细信息
-        ingredients = db.query(IngredientModel).filter(
-            IngredientModel.formula_id == formula_id
-        ).order_by(IngredientModel.ingredient_id, IngredientModel.ingredient_sequence).all()
-        
-        logger.info(f"找到 {len(ingredients)} 个成分记录")
+        # 批量获取原料目录信息
+        catalogs_by_id = {}
+        catalog_ids = list({ingredient.catalog_id for ingredient in ingredients if ingredient.catalog_id})
+        if catalog_ids:
+            try:
+                for catalog in db.query(IngredientCatalog).filter(IngredientCatalog.id.in_(catalog_ids)).all():
+                    catalogs_by_id[catalog.id] = catalog
+            except Exception as e:
+                logger.warning(f"获取原料目录信息失败: {e}")
 
         # 构建详细的成分列表
         ingredients_data = []
         for ingredient in ingredients:
             try:
-                # 尝试获取原料目录信息
+                # 原料目录信息
                 catalog_info = None
-                if ingredient.catalog_id:
-                    try:
-                        catalog = db.query(IngredientCatalog).filter(
-                            IngredientCatalog.id == ingredient.catalog_id
-                        ).first()
-                        if catalog:
-                            catalog_info = {
-                                "id": catalog.id,
-                                "chinese_name": catalog.chinese_name or '',
-                                "inci_name": catalog.inci_name or ''
-                            }
-                    except Exception as e:
-                        logger.warning(f"获取原料目录信息失败: {e}")
+                catalog = catalogs_by_id.get(ingredient.catalog_id) if ingredient.catalog_id else None
+                if catalog:
+                    catalog_info = {
+                        "id": catalog.id,
+                        "chinese_name": catalog.chinese_name or '',
+                        "inci_name": catalog.inci_name or ''
+                    }
 
                 # 获取使用目的（优先使用数据库中的purpose字段）
                 purpose = ingredient.purpose or "未填写"
@@ -621,6 +777,183 @@ async def get_formula_detail(
         raise HTTPException(status_code=500, detail=f"获取配方详情失败: {str(e)}")
 
 
+@router.post("/batch-match")
+def batch_match_formulas(
+        request: BatchMatchRequest,
+        db: Session = Depends(get_db),
+        current_user: Users = Depends(require_login)
+):
+    """
+    多对多批量匹配（同步）：全部待匹配配方一次矩阵打分，批量保存匹配记录
+
+    配方数量较多、耗时可能超过代理超时时间时，改用 /match-jobs 异步任务
+    """
+    if not request.source_formula_ids:
+        raise HTTPException(status_code=400, detail="请提供要匹配的配方ID列表")
+    if request.retrieval_mode is not None and request.retrieval_mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"不支持的召回模式: {request.retrieval_mode}")
+    _validate_max_results(request.max_results)
+
+    try:
+        matching_engine = get_matching_engine(db)
+        parameters = _request_parameters(matching_engine, db, request.max_results)
+        source_ids = list(dict.fromkeys(request.source_formula_ids))
+        logger.info(f"开始批量匹配 {len(source_ids)} 个配方, 严格模式: {request.strict_mode}")
+
+        results_by_source = matching_engine.batch_match_formulas(
+            source_ids, db, strict_mode=request.strict_mode,
+            retrieval_mode=request.retrieval_mode, parameters=parameters
+        )
+
+        DualFormulaLibraryHandler.save_batch_match_records(db, results_by_source)
+        db.commit()
+
+        source_formulas = {
+            formula.id: formula
+            for formula in db.query(FormulasToBeMatched).filter(FormulasToBeMatched.id.in_(source_ids)).all()
+        }
+        results = [
+            _build_match_response(
+                matching_engine, source_formulas[source_id], results_by_source[source_id],
+                parameters, request.retrieval_mode
+            )
+            for source_id in source_ids if source_id in source_formulas
+        ]
+
+        return JSONResponse(content={
+            "success": True,
+            "total_sources": len(source_ids),
+            "matched_sources": len(results),
+            "missing_formula_ids": [source_id for source_id in source_ids if source_id not in source_formulas],
+            "results": results
+        })
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"批量匹配失败: {e}")
+        raise HTTPException(status_code=500, detail=f"批量匹配失败: {str(e)}")
+
+
+@router.post("/match-jobs")
+async def submit_match_job(
+        request: BatchMatchRequest,
+        db: Session = Depends(get_db),
+        current_user: Users = Depends(require_login)
+):
+    """提交异步匹配任务（一个或多个待匹配配方），立即返回任务ID，匹配由后台工作线程执行并保存匹配记录"""
+    if not request.source_formula_ids:
+        raise HTTPException(status_code=400, detail="请提供要匹配的配方ID列表")
+    if request.retrieval_mode is not None and request.retrieval_mode not in RETRIEVAL_MODES:
+        raise HTTPException(status_code=400, detail=f"不支持的召回模式: {request.retrieval_mode}")
+    _validate_max_results(request.max_results)
+
+    job = get_match_job_manager(db).submit(
+        request.source_formula_ids,
+        strict_mode=request.strict_mode,
+        retrieval_mode=request.retrieval_mode,
+        max_results=request.max_results,
+        created_by=current_user.username
+    )
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
+@router.get("/match-jobs")
+async def list_match_jobs(db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """匹配任务列表（管理员全量，普通用户仅自己的）"""
+    jobs = get_match_job_manager(db).list_jobs()
+    if current_user.role != 'admin':
+        jobs = [job for job in jobs if job.created_by == current_user.username]
+    return JSONResponse(content={"success": True, "jobs": [job.to_dict() for job in jobs]})
+
+
+def _get_visible_match_job(job_id: str, db: Session, current_user: Users):
+    """读取当前用户可见的匹配任务，不存在或无权访问时返回404"""
+    job = get_match_job_manager(db).get(job_id)
+    if job is None or (current_user.role != 'admin' and job.created_by != current_user.username):
+        raise HTTPException(status_code=404, detail="匹配任务不存在")
+    return job
+
+
+@router.get("/match-jobs/{job_id}")
+async def get_match_job(job_id: str, db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """查询匹配任务状态与进度"""
+    job = _get_visible_match_job(job_id, db, current_user)
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
+@router.post("/match-jobs/{job_id}/cancel")
+async def cancel_match_job(job_id: str, db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """取消匹配任务（运行中的任务在当前配方匹配完成后停止，已完成的结果保留）"""
+    _get_visible_match_job(job_id, db, current_user)
+    job = get_match_job_manager(db).cancel(job_id)
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
+@router.get("/match-jobs/{job_id}/results")
+def get_match_job_results(job_id: str, db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """读取匹配任务已完成配方的匹配结果（格式与 /match-formula/{formula_id} 相同）"""
+    job = _get_visible_match_job(job_id, db, current_user)
+    job_results = dict(job.results)
+
+    source_formulas = {
+        formula.id: formula
+        for formula in db.query(FormulasToBeMatched).filter(FormulasToBeMatched.id.in_(list(job_results))).all()
+    } if job_results else {}
+
+    matching_engine = get_matching_engine(db)
+    results = []
+    for source_id in job.source_formula_ids:
+        if source_id not in job_results or source_id not in source_formulas:
+            continue
+        results.append(_build_match_response(
+            matching_engine, source_formulas[source_id], job_results[source_id], job.parameters, job.retrieval_mode
+        ))
+
+    return JSONResponse(content={"success": True, "job": job.to_dict(), "results": results})
+
+
+@router.get("/lsh-recall")
+def evaluate_lsh_recall(
+        sample_size: int = 50,
+        bands: Optional[int] = None,
+        rows: Optional[int] = None,
+        db: Session = Depends(get_db),
+        current_user: Users = Depends(require_admin)
+):
+    """
+    评估MinHash/LSH近似召回相对精确检索的Recall@K（管理员，bands/rows缺省使用当前配置）
+
+    需要为整个参考配方库计算签名并逐个精确检索，同步执行于线程池，不阻塞事件循环
+    """
+    if (bands is not None and bands <= 0) or (rows is not None and rows <= 0):
+        raise HTTPException(status_code=400, detail="bands、rows 必须为正整数")
+    if not 1 <= sample_size <= LSH_RECALL_MAX_SAMPLE_SIZE:
+        raise HTTPException(status_code=400, detail=f"sample_size必须在1到{LSH_RECALL_MAX_SAMPLE_SIZE}之间")
+
+    try:
+        matching_engine = get_matching_engine(db)
+        current = matching_engine.lsh_parameters
+        parameters = LSHParameters(
+            bands=bands or current.bands,
+            rows=rows or current.rows,
+            seed=current.seed
+        )
+        if parameters.num_permutations > MAX_NUM_PERMUTATIONS:
+            raise HTTPException(status_code=400, detail=f"bands × rows 不能超过 {MAX_NUM_PERMUTATIONS}")
+        report = matching_engine.evaluate_lsh_recall(db, sample_size=sample_size, parameters=parameters)
+        return JSONResponse(content={
+            "success": True,
+            "retrieval_mode": matching_engine.retrieval_mode,
+            "report": report
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"LSH召回率评估失败: {e}")
+        raise HTTPException(status_code=500, detail=f"LSH召回率评估失败: {str(e)}")
+
+
 @router.get("/customers")
 async def get_customers(db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
     """获取客户列表"""
@@ -664,10 +997,11 @@ async def compare_formulas_api(
         request: dict,
         db: Session = Depends(get_db)
 ):
-    """配方对比分析"""
+    """配方对比分析（请求中 explain 为 true 时在 match_details.explanation 中返回相似度计算明细）"""
     try:
         source_id = request.get('source_formula_id')
         target_id = request.get('target_formula_id')
+        explain = bool(request.get('explain', False))
 
         if not source_id or not target_id:
             raise HTTPException(status_code=400, detail="缺少配方ID参数")
@@ -697,9 +1031,10 @@ async def compare_formulas_api(
         # 使用匹配引擎进行详细分析
         matching_engine = get_matching_engine(db)
 
-        # 执行单对配方的详细匹配分析
+        # 执行单对配方的详细匹配分析（复用已加载的目标配方及结构）
         match_result = matching_engine._match_single_pair(
-            source_formula, source_structure, target_id, db
+            source_formula, source_structure, target_id, db,
+            target_formula=target_formula, target_structure=target_structure, explain=explain
         )
 
         if not match_result:
@@ -5,25 +5,37 @@
 """
 
 import os
+import shutil
 import tempfile
 import logging
+import threading
+import zipfile
 from datetime import datetime
 from decimal import Decimal
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
+from typing import List, Optional
+from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, BackgroundTasks
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 
-from src.backend.dependencies import get_db, require_login
+from src.backend.dependencies import (
+    get_db, require_login, require_admin, get_matching_engine, get_catalog_resolver, get_formula_import_manager,
+    get_parse_cache, initialize_database
+)
 from src.backend.sql.mysql_models import (
-    Formulas, FormulaIngredients, IngredientCatalog, 
-    FormulaMatchRecord, Users, DualFormulaLibraryHandler
+    Formulas, FormulaIngredients, FormulaIngredientsToBeMatched,
+    FormulaMatchRecord, FormulaDuplicatePair, Users, DualFormulaLibraryHandler
 )
 from src.backend.formula_parser import FormulaParser
+from src.backend.formula_import import is_excel_path
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/v1", tags=["参考配方库"])
 
+# 近似重复检测同一时间只运行一个
+_duplicate_detection_lock = threading.Lock()
+
 
 def safe_float(value):
     """安全转换Decimal为float"""
@@ -39,6 +51,10 @@ def safe_float(value):
         return 0.0
 
 
+class BatchDeleteRequest(BaseModel):
+    formula_ids: List[int]
+
+
 @router.get("/reference-library-stats")
 async def get_reference_library_stats(db: Session = Depends(get_db)):
     """获取配方库管理统计信息"""
@@ -158,6 +174,283 @@ async def get_reference_formulas(
         raise HTTPException(status_code=500, detail=f"获取配方库失败: {str(e)}")
 
 
+def _run_duplicate_detection(threshold: float):
+    """后台执行近似重复检测（使用独立的数据库会话）"""
+    try:
+        _, SessionLocal = initialize_database()
+        with SessionLocal() as db:
+            summary = get_matching_engine(db).detect_duplicate_formulas(db, threshold)
+        logger.info(f"参考配方近似重复检测完成: {summary}")
+    except Exception as e:
+        logger.error(f"参考配方近似重复检测失败: {e}")
+    finally:
+        _duplicate_detection_lock.release()
+
+
+@router.post("/reference-formulas/duplicates/detect")
+async def detect_duplicate_formulas(
+        background_tasks: BackgroundTasks,
+        threshold: float = 0.95,
+        current_user: Users = Depends(require_admin)
+):
+    """启动参考配方库近似重复检测（管理员，后台执行，结果整体替换上次的检测结果）"""
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="相似度阈值必须在 (0, 1] 范围内")
+    if not _duplicate_detection_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="近似重复检测正在进行中")
+
+    background_tasks.add_task(_run_duplicate_detection, threshold)
+    logger.info(f"管理员 {current_user.username} 启动近似重复检测, 阈值: {threshold}")
+    return JSONResponse(content={"success": True, "message": "近似重复检测已开始", "threshold": threshold})
+
+
+@router.get("/reference-formulas/duplicates")
+async def get_duplicate_formulas(db: Session = Depends(get_db), current_user: Users = Depends(require_admin)):
+    """获取最近一次近似重复检测的重复簇（簇内配方ID最小者为建议保留的配方）"""
+    try:
+        pairs = db.query(FormulaDuplicatePair).order_by(
+            FormulaDuplicatePair.cluster_id, FormulaDuplicatePair.formula_id, FormulaDuplicatePair.duplicate_formula_id
+        ).all()
+
+        formula_ids = sorted({pair.formula_id for pair in pairs} | {pair.duplicate_formula_id for pair in pairs})
+        formulas = {
+            formula.id: formula
+            for formula in db.query(Formulas).filter(Formulas.id.in_(formula_ids)).all()
+        } if formula_ids else {}
+
+        clusters = {}
+        for pair in pairs:
+            cluster = clusters.setdefault(pair.cluster_id, {"cluster_id": pair.cluster_id, "members": set(), "pairs": []})
+            cluster["members"].update((pair.formula_id, pair.duplicate_formula_id))
+            cluster["pairs"].append({
+                "formula_id": pair.formula_id,
+                "duplicate_formula_id": pair.duplicate_formula_id,
+                "similarity_score": safe_float(pair.similarity_score),
+                "composition_similarity": safe_float(pair.composition_similarity),
+                "proportion_similarity": safe_float(pair.proportion_similarity)
+            })
+
+        result_clusters = []
+        for cluster in clusters.values():
+            members = sorted(cluster["members"])
+            result_clusters.append({
+                "cluster_id": cluster["cluster_id"],
+                "keep_formula_id": members[0],
+                "formulas": [
+                    {
+                        "id": formula_id,
+                        "formula_name": formulas[formula_id].formula_name,
+                        "product_type": formulas[formula_id].product_type,
+                        "customer": formulas[formula_id].customer,
+                        "updated_at": formulas[formula_id].updated_at.isoformat()
+                        if formulas[formula_id].updated_at else None
+                    }
+                    for formula_id in members if formula_id in formulas
+                ],
+                "pairs": cluster["pairs"]
+            })
+
+        return JSONResponse(content={
+            "success": True,
+            "running": _duplicate_detection_lock.locked(),
+            "threshold": safe_float(pairs[0].threshold) if pairs else None,
+            "detected_at": pairs[0].detected_at.isoformat() if pairs and pairs[0].detected_at else None,
+            "cluster_count": len(result_clusters),
+            "duplicate_formula_count": sum(len(cluster["formulas"]) - 1 for cluster in result_clusters),
+            "clusters": result_clusters
+        })
+    except Exception as e:
+        logger.error(f"获取近似重复配方失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取近似重复配方失败: {str(e)}")
+
+
+@router.post("/reference-formulas/relink-catalog")
+async def relink_ingredient_catalog(db: Session = Depends(get_db), current_user: Users = Depends(require_admin)):
+    """
+    为两个配方库中尚未关联原料目录的成分重新解析目录条目（管理员，原料目录补充后使用）
+    关联发生变化的配方重新计算匹配特征，参考配方库增量更新匹配索引
+    """
+    try:
+        catalog_resolver = get_catalog_resolver(db)
+        matching_engine = get_matching_engine(db)
+        summary = {}
+        for table_type, ingredient_model in (('reference', FormulaIngredients),
+                                             ('to_be_matched', FormulaIngredientsToBeMatched)):
+            unlinked = db.query(ingredient_model).filter(ingredient_model.catalog_id.is_(None)).all()
+            catalog_keys = [(ingredient.standard_chinese_name, ingredient.inci_name) for ingredient in unlinked]
+            catalog_matches = catalog_resolver.resolve_many(catalog_keys)
+
+            changed_formula_ids = set()
+            for ingredient, catalog_match in zip(unlinked, catalog_matches):
+                if catalog_match is not None:
+                    ingredient.catalog_id = catalog_match.catalog_id
+                    changed_formula_ids.add(ingredient.formula_id)
+            if table_type == 'reference' and changed_formula_ids:
+                DualFormulaLibraryHandler.bump_library_version(db)
+            db.commit()
+
+            changed_formula_ids = sorted(changed_formula_ids)
+            if changed_formula_ids:
+                matching_engine.refresh_match_features(db, changed_formula_ids, table_type)
+                if table_type == 'reference':
+                    matching_engine.apply_library_changes(db, upserted_ids=changed_formula_ids)
+
+            summary[table_type] = {
+                "unlinked_count": len(unlinked),
+                "linked_count": sum(1 for catalog_match in catalog_matches if catalog_match is not None),
+                "updated_formula_count": len(changed_formula_ids),
+                "catalog_matching": catalog_resolver.summarize(catalog_keys, catalog_matches)
+            }
+
+        logger.info(f"管理员 {current_user.username} 重新关联原料目录: "
+                    f"参考库 {summary['reference']['linked_count']} 个成分, "
+                    f"待匹配库 {summary['to_be_matched']['linked_count']} 个成分")
+        return JSONResponse(content={"success": True, **summary})
+    except Exception as e:
+        logger.error(f"重新关联原料目录失败: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"重新关联原料目录失败: {str(e)}")
+
+
+@router.delete("/reference-formulas/batch")
+async def batch_delete_reference_formulas(request: BatchDeleteRequest, db: Session = Depends(get_db),
+                                          current_user: Users = Depends(require_admin)):
+    """批量删除参考配方（管理员，用于清理近似重复配方）"""
+    try:
+        if not request.formula_ids:
+            raise HTTPException(status_code=400, detail="请选择要删除的配方")
+
+        formulas = db.query(Formulas).filter(Formulas.id.in_(request.formula_ids)).all()
+        if not formulas:
+            raise HTTPException(status_code=404, detail="未找到要删除的配方")
+        formula_ids = [formula.id for formula in formulas]
+
+        # 删除相关的匹配记录、匹配特征、来源文件指纹与近似重复记录（成分通过外键级联删除）
+        match_records_count = db.query(FormulaMatchRecord).filter(
+            FormulaMatchRecord.target_formula_id.in_(formula_ids)
+        ).delete(synchronize_session=False)
+        DualFormulaLibraryHandler.delete_match_features(db, 'reference', formula_ids)
+        DualFormulaLibraryHandler.delete_source_files(db, 'reference', formula_ids)
+        DualFormulaLibraryHandler.delete_duplicate_pairs(db, formula_ids)
+        for formula in formulas:
+            db.delete(formula)
+        DualFormulaLibraryHandler.bump_library_version(db)
+        db.commit()
+
+        # 参考配方库已变更，增量更新匹配索引
+        get_matching_engine(db).apply_library_changes(db, deleted_ids=formula_ids)
+
+        logger.info(f"批量删除参考配方成功: 删除了 {len(formula_ids)} 个配方，{match_records_count} 条匹配记录")
+        return JSONResponse(content={
+            "success": True,
+            "message": f"批量删除完成，共删除 {len(formula_ids)} 个配方",
+            "deleted_count": len(formula_ids),
+            "deleted_formula_ids": formula_ids,
+            "deleted_match_records_count": match_records_count
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"批量删除参考配方失败: {e}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"批量删除参考配方失败: {str(e)}")
+
+
+@router.post("/reference-formulas/bulk-import")
+def submit_bulk_import(
+        archive: Optional[UploadFile] = File(None),
+        files: List[UploadFile] = File(None),
+        paths: List[str] = Form(None),
+        has_root_folder: Optional[bool] = Form(None),
+        db: Session = Depends(get_db),
+        current_user: Users = Depends(require_login)
+):
+    """
+    提交批量导入任务，立即返回任务ID，解析与写入由后台任务执行
+
+    二选一：archive为按 客户/产品大类/产品小类/配方.xlsx 组织的zip压缩包；或files与paths一一对应，
+    paths为各文件在文件夹中的相对路径（文件较多时前端分批提交，每批一个任务）。
+    has_root_folder指定路径是否带主文件夹，不传时自动判断。
+    上传内容同步复制到暂存目录（压缩包可达数GB），因此为同步接口，在线程池中执行，不阻塞事件循环
+    """
+    if archive is None and not files:
+        raise HTTPException(status_code=400, detail="请上传zip压缩包或配方文件")
+    if files and (not paths or len(paths) != len(files)):
+        raise HTTPException(status_code=400, detail="paths必须与files一一对应")
+
+    staging_dir = tempfile.mkdtemp(prefix='formula_import_')
+    try:
+        if archive is not None:
+            if not archive.filename.lower().endswith('.zip'):
+                raise HTTPException(status_code=400, detail="只支持zip格式的压缩包")
+            archive_path = os.path.join(staging_dir, 'archive.zip')
+            with open(archive_path, 'wb') as target:
+                shutil.copyfileobj(archive.file, target)
+            if not zipfile.is_zipfile(archive_path):
+                raise HTTPException(status_code=400, detail="不是有效的zip压缩包")
+            sources = None
+        else:
+            archive_path = None
+            sources = []
+            for index, (upload, relative_path) in enumerate(zip(files, paths)):
+                relative_path = relative_path.replace('\\', '/').strip('/')
+                if not is_excel_path(relative_path) or '..' in relative_path.split('/'):
+                    continue
+                local_path = os.path.join(staging_dir, f"{index:06d}{os.path.splitext(relative_path)[1].lower()}")
+                with open(local_path, 'wb') as target:
+                    shutil.copyfileobj(upload.file, target)
+                sources.append((relative_path, local_path))
+            if not sources:
+                raise HTTPException(status_code=400, detail="未找到有效的Excel文件")
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    job = get_formula_import_manager(db).submit(
+        staging_dir,
+        archive_path=archive_path,
+        sources=sources,
+        has_root_folder=has_root_folder,
+        user_id=current_user.id,
+        created_by=current_user.username
+    )
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
+@router.get("/reference-formulas/bulk-import")
+async def list_bulk_imports(db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """批量导入任务列表（管理员全量，普通用户仅自己的）"""
+    jobs = get_formula_import_manager(db).list_jobs()
+    if current_user.role != 'admin':
+        jobs = [job for job in jobs if job.created_by == current_user.username]
+    return JSONResponse(content={"success": True, "jobs": [job.to_dict() for job in jobs]})
+
+
+def _get_visible_import_job(job_id: str, db: Session, current_user: Users):
+    """读取当前用户可见的批量导入任务，不存在或无权访问时返回404"""
+    job = get_formula_import_manager(db).get(job_id)
+    if job is None or (current_user.role != 'admin' and job.created_by != current_user.username):
+        raise HTTPException(status_code=404, detail="批量导入任务不存在")
+    return job
+
+
+@router.get("/reference-formulas/bulk-import/{job_id}")
+async def get_bulk_import(job_id: str, db: Session = Depends(get_db), current_user: Users = Depends(require_login)):
+    """查询批量导入任务状态、进度与逐个文件的失败原因"""
+    job = _get_visible_import_job(job_id, db, current_user)
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
+@router.post("/reference-formulas/bulk-import/{job_id}/cancel")
+async def cancel_bulk_import(job_id: str, db: Session = Depends(get_db),
+                             current_user: Users = Depends(require_login)):
+    """取消批量导入任务（已写入的配方保留）"""
+    _get_visible_import_job(job_id, db, current_user)
+    job = get_formula_import_manager(db).cancel(job_id)
+    return JSONResponse(content={"success": True, "job": job.to_dict()})
+
+
 @router.get("/reference-formulas/{formula_id}")
 async def get_reference_formula_detail(formula_id: int, db: Session = Depends(get_db)):
     """获取配方库详细信息"""
@@ -177,10 +470,10 @@ async def get_reference_formula_detail(formula_id: int, db: Session = Depends(ge
         
         logger.info(f"找到 {len(ingredients)} 个成分记录")
 
-        # 获取配方结构 - 增加错误处理
+        # 由已加载的成分记录构建配方结构 - 增加错误处理
         try:
-            structure = DualFormulaLibraryHandler.get_formula_structure(
-                formula_id, db, 'reference'
+            structure = DualFormulaLibraryHandler.build_formula_structure(
+                formula_id, ingredients, 'reference'
             )
             logger.info(f"配方结构获取成功")
         except Exception as e:
@@ -265,10 +558,17 @@ async def delete_reference_formula(formula_id: int, db: Session = Depends(get_db
             FormulaIngredients.formula_id == formula_id
         ).count()
 
-        # 3. 删除配方
+        # 3. 删除配方及其匹配特征、来源文件指纹
+        DualFormulaLibraryHandler.delete_match_features(db, 'reference', [formula_id])
+        DualFormulaLibraryHandler.delete_source_files(db, 'reference', [formula_id])
+        DualFormulaLibraryHandler.delete_duplicate_pairs(db, [formula_id])
         db.delete(formula)
+        DualFormulaLibraryHandler.bump_library_version(db)
         db.commit()
 
+        # 参考配方库已变更，增量更新匹配索引
+        get_matching_engine(db).apply_library_changes(db, deleted_ids=[formula_id])
+
         result = {
             "success": True,
             "message": f"配方 '{formula_name}' 及其 {ingredients_count} 个成分已删除",
@@ -326,110 +626,124 @@ async def edit_reference_formula(
         formula.updated_at = datetime.now()
 
         # 如果上传了新文件，则重新解析成分
+        catalog_matching = None
+        same_file_formulas = None
         if file and file.filename:
             logger.info(f"重新解析配方文件: {file.filename}")
 
-            # 创建临时文件
+            # 按内容指纹解析新文件：相同内容的文件已解析过时直接使用缓存的解析结果
             file_extension = os.path.splitext(file.filename)[1].lower()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-                tmp_path = tmp_file.name
-                content = await file.read()
-                tmp_file.write(content)
-
-            try:
-                # 解析新文件
-                parser = FormulaParser()
-                parsed_result = parser.parse_file(tmp_path)
-
-                # 检查是否有成分数据
-                ingredients_data = parsed_result.get('ingredients', [])
-                if not ingredients_data:
-                    raise HTTPException(status_code=400, detail="文件中没有找到有效的成分数据")
-
-                # 删除原有成分
-                db.query(FormulaIngredients).filter(FormulaIngredients.formula_id == formula_id).delete()
-
-                # 添加新成分 - 使用与添加配方相同的逻辑
-                ingredients_created = 0
-                parsed_ingredients = parsed_result['ingredients']
-
-                # 按序号分组，检测复配
-                ingredient_groups = {}
-                for ingredient in parsed_ingredients:
-                    seq = ingredient['sequence']
-                    if seq not in ingredient_groups:
-                        ingredient_groups[seq] = []
-                    ingredient_groups[seq].append(ingredient)
-
-                # 处理每个序号组
-                for seq, group in ingredient_groups.items():
-                    if len(group) == 1:
-                        # 单一成分
-                        ing = group[0]
-                        # 尝试匹配原料目录
-                        catalog_match = db.query(IngredientCatalog).filter(
-                            IngredientCatalog.chinese_name == ing['chinese_name']
-                        ).first()
+            content = await file.read()
+            parser = FormulaParser()
+            content_hash, parsed_result, _ = parser.parse_content(
+                content, file_extension, cache=get_parse_cache()
+            )
+            same_file_formulas = [
+                same_file_formula for same_file_formula in DualFormulaLibraryHandler.find_formulas_by_source_hashes(
+                    db, [content_hash]
+                ).get(content_hash, [])
+                if not (same_file_formula["table_type"] == 'reference' and same_file_formula["formula_id"] == formula_id)
+            ]
+            DualFormulaLibraryHandler.save_source_files(db, 'reference', {formula_id: (content_hash, file.filename)})
+
+            # 检查是否有成分数据
+            ingredients_data = parsed_result.get('ingredients', [])
+            if not ingredients_data:
+                raise HTTPException(status_code=400, detail="文件中没有找到有效的成分数据")
+
+            # 删除原有成分
+            db.query(FormulaIngredients).filter(FormulaIngredients.formula_id == formula_id).delete()
+
+            # 添加新成分 - 使用与添加配方相同的逻辑
+            ingredients_created = 0
+            parsed_ingredients = parsed_result['ingredients']
+
+            # 一次解析全部成分对应的原料目录条目（精确 → 规范化 → INCI → 模糊）
+            catalog_resolver = get_catalog_resolver(db)
+            catalog_keys = [(ing['chinese_name'], ing['inci_name']) for ing in parsed_ingredients]
+            catalog_matches = catalog_resolver.resolve_many(catalog_keys)
+            catalog_lookup = dict(zip(catalog_keys, catalog_matches))
+            catalog_matching = catalog_resolver.summarize(catalog_keys, catalog_matches)
+
+            # 按序号分组，检测复配
+            ingredient_groups = {}
+            for ingredient in parsed_ingredients:
+                seq = ingredient['sequence']
+                if seq not in ingredient_groups:
+                    ingredient_groups[seq] = []
+                ingredient_groups[seq].append(ingredient)
+
+            # 处理每个序号组
+            for seq, group in ingredient_groups.items():
+                if len(group) == 1:
+                    # 单一成分
+                    ing = group[0]
+                    # 原料目录匹配结果
+                    catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
+
+                    # 使用Excel文件中的原始使用目的字段
+                    purpose = ing.get('purpose', '').strip() or '未填写'
+
+                    ingredient = FormulaIngredients(
+                        formula_id=formula_id,
+                        ingredient_id=seq,
+                        ingredient_sequence=1,
+                        standard_chinese_name=ing['chinese_name'],
+                        inci_name=ing['inci_name'] or None,
+                        ingredient_content=ing['percentage'],
+                        catalog_id=catalog_match.catalog_id if catalog_match else None,
+                        component_content=ing.get('ingredient_percentage', 100.0),
+                        actual_component_content=ing.get('actual_percentage', ing['percentage']),
+                        purpose=purpose
+                    )
+                    db.add(ingredient)
+                    ingredients_created += 1
+                else:
+                    # 复配成分
+                    for sub_seq, ing in enumerate(group, 1):
+                        # 原料目录匹配结果
+                        catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
 
                         # 使用Excel文件中的原始使用目的字段
                         purpose = ing.get('purpose', '').strip() or '未填写'
 
+                        # 创建复配成分记录
                         ingredient = FormulaIngredients(
                             formula_id=formula_id,
-                            ingredient_id=seq,
-                            ingredient_sequence=1,
+                            ingredient_id=seq,  # 相同的配料ID表示复配
+                            ingredient_sequence=sub_seq,  # 不同的序号表示复配中的不同成分
                             standard_chinese_name=ing['chinese_name'],
                             inci_name=ing['inci_name'] or None,
-                            ingredient_content=ing['percentage'],
-                            catalog_id=catalog_match.id if catalog_match else None,
+                            ingredient_content=ing['percentage'],  # 在复配中的比例
+                            catalog_id=catalog_match.catalog_id if catalog_match else None,
                             component_content=ing.get('ingredient_percentage', 100.0),
                             actual_component_content=ing.get('actual_percentage', ing['percentage']),
                             purpose=purpose
                         )
                         db.add(ingredient)
                         ingredients_created += 1
-                    else:
-                        # 复配成分
-                        for sub_seq, ing in enumerate(group, 1):
-                            # 尝试匹配原料目录
-                            catalog_match = db.query(IngredientCatalog).filter(
-                                IngredientCatalog.chinese_name == ing['chinese_name']
-                            ).first()
-
-                            # 使用Excel文件中的原始使用目的字段
-                            purpose = ing.get('purpose', '').strip() or '未填写'
-
-                            # 创建复配成分记录
-                            ingredient = FormulaIngredients(
-                                formula_id=formula_id,
-                                ingredient_id=seq,  # 相同的配料ID表示复配
-                                ingredient_sequence=sub_seq,  # 不同的序号表示复配中的不同成分
-                                standard_chinese_name=ing['chinese_name'],
-                                inci_name=ing['inci_name'] or None,
-                                ingredient_content=ing['percentage'],  # 在复配中的比例
-                                catalog_id=catalog_match.id if catalog_match else None,
-                                component_content=ing.get('ingredient_percentage', 100.0),
-                                actual_component_content=ing.get('actual_percentage', ing['percentage']),
-                                purpose=purpose
-                            )
-                            db.add(ingredient)
-                            ingredients_created += 1
-
-                logger.info(f"更新了 {ingredients_created} 个成分")
-
-            finally:
-                # 清理临时文件
-                os.unlink(tmp_path)
+
+            logger.info(f"更新了 {ingredients_created} 个成分")
 
         # 提交更改
+        DualFormulaLibraryHandler.bump_library_version(db)
         db.commit()
 
+        # 重新计算匹配特征；参考配方库已变更，增量更新匹配索引
+        matching_engine = get_matching_engine(db)
+        matching_engine.refresh_match_features(db, [formula_id], 'reference')
+        matching_engine.apply_library_changes(db, upserted_ids=[formula_id])
+
         result = {
             "success": True,
             "message": f"配方 '{old_name}' 已更新为 '{formula_name}'",
             "formula_id": formula_id,
             "updated_file": bool(file and file.filename)
         }
+        if catalog_matching is not None:
+            result["catalog_matching"] = catalog_matching
+        if same_file_formulas is not None:
+            result["same_file_formulas"] = same_file_formulas
 
         logger.info(f"成功编辑配方: {old_name} -> {formula_name} (ID: {formula_id})")
         return JSONResponse(content=result)
@@ -5,6 +5,7 @@
 """
 
 import logging
+from typing import Optional
 from pydantic import BaseModel
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import JSONResponse
@@ -12,6 +13,7 @@ from sqlalchemy.orm import Session
 
 from src.backend.dependencies import get_db, get_current_user
 from src.backend.sql.mysql_models import SystemConfig, SystemConfigManager, Users
+from src.backend.dual_library_matching_engine import MAX_RESULTS_LIMIT
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/v1", tags=["系统配置"])
@@ -31,6 +33,7 @@ class MatchingParametersRequest(BaseModel):
     proportion_weight: float
     compound_threshold: float
     min_similarity_threshold: float
+    max_results: Optional[int] = None
 
 
 @router.get("/stats")
@@ -147,6 +150,15 @@ async def update_matching_parameters(request: MatchingParametersRequest, db: Ses
                 detail="最小相似度阈值必须在0.0-1.0之间"
             )
 
+        # 未提供时保持当前的默认结果数量
+        if request.max_results is not None:
+            if not (1 <= request.max_results <= MAX_RESULTS_LIMIT):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"默认返回结果数量必须在1-{MAX_RESULTS_LIMIT}之间"
+                )
+            params['max_results'] = request.max_results
+
         SystemConfigManager.set_matching_parameters(db, params)
         logger.info(f"匹配算法参数已更新: {params}")
 
@@ -12,7 +12,9 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
-from .dependencies import initialize_database
+from .dependencies import (
+    initialize_database, start_matching_engine_warmup, shutdown_match_job_manager, shutdown_formula_import_manager
+)
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +61,13 @@ def create_app() -> FastAPI:
     
     # 注册路由
     register_routes(app)
+
+    # 启动后在后台预构建参考配方库匹配索引
+    app.add_event_handler("startup", start_matching_engine_warmup)
+
+    # 应用关闭时停止后台匹配任务与批量导入任务
+    app.add_event_handler("shutdown", shutdown_match_job_manager)
+    app.add_event_handler("shutdown", shutdown_formula_import_manager)
     
     logger.info("FastAPI应用创建完成")
     return app
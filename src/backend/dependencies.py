@@ -5,7 +5,9 @@
 """
 
 import logging
-from typing import Optional
+import os
+import threading
+from typing import Dict, Optional
 from fastapi import HTTPException, Request, Depends
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy import create_engine
@@ -17,20 +19,177 @@ logger = logging.getLogger(__name__)
 
 # 全局变量
 _matching_engine = None
+_matching_engine_lock = threading.Lock()
+_match_job_manager = None
+_match_job_manager_lock = threading.Lock()
+_formula_import_manager = None
+_catalog_resolver = None
+_catalog_resolver_lock = threading.Lock()
+_parse_cache = None
+_parse_cache_lock = threading.Lock()
 _engine = None
 _SessionLocal = None
 
 
 def get_matching_engine(db_session):
-    """获取匹配引擎实例（单例模式）"""
+    """获取匹配引擎实例（单例模式，并发首次调用时只创建一个实例）"""
     global _matching_engine
     if _matching_engine is None:
-        from ..backend.dual_library_matching_engine import DualLibraryMatchingEngine
-        _matching_engine = DualLibraryMatchingEngine()
-        logger.info("匹配引擎初始化完成")
+        with _matching_engine_lock:
+            if _matching_engine is None:
+                from ..backend.dual_library_matching_engine import DualLibraryMatchingEngine
+                _matching_engine = DualLibraryMatchingEngine()
+                logger.info("匹配引擎初始化完成")
     return _matching_engine
 
 
+def get_match_job_manager(db_session):
+    """获取异步匹配任务管理器（单例模式），工作线程数读取system_config.ini的[matching] job_workers"""
+    global _match_job_manager
+    if _match_job_manager is None:
+        with _match_job_manager_lock:
+            if _match_job_manager is None:
+                from ..backend.matching_jobs import MatchJobManager
+                config = SystemConfigManager.load_system_config()
+                max_workers = 2
+                if config and 'matching' in config:
+                    try:
+                        max_workers = config.getint('matching', 'job_workers', fallback=max_workers)
+                    except ValueError as e:
+                        logger.warning(f"读取[matching] job_workers失败，使用默认值 {max_workers}: {e}")
+                _, SessionLocal = initialize_database()
+                _match_job_manager = MatchJobManager(get_matching_engine(db_session), SessionLocal,
+                                                     max_workers=max_workers)
+                logger.info(f"匹配任务管理器初始化完成，工作线程数: {max_workers}")
+    return _match_job_manager
+
+
+def get_catalog_resolver(db_session):
+    """
+    获取原料目录解析器（单例模式）
+    每次获取时比较原料目录版本戳，目录有增删改时重新加载；模糊匹配阈值读取system_config.ini的[matching] catalog_fuzzy_threshold
+    """
+    global _catalog_resolver
+    from ..backend.ingredient_catalog import IngredientCatalogResolver
+    stamp = IngredientCatalogResolver.catalog_stamp(db_session)
+    with _catalog_resolver_lock:
+        if _catalog_resolver is None or _catalog_resolver.stamp != stamp:
+            config = SystemConfigManager.load_system_config()
+            fuzzy_threshold = IngredientCatalogResolver.FUZZY_THRESHOLD
+            if config and 'matching' in config:
+                try:
+                    fuzzy_threshold = config.getfloat('matching', 'catalog_fuzzy_threshold', fallback=fuzzy_threshold)
+                except ValueError as e:
+                    logger.warning(f"读取[matching] catalog_fuzzy_threshold失败，使用默认值 {fuzzy_threshold}: {e}")
+            _catalog_resolver = IngredientCatalogResolver.load(db_session, fuzzy_threshold=fuzzy_threshold)
+        return _catalog_resolver
+
+
+def get_parse_cache():
+    """
+    获取上传文件解析结果缓存（单例模式，按文件内容指纹缓存）
+    条目数与存活时间读取system_config.ini的[import] parse_cache_size、parse_cache_ttl
+    """
+    global _parse_cache
+    with _parse_cache_lock:
+        if _parse_cache is None:
+            from ..backend.matching_cache import ParseResultCache
+            max_entries, ttl_seconds = 128, 0.0
+            config = SystemConfigManager.load_system_config()
+            if config and 'import' in config:
+                try:
+                    max_entries = config.getint('import', 'parse_cache_size', fallback=max_entries)
+                    ttl_seconds = config.getfloat('import', 'parse_cache_ttl', fallback=ttl_seconds)
+                except ValueError as e:
+                    logger.warning(f"读取[import]解析结果缓存配置失败，使用默认值: {e}")
+            _parse_cache = ParseResultCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+            logger.info(f"解析结果缓存初始化完成，最大条目数: {max_entries}")
+        return _parse_cache
+
+
+def get_formula_import_manager(db_session):
+    """
+    获取批量导入任务管理器（单例模式）
+    解析进程数、解析超时、内存上限、每批写入数量与压缩包大小上限读取system_config.ini的[import]
+    """
+    global _formula_import_manager
+    if _formula_import_manager is None:
+        from ..backend.formula_import import FormulaImportManager
+        settings = {'parse_workers': min(4, os.cpu_count() or 1), 'parse_timeout': 120.0,
+                    'parse_max_memory_mb': 1024, 'batch_size': 200, 'max_archive_mb': 2048}
+        config = SystemConfigManager.load_system_config()
+        if config and 'import' in config:
+            for key, default in settings.items():
+                getter = config.getfloat if isinstance(default, float) else config.getint
+                try:
+                    settings[key] = getter('import', key, fallback=default)
+                except ValueError as e:
+                    logger.warning(f"读取[import] {key}失败，使用默认值 {default}: {e}")
+        _, SessionLocal = initialize_database()
+        _formula_import_manager = FormulaImportManager(
+            get_matching_engine(db_session), SessionLocal, get_catalog_resolver, parse_cache=get_parse_cache(),
+            parse_workers=settings['parse_workers'],
+            parse_timeout=settings['parse_timeout'] or None,
+            parse_max_memory_mb=settings['parse_max_memory_mb'] or None,
+            batch_size=settings['batch_size'],
+            max_archive_bytes=settings['max_archive_mb'] * 1024 * 1024 if settings['max_archive_mb'] else None
+        )
+        logger.info(f"批量导入任务管理器初始化完成，解析进程数: {settings['parse_workers']}")
+    return _formula_import_manager
+
+
+def shutdown_match_job_manager():
+    """应用关闭时停止异步匹配任务（运行中的任务在当前配方完成后停止）"""
+    global _match_job_manager
+    with _match_job_manager_lock:
+        if _match_job_manager is not None:
+            _match_job_manager.shutdown()
+            _match_job_manager = None
+            logger.info("匹配任务管理器已停止")
+
+
+def shutdown_formula_import_manager():
+    """应用关闭时停止批量导入任务（运行中的任务停止解析，已写入的配方保留）"""
+    global _formula_import_manager
+    if _formula_import_manager is not None:
+        _formula_import_manager.shutdown()
+        _formula_import_manager = None
+        logger.info("批量导入任务管理器已停止")
+
+
+def warmup_matching_engine():
+    """预构建参考配方库匹配索引（缺失的匹配特征在构建时即时计算）"""
+    try:
+        _, SessionLocal = initialize_database()
+        with SessionLocal() as db:
+            get_matching_engine(db).build_library_index(db)
+        logger.info("✅ 参考配方库匹配索引预构建完成")
+    except Exception as e:
+        logger.warning(f"⚠️ 参考配方库匹配索引预构建失败，将在首次匹配时构建: {e}")
+
+
+def start_matching_engine_warmup():
+    """应用启动后在后台线程中预构建参考配方库匹配索引，不阻塞应用创建与请求处理"""
+    threading.Thread(target=warmup_matching_engine, name="matching-index-warmup", daemon=True).start()
+
+
+def backfill_match_features() -> Dict[str, int]:
+    """
+    为两库中缺少当前版本匹配特征的配方批量计算并持久化特征
+
+    一次性命令（python main.py --backfill-features），在升级特征规则版本或导入历史数据后单进程执行，
+    避免多个工作进程启动时同时写入特征
+
+    Returns:
+        各配方库补齐的配方数量
+    """
+    _, SessionLocal = initialize_database()
+    with SessionLocal() as db:
+        matching_engine = get_matching_engine(db)
+        return {table_type: matching_engine.backfill_match_features(db, table_type)
+                for table_type in ('reference', 'to_be_matched')}
+
+
 def initialize_database():
     """初始化数据库连接"""
     global _engine, _SessionLocal
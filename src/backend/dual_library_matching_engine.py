@@ -6,25 +6,59 @@
 实现基于更新需求的两段式相似度计算算法
 """
 
+import hashlib
+import heapq
+import json
+import os
 import numpy as np
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from dataclasses import asdict, dataclass
 import logging
-from sklearn.metrics.pairwise import cosine_similarity
 from collections import defaultdict
 
 from src.backend.sql.mysql_models import (
-    Formulas, FormulasToBeMatched,
-    DualFormulaLibraryHandler, SystemConfigManager
+    Formulas, FormulasToBeMatched, FormulaMatchFeatures,
+    DualFormulaLibraryHandler, SystemConfigManager, LIBRARY_VERSION_KEY
 )
-from sqlalchemy import or_
+from src.backend.matching_index import (
+    MatchFeatures, ReferenceLibraryIndex, SegmentedLibraryIndex, SourceBatch, SourceFeatures, STANDARD_CATEGORIES,
+    compound_jaccard, compound_signature, parse_compound_signature, stamp_digest
+)
+from src.backend.matching_lsh import LSHParameters, MAX_NUM_PERMUTATIONS, MinHashLSHIndex
+from src.backend.matching_cache import MatchResultCache
 
 logger = logging.getLogger(__name__)
 
+# 候选召回模式
+RETRIEVAL_MODES = ('exact', 'lsh')
 
-@dataclass
+# 渐进式匹配每个分区的配方数量（每个分区完成后推送一次临时结果）
+PROGRESS_PARTITION_SIZE = 5000
+
+# 单次匹配/单页返回的结果数量上限
+MAX_RESULTS_LIMIT = 100
+
+# LSH召回率评估的查询配方数量上限（每个查询配方都做一次精确Top-K检索）
+LSH_RECALL_MAX_SAMPLE_SIZE = 200
+
+# 分页匹配首次排名的深度（页数）：一次取前 page_size × CURSOR_PREFETCH_PAGES 名暂存在服务端供后续翻页
+CURSOR_PREFETCH_PAGES = 10
+
+# 匹配特征提取规则版本：extract_match_features 的输出规则变化时递增，已持久化的旧版本特征将被重新计算
+# （2：复配改为按全部组成成分的catalog_id集合标识）
+MATCH_FEATURE_VERSION = 2
+
+# 项目根目录及默认的匹配索引快照目录（相对项目根目录）
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_INDEX_SNAPSHOT_DIR = os.path.join('data', 'match_index')
+
+
+@dataclass(frozen=True)
 class DualLibraryMatchingParameters:
-    """双配方库匹配算法参数"""
+    """双配方库匹配算法参数（不可变，每次匹配使用同一份快照）"""
     # 类别权重
     category_weights: Dict[str, float]
 
@@ -39,6 +73,12 @@ class DualLibraryMatchingParameters:
     min_similarity_threshold: float
     max_results: int
 
+    @property
+    def fingerprint(self) -> str:
+        """参数内容摘要（匹配结果缓存键的一部分，内容相同的参数摘要相同）"""
+        payload = json.dumps(asdict(self), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
 
 @dataclass
 class DualLibraryMatchResult:
@@ -57,18 +97,148 @@ class DualLibraryMatchResult:
     match_details: Dict
 
 
+@dataclass
+class MatchRanking:
+    """
+    分页匹配暂存的排名（服务端短期保存，游标翻页时直接切片，不重新打分）
+
+    同时保存生成排名时的内存索引，加深排名时仍在同一索引上打分；排名只在深度不足时整体替换为更深的排名
+    """
+    source_formula_id: int
+    library_index: SegmentedLibraryIndex
+    parameters: DualLibraryMatchingParameters
+    strict_mode: bool
+    retrieval_mode: str
+    ranking: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]
+    complete: bool
+
+
+@dataclass
+class MatchPage:
+    """分页匹配的一页结果"""
+    source_formula_id: int
+    results: List[DualLibraryMatchResult]
+    offset: int
+    next_cursor: Optional[str]
+    parameters: DualLibraryMatchingParameters
+    retrieval_mode: str
+
+
+@dataclass
+class IndexBatchScores:
+    """内存索引批量打分结果（各数组按候选顺序对齐）"""
+    rows: np.ndarray
+    total: np.ndarray
+    composition: np.ndarray
+    proportion: np.ndarray
+    category_similarities: np.ndarray
+    active_categories: np.ndarray
+
+    def scores_at(self, i: int) -> Tuple[int, Tuple[float, float, float, Dict[str, float]]]:
+        """第i个候选的 (行号, (总相似度, 组成相似度, 比例相似度, 分类相似度))"""
+        category_similarities = {
+            category: float(self.category_similarities[i, code])
+            for code, category in enumerate(STANDARD_CATEGORIES)
+            if self.active_categories[i, code]
+        }
+        return int(self.rows[i]), (float(self.total[i]), float(self.composition[i]),
+                                   float(self.proportion[i]), category_similarities)
+
+
 class DualLibraryMatchingEngine:
     """双配方库匹配引擎"""
 
+    # 上界剪枝时每批精确打分的候选数量
+    TOP_K_BLOCK_SIZE = 2048
+    # 上界比较的浮点容差（精确分数存在1e-10级别的精度修正）
+    UPPER_BOUND_TOLERANCE = 1e-9
+    # 多对多批量打分时每块 (待匹配配方数 × 参考配方行数 × 分类数) 的元素数量上限
+    BATCH_SCORE_BUDGET = 1 << 22
+
     def __init__(self, parameters: DualLibraryMatchingParameters = None):
         """初始化匹配引擎"""
+        # 默认匹配参数（无法读取配置快照时使用），匹配过程中不修改
         self.parameters = parameters or self._get_default_parameters()
+        # (匹配配置快照版本, 对应的参数)，整体替换保证并发读取一致
+        self._parameters_cache: Tuple[int, DualLibraryMatchingParameters] = (0, self.parameters)
+
+        # 参考配方库常驻内存索引（基础段 + 增量段）
+        self._library_index: Optional[SegmentedLibraryIndex] = None
+        self._library_index_stale = False
+        self._library_index_lock = threading.Lock()
+
+        # 候选召回模式：exact（倒排索引精确召回）或 lsh（MinHash/LSH近似召回）
+        self.retrieval_mode = 'exact'
+        self.lsh_parameters = LSHParameters()
+        # 当前内存索引各段对应的LSH索引
+        self._lsh_indexes: List[MinHashLSHIndex] = []
+        self._lsh_index_lock = threading.Lock()
+
+        # 匹配索引磁盘快照目录，None表示不使用快照
+        self.index_snapshot_dir: Optional[str] = os.path.join(PROJECT_ROOT, DEFAULT_INDEX_SNAPSHOT_DIR)
+
+        # 当前索引对应的数据库配方库版本戳及其摘要（索引匹配结果缓存键的一部分）
+        self._library_stamp: Optional[Dict] = None
+        self._library_version: Optional[str] = None
+        # 最近一次从数据库读取的配方库版本戳及其摘要（单对匹配结果缓存键的一部分）、读取时间（单调时钟）
+        self._observed_library_stamp: Optional[Dict] = None
+        self._observed_library_version: Optional[str] = None
+        self._library_checked_at = 0.0
+        # 版本戳比较的最小间隔（秒），0表示每次获取索引都比较
+        self.library_check_interval = 1.0
+
+        self.result_cache = MatchResultCache()
+        # 分页匹配暂存的排名（键为排名ID，值引用内存索引，不做深拷贝）
+        self.ranking_cache = MatchResultCache(max_entries=128, ttl_seconds=300.0, copy_values=False)
+
+        self._load_matching_config()
+
+    def _load_matching_config(self):
+        """从system_config.ini的[matching]段读取候选召回模式、LSH参数、索引快照目录与版本检查间隔、结果缓存与分页排名配置"""
+        config = SystemConfigManager.load_system_config()
+        if not config or 'matching' not in config:
+            return
+        try:
+            retrieval_mode = config.get('matching', 'retrieval_mode', fallback='exact').strip().lower()
+            if retrieval_mode in RETRIEVAL_MODES:
+                self.retrieval_mode = retrieval_mode
+            else:
+                logger.warning(f"未知的候选召回模式 {retrieval_mode}，使用 exact")
 
-        # 成分分类缓存
-        self._ingredient_categories = {}
+            defaults = LSHParameters()
+            lsh_parameters = LSHParameters(
+                bands=config.getint('matching', 'lsh_bands', fallback=defaults.bands),
+                rows=config.getint('matching', 'lsh_rows', fallback=defaults.rows),
+                seed=config.getint('matching', 'lsh_seed', fallback=defaults.seed)
+            )
+            if lsh_parameters.bands <= 0 or lsh_parameters.rows <= 0 or \
+                    lsh_parameters.num_permutations > MAX_NUM_PERMUTATIONS:
+                raise ValueError(f"lsh_bands、lsh_rows 须为正整数且乘积不超过 {MAX_NUM_PERMUTATIONS}")
+            self.lsh_parameters = lsh_parameters
+        except ValueError as e:
+            logger.warning(f"读取[matching]召回配置失败，使用默认召回配置: {e}")
+
+        snapshot_dir = config.get('matching', 'index_snapshot_dir', fallback=DEFAULT_INDEX_SNAPSHOT_DIR).strip()
+        self.index_snapshot_dir = os.path.join(PROJECT_ROOT, snapshot_dir) if snapshot_dir else None
+        try:
+            self.library_check_interval = config.getfloat(
+                'matching', 'library_check_interval', fallback=self.library_check_interval
+            )
+        except ValueError as e:
+            logger.warning(f"读取[matching] library_check_interval失败，使用默认值 {self.library_check_interval}: {e}")
 
-        # 复配体系缓存
-        self._compound_systems = {}
+        try:
+            self.result_cache = MatchResultCache(
+                max_entries=config.getint('matching', 'result_cache_size', fallback=self.result_cache.max_entries),
+                ttl_seconds=config.getfloat('matching', 'result_cache_ttl', fallback=self.result_cache.ttl_seconds)
+            )
+            self.ranking_cache = MatchResultCache(
+                max_entries=config.getint('matching', 'ranking_cache_size', fallback=self.ranking_cache.max_entries),
+                ttl_seconds=config.getfloat('matching', 'ranking_cache_ttl', fallback=self.ranking_cache.ttl_seconds),
+                copy_values=False
+            )
+        except ValueError as e:
+            logger.warning(f"读取[matching]结果缓存配置失败，使用默认缓存配置: {e}")
 
     def _get_default_parameters(self) -> DualLibraryMatchingParameters:
         """获取默认匹配参数（硬编码备用）"""
@@ -88,37 +258,40 @@ class DualLibraryMatchingEngine:
             max_results=5
         )
 
-    def _load_parameters_from_db(self, session) -> DualLibraryMatchingParameters:
-        """从数据库加载匹配参数"""
-        try:
-            # 获取分类权重
-            category_weights = SystemConfigManager.get_category_weights(session)
-
-            # 获取匹配算法参数
-            matching_params = SystemConfigManager.get_matching_parameters(session)
-
-            logger.info(f"从数据库加载配置成功 - 分类权重: {category_weights}")
-            logger.info(f"从数据库加载配置成功 - 匹配参数: {matching_params}")
-
-            return DualLibraryMatchingParameters(
-                category_weights=category_weights,
-                composition_weight=matching_params['composition_weight'],
-                proportion_weight=matching_params['proportion_weight'],
-                compound_threshold=matching_params['compound_threshold'],
-                min_similarity_threshold=matching_params['min_similarity_threshold'],
-                max_results=5  # 这个参数可以后续也加入配置
-            )
+    def get_parameters(self, session) -> DualLibraryMatchingParameters:
+        """
+        获取当前匹配参数快照
 
-        except Exception as e:
-            logger.warning(f"从数据库加载配置失败，使用默认配置: {e}")
-            return self._get_default_parameters()
+        匹配配置快照由SystemConfigManager在进程内缓存，版本号未变化时直接返回已构建的参数对象；
+        其他工作进程修改的配置最迟在library_check_interval秒后生效。
+        返回的参数不可变，调用方在整次匹配中使用同一份参数
+        """
+        snapshot = SystemConfigManager.get_matching_config_snapshot(session, self.library_check_interval)
+        version, parameters = self._parameters_cache
+        if snapshot.version and snapshot.version == version:
+            return parameters
+
+        matching_params = snapshot.matching_parameters
+        parameters = DualLibraryMatchingParameters(
+            category_weights=dict(snapshot.category_weights),
+            composition_weight=matching_params['composition_weight'],
+            proportion_weight=matching_params['proportion_weight'],
+            compound_threshold=matching_params['compound_threshold'],
+            min_similarity_threshold=matching_params['min_similarity_threshold'],
+            max_results=min(max(int(matching_params['max_results']), 1), MAX_RESULTS_LIMIT)
+        )
+        if snapshot.version:
+            self._parameters_cache = (snapshot.version, parameters)
+        return parameters
 
     def match_formula_against_library(
             self,
             source_formula_id: int,
             session,
             target_formulas: List[int] = None,
-            strict_mode: bool = False
+            strict_mode: bool = False,
+            retrieval_mode: Optional[str] = None,
+            parameters: Optional[DualLibraryMatchingParameters] = None
     ) -> List[DualLibraryMatchResult]:
         """
         将待匹配配方与配方库进行匹配
@@ -127,13 +300,47 @@ class DualLibraryMatchingEngine:
             source_formula_id: 待匹配配方ID (formulas_to_be_matched表)
             session: 数据库会话
             target_formulas: 目标配方ID列表，如果为None则匹配所有配方库配方
+            retrieval_mode: 候选召回模式（exact/lsh），None时使用配置文件中的模式
+            parameters: 本次匹配使用的参数快照，None时读取当前配置
             
         Returns:
             匹配结果列表，按相似度降序排列
         """
+        for event in self.iter_match_progress(
+                source_formula_id, session, target_formulas=target_formulas, strict_mode=strict_mode,
+                retrieval_mode=retrieval_mode, parameters=parameters
+        ):
+            if event['event'] == 'final':
+                return event['results']
+        return []
+
+    def iter_match_progress(
+            self,
+            source_formula_id: int,
+            session,
+            target_formulas: List[int] = None,
+            strict_mode: bool = False,
+            retrieval_mode: Optional[str] = None,
+            parameters: Optional[DualLibraryMatchingParameters] = None,
+            partition_size: Optional[int] = None
+    ) -> Iterator[Dict]:
+        """
+        渐进式匹配：按分区对配方库打分，每个分区完成后产出一次临时前N名，最后产出完整结果
+
+        各分区分别取前N名再合并（同分按配方库顺序），最终结果与一次性全库匹配完全一致。
+        仅精确召回的全库/严格模式匹配会分区；LSH召回与指定目标配方的匹配候选集较小，直接产出最终结果
+
+        Args:
+            partition_size: 每个分区的配方数量，None或<=0表示不分区
+
+        Yields:
+            {'event': 'progress', 'scored_count', 'total_count', 'results'}：临时前N名（轻量字段，来自内存索引）
+            {'event': 'final', 'results', 'cached'}：最终匹配结果列表（DualLibraryMatchResult）
+        """
         try:
-            # 从数据库加载最新配置
-            self.parameters = self._load_parameters_from_db(session)
+            # 本次匹配使用的参数快照（不写回引擎实例，并发匹配互不影响）
+            parameters = parameters or self.get_parameters(session)
+            retrieval_mode = retrieval_mode or self.retrieval_mode
 
             # 获取待匹配配方
             source_formula = session.query(FormulasToBeMatched).filter(
@@ -143,469 +350,1296 @@ class DualLibraryMatchingEngine:
             if not source_formula:
                 raise ValueError(f"待匹配配方 {source_formula_id} 不存在")
 
+            # 参考配方库常驻内存索引（首次使用或库版本戳变化时重新加载，须在组合缓存键之前获取）
+            library_index = self.get_library_index(session)
+            library_version = self._library_version
+
+            # 匹配结果缓存：同一配方版本、配方库版本与参数摘要下直接返回已计算的结果
+            cache_key = self._match_cache_key(
+                source_formula, library_version, parameters, strict_mode, retrieval_mode, target_formulas
+            )
+            cached_results = self.result_cache.get(cache_key)
+            if cached_results is not None:
+                yield {'event': 'final', 'results': cached_results, 'cached': True}
+                return
+
             # 获取待匹配配方结构
             source_structure = DualFormulaLibraryHandler.get_formula_structure(
                 source_formula_id, session, 'to_be_matched'
             )
 
-            # 获取目标配方列表
+            # 确定各索引段的候选行
+            segments = library_index.segments
             if target_formulas is None:
                 if strict_mode:
                     # 严格范围匹配：只匹配相同产品类型和客户的配方
                     logger.info(f"严格模式匹配：产品类型={source_formula.product_type}, 客户={source_formula.customer}")
-
-                    # 解析源配方的产品类型
-                    source_product_type = source_formula.product_type or ""
-                    source_customer = source_formula.customer or ""
-
-                    # 构建查询条件
-                    query = session.query(Formulas)
-
-                    # 产品类型过滤
-                    if source_product_type:
-                        # 如果是新格式（大类-细分类型），精确匹配
-                        # 如果是旧格式（只有大类），匹配所有相同大类的配方
-                        if '-' in source_product_type:
-                            # 精确匹配新格式
-                            query = query.filter(Formulas.product_type == source_product_type)
-                        else:
-                            # 匹配相同大类的所有配方（兼容新旧格式）
-                            query = query.filter(
-                                or_(
-                                    Formulas.product_type == source_product_type,  # 旧格式精确匹配
-                                    Formulas.product_type.like(f"{source_product_type}-%")  # 新格式大类匹配
-                                )
-                            )
-
-                    # 客户过滤
-                    if source_customer:
-                        query = query.filter(Formulas.customer == source_customer)
-                    else:
-                        # 如果源配方没有客户信息，只匹配同样没有客户信息的配方
-                        query = query.filter(or_(Formulas.customer == "", Formulas.customer.is_(None)))
-
-                    target_formulas_query = query.all()
-                    logger.info(f"严格模式过滤后找到 {len(target_formulas_query)} 个候选配方")
+                    scopes = [segment.strict_scope_rows(source_formula.product_type, source_formula.customer)
+                              for segment in segments]
+                    logger.info(f"严格模式过滤后找到 {sum(len(scope) for scope in scopes)} 个候选配方")
                 else:
                     # 常规模式：匹配所有配方
-                    target_formulas_query = session.query(Formulas).all()
-                    logger.info(f"常规模式匹配所有 {len(target_formulas_query)} 个配方")
-
-                target_formula_ids = [f.id for f in target_formulas_query]
+                    scopes = [None] * len(segments)
+                    logger.info(f"常规模式匹配所有 {library_index.live_count} 个配方")
             else:
-                target_formula_ids = target_formulas
+                scopes = [np.asarray([row for row in (segment.row_of(fid) for fid in target_formulas)
+                                      if row is not None], dtype=np.int64) for segment in segments]
+
+            category_identifiers, proportions = self.get_match_features(
+                [source_formula_id], session, 'to_be_matched'
+            )[source_formula_id]
+            # 各索引段词表不同，待匹配配方分别编码
+            sources = [segment.encode_source(category_identifiers, proportions, parameters.compound_threshold)
+                       for segment in segments]
+            if target_formulas is None and retrieval_mode == 'lsh':
+                # MinHash/LSH近似召回候选，精确算法重排
+                top_scored = []
+                for segment, source_features, scope in zip(segments, sources, scopes):
+                    top_scored = self._merge_top_scored(top_scored, segment, self._lsh_top_k_index_rows(
+                        parameters, segment, category_identifiers, source_features, scope, parameters.max_results
+                    ), parameters.max_results)
+            elif target_formulas is None:
+                # 倒排索引召回候选，按相似度上界剪枝取前N个结果；分区时逐个分区合并前N名
+                scope_rows = [segment.live_rows() if scope is None else scope
+                              for segment, scope in zip(segments, scopes)]
+                total_count = sum(len(rows) for rows in scope_rows)
+                partitioned = bool(partition_size and partition_size > 0 and total_count > partition_size)
+                partitions = []  # (索引段序号, 行号范围)
+                for number, (rows, scope) in enumerate(zip(scope_rows, scopes)):
+                    if partitioned:
+                        partitions.extend((number, rows[start:start + partition_size])
+                                          for start in range(0, len(rows), partition_size))
+                    else:
+                        partitions.append((number, scope))
 
-            # 执行批量匹配
-            match_results = []
-            for target_formula_id in target_formula_ids:
-                try:
-                    result = self._match_single_pair(
-                        source_formula, source_structure,
-                        target_formula_id, session
+                top_scored = []
+                scored_count = 0
+                for partition_number, (number, partition) in enumerate(partitions, start=1):
+                    partition_top = self._top_k_index_rows(
+                        parameters, segments[number], sources[number], partition, parameters.max_results
                     )
-
-                    if result and result.similarity_score >= self.parameters.min_similarity_threshold:
-                        match_results.append(result)
-
-                except Exception as e:
-                    logger.warning(f"匹配配方 {target_formula_id} 时出错: {e}")
-                    continue
-
-            # 按相似度排序并返回前N个结果
-            match_results.sort(key=lambda x: x.similarity_score, reverse=True)
-            return match_results[:self.parameters.max_results]
+                    top_scored = self._merge_top_scored(
+                        top_scored, segments[number], partition_top, parameters.max_results
+                    )
+                    if partitioned and partition_number < len(partitions):
+                        scored_count += len(partition)
+                        yield {
+                            'event': 'progress',
+                            'scored_count': scored_count,
+                            'total_count': total_count,
+                            'results': self._provisional_results(library_index, top_scored)
+                        }
+            else:
+                # 指定目标配方：在各索引段上批量计算相似度
+                scored = {}
+                for segment, source_features, rows in zip(segments, sources, scopes):
+                    batch_scores = self._score_index_rows(parameters, segment, source_features, rows)
+                    for i in range(len(rows)):
+                        row, scores = batch_scores.scores_at(i)
+                        scored[int(segment.formula_ids[row])] = scores
+
+                # 过滤并按相似度降序取前N个结果（稳定排序，同分保持目标列表顺序）
+                passed = [(fid, scored[fid]) for fid in target_formulas
+                          if fid in scored and scored[fid][0] >= parameters.min_similarity_threshold]
+                top_scored = sorted(passed, key=lambda entry: -entry[1][0])[:parameters.max_results]
+
+            results = self._materialize_index_results(
+                parameters, source_formula, source_structure, top_scored, session
+            )
+            # 匹配期间索引被替换时结果可能来自旧索引，不写入缓存
+            if library_index is self._library_index and library_version == self._library_version:
+                self.result_cache.put(cache_key, results)
+            yield {'event': 'final', 'results': results, 'cached': False}
 
         except Exception as e:
             logger.error(f"配方匹配失败: {e}")
             raise e
 
-    def _match_single_pair(
+    @staticmethod
+    def _match_cache_key(source_formula: FormulasToBeMatched, library_version: Optional[str],
+                         parameters: DualLibraryMatchingParameters, strict_mode: bool, retrieval_mode: str,
+                         target_formulas: Optional[List[int]] = None) -> tuple:
+        """配方库匹配结果的缓存键（待匹配配方版本 + 参考配方库版本号摘要 + 参数摘要 + 匹配选项）"""
+        return (
+            'match', source_formula.id, source_formula.updated_at, library_version,
+            parameters.fingerprint, strict_mode, retrieval_mode,
+            tuple(target_formulas) if target_formulas is not None else None
+        )
+
+    @staticmethod
+    def _merge_top_scored(
+            top_scored: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]],
+            segment: ReferenceLibraryIndex,
+            segment_top: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]],
+            k: int
+    ) -> List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]:
+        """
+        将某一索引段的 (行号, 打分结果) 前K名并入已有的 (配方ID, 打分结果) 前K名
+
+        同分按配方ID升序（各段行号均按配方ID升序），合并结果与在整库索引上取前K名一致
+        """
+        merged = top_scored + [(int(segment.formula_ids[row]), scores) for row, scores in segment_top]
+        return sorted(merged, key=lambda entry: (-entry[1][0], entry[0]))[:k]
+
+    @staticmethod
+    def _provisional_results(
+            library_index: SegmentedLibraryIndex,
+            top_scored: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]
+    ) -> List[Dict]:
+        """临时前N名的展示字段（直接取自内存索引，不查询数据库）"""
+        results = []
+        for formula_id, (total_similarity, composition_similarity, proportion_similarity, _) in top_scored:
+            segment, row = library_index.locate(formula_id)
+            results.append({
+                "target_formula_id": formula_id,
+                "target_formula_name": segment.formula_names[row],
+                "similarity_score": round(total_similarity, 10),
+                "composition_similarity": round(composition_similarity, 10),
+                "proportion_similarity": round(proportion_similarity, 10)
+            })
+        return results
+
+    # ==================== 游标分页匹配 ====================
+
+    def match_formula_page(
             self,
-            source_formula: FormulasToBeMatched,
-            source_structure: Dict,
-            target_formula_id: int,
-            session
-    ) -> Optional[DualLibraryMatchResult]:
-        """匹配单个配方对"""
-        try:
-            # 获取目标配方
-            target_formula = session.query(Formulas).filter(
-                Formulas.id == target_formula_id
-            ).first()
+            source_formula_id: int,
+            session,
+            page_size: int,
+            strict_mode: bool = False,
+            retrieval_mode: Optional[str] = None,
+            parameters: Optional[DualLibraryMatchingParameters] = None
+    ) -> MatchPage:
+        """
+        分页匹配的第一页：一次取前 page_size × CURSOR_PREFETCH_PAGES 名并暂存在服务端，返回第一页与下一页游标
 
-            if not target_formula:
-                return None
+        排名与一次性匹配的排序规则相同（第一页与 max_results=page_size 的匹配结果一致）；
+        后续页由 next_match_page 按游标切片暂存的排名，不重新打分
+        """
+        parameters = parameters or self.get_parameters(session)
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+        library_index = self.get_library_index(session)
+        depth = page_size * CURSOR_PREFETCH_PAGES
+        ranking = self._rank_library_rows(
+            parameters, library_index, source_formula_id, session, strict_mode, retrieval_mode, depth
+        )
+        match_ranking = MatchRanking(
+            source_formula_id=source_formula_id,
+            library_index=library_index,
+            parameters=parameters,
+            strict_mode=strict_mode,
+            retrieval_mode=retrieval_mode,
+            ranking=ranking,
+            complete=len(ranking) < depth
+        )
+        ranking_id = uuid.uuid4().hex
+        self.ranking_cache.put(ranking_id, match_ranking)
+        logger.info(f"分页匹配配方 {source_formula_id}: 暂存前 {len(ranking)} 名 (排名 {ranking_id})")
+        return self._match_page(match_ranking, ranking_id, 0, page_size, session)
 
-            # 获取目标配方结构
-            target_structure = DualFormulaLibraryHandler.get_formula_structure(
-                target_formula_id, session, 'reference'
-            )
+    def next_match_page(self, cursor: str, session, page_size: Optional[int] = None) -> MatchPage:
+        """
+        按游标读取暂存排名的下一页（page_size为None时与第一页的结果数量相同）
 
-            # 计算成分组成相似度（第一段）
-            composition_similarity = self._calculate_composition_similarity(
-                source_structure, target_structure, session
+        Raises:
+            ValueError: 游标格式错误，或对应的排名已过期（调用方应重新发起分页匹配）
+        """
+        ranking_id, _, offset = cursor.partition(':')
+        if not offset.isdigit():
+            raise ValueError(f"无效的分页游标: {cursor}")
+        match_ranking = self.ranking_cache.get(ranking_id)
+        if match_ranking is None:
+            raise ValueError("分页游标已过期，请重新匹配")
+        return self._match_page(match_ranking, ranking_id, int(offset),
+                                page_size or match_ranking.parameters.max_results, session)
+
+    def _match_page(self, match_ranking: MatchRanking, ranking_id: str, offset: int, page_size: int,
+                    session) -> MatchPage:
+        """切片暂存排名并补全该页的展示信息；翻页超出暂存深度且排名未穷尽时，按原索引与参数取更深的排名"""
+        if offset + page_size > len(match_ranking.ranking) and not match_ranking.complete:
+            depth = max(2 * len(match_ranking.ranking), offset + page_size * CURSOR_PREFETCH_PAGES)
+            ranking = self._rank_library_rows(
+                match_ranking.parameters, match_ranking.library_index, match_ranking.source_formula_id,
+                session, match_ranking.strict_mode, match_ranking.retrieval_mode, depth
             )
+            # 排序规则确定，更深的排名前缀与原排名相同，已发出的游标继续有效
+            match_ranking.ranking, match_ranking.complete = ranking, len(ranking) < depth
+            logger.info(f"分页排名 {ranking_id} 加深至前 {len(ranking)} 名")
+
+        source_formula = session.query(FormulasToBeMatched).filter(
+            FormulasToBeMatched.id == match_ranking.source_formula_id
+        ).first()
+        if not source_formula:
+            raise ValueError(f"待匹配配方 {match_ranking.source_formula_id} 不存在")
+        source_structure = DualFormulaLibraryHandler.get_formula_structure(
+            source_formula.id, session, 'to_be_matched'
+        )
 
-            # 计算成分比例相似度（第二段）
-            proportion_similarity = self._calculate_proportion_similarity(
-                source_structure, target_structure
-            )
+        end = offset + page_size
+        results = self._materialize_index_results(
+            match_ranking.parameters, source_formula, source_structure, match_ranking.ranking[offset:end], session
+        )
+        return MatchPage(
+            source_formula_id=source_formula.id,
+            results=results,
+            offset=offset,
+            next_cursor=f"{ranking_id}:{end}" if end < len(match_ranking.ranking) or not match_ranking.complete
+            else None,
+            parameters=match_ranking.parameters,
+            retrieval_mode=match_ranking.retrieval_mode
+        )
 
-            # 计算分类相似度
-            category_similarities = self._calculate_category_similarities(
-                source_structure, target_structure, session
-            )
+    def _rank_library_rows(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: SegmentedLibraryIndex,
+            source_formula_id: int,
+            session,
+            strict_mode: bool,
+            retrieval_mode: str,
+            depth: int
+    ) -> List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]:
+        """在指定内存索引上取待匹配配方的前depth名（召回与排序规则同 iter_match_progress）"""
+        source_formula = session.query(FormulasToBeMatched).filter(
+            FormulasToBeMatched.id == source_formula_id
+        ).first()
+        if not source_formula:
+            raise ValueError(f"待匹配配方 {source_formula_id} 不存在")
+
+        category_identifiers, proportions = self.get_match_features(
+            [source_formula_id], session, 'to_be_matched'
+        )[source_formula_id]
+        ranking = []
+        for segment in library_index.segments:
+            scope = segment.strict_scope_rows(source_formula.product_type, source_formula.customer) \
+                if strict_mode else None
+            source_features = segment.encode_source(category_identifiers, proportions, parameters.compound_threshold)
+            if retrieval_mode == 'lsh':
+                segment_top = self._lsh_top_k_index_rows(
+                    parameters, segment, category_identifiers, source_features, scope, depth
+                )
+            else:
+                segment_top = self._top_k_index_rows(parameters, segment, source_features, scope, depth)
+            ranking = self._merge_top_scored(ranking, segment, segment_top, depth)
+        return ranking
 
-            # 计算总相似度
-            total_similarity = (
-                    self.parameters.composition_weight * composition_similarity +
-                    self.parameters.proportion_weight * proportion_similarity
-            )
+    # ==================== 参考配方库内存索引 ====================
 
-            # 精度修正：避免浮点数误差
-            if abs(total_similarity - 1.0) < 1e-10:
-                total_similarity = 1.0
-            elif abs(total_similarity) < 1e-10:
-                total_similarity = 0.0
+    def get_library_index(self, session) -> SegmentedLibraryIndex:
+        """
+        获取参考配方库内存索引（首次使用、失效或数据库中的配方库版本戳变化后重新加载）
 
-            # 获取共同成分信息
-            common_ingredients = self._get_common_ingredients(
-                source_structure, target_structure
-            )
+        版本戳按 library_check_interval 节流比较，其他工作进程写入的变更在此发现
+        """
+        index = self._library_index
+        if index is not None and not self._library_index_stale and not self._library_changed(session):
+            return index
+        return self.build_library_index(session)
 
-            # 构建匹配详情
-            source_ingredients_list = self._extract_ingredients_list(source_structure)
-            target_ingredients_list = self._extract_ingredients_list(target_structure)
-
-            match_details = {
-                "source_ingredients_count": len(source_ingredients_list),
-                "target_ingredients_count": len(target_ingredients_list),
-                "composition_method": "weighted_jaccard",
-                "proportion_method": "weighted_cosine",
-                "algorithm_version": "dual_library_v1.0",
-                "parameters": {
-                    "composition_weight": self.parameters.composition_weight,
-                    "proportion_weight": self.parameters.proportion_weight,
-                    "category_weights": self.parameters.category_weights
-                }
-            }
+    def _library_changed(self, session) -> bool:
+        """数据库中的参考配方库版本戳是否与当前索引不一致"""
+        self.get_library_version(session)
+        return self._observed_library_stamp != self._library_stamp
 
-            # 创建匹配结果
-            result = DualLibraryMatchResult(
-                source_formula_id=source_formula.id,
-                source_formula_name=source_formula.formula_name,
-                target_formula_id=target_formula.id,
-                target_formula_name=target_formula.formula_name,
-                similarity_score=total_similarity,
-                composition_similarity=composition_similarity,
-                proportion_similarity=proportion_similarity,
-                category_similarities=category_similarities,
-                common_ingredients=common_ingredients,
-                common_ingredients_count=len(common_ingredients),
-                total_ingredients_count=len(set([ing['chinese_name'] for ing in source_ingredients_list])),
-                match_details=match_details
-            )
+    def get_library_version(self, session) -> str:
+        """
+        数据库中参考配方库版本戳的摘要（不依赖内存索引，用作单对匹配结果的缓存键）
 
-            return result
+        距上次读取不足 library_check_interval 秒时沿用上次读取的版本戳，其他工作进程的变更最迟在该间隔后可见
+        """
+        now = time.monotonic()
+        if self._observed_library_stamp is None or now - self._library_checked_at >= self.library_check_interval:
+            self._observe_library_stamp(DualFormulaLibraryHandler.get_library_stamp(session), now)
+        return self._observed_library_version
+
+    def _observe_library_stamp(self, library_stamp: Dict, checked_at: Optional[float] = None):
+        """记录最近一次从数据库读取的配方库版本戳"""
+        self._observed_library_version = stamp_digest(library_stamp)
+        self._observed_library_stamp = library_stamp
+        self._library_checked_at = time.monotonic() if checked_at is None else checked_at
+
+    def build_library_index(self, session) -> SegmentedLibraryIndex:
+        """
+        构建或重新加载参考配方库内存索引
 
-        except Exception as e:
-            logger.error(f"单个配方匹配失败: {e}")
-            return None
+        配置了快照目录时，优先加载与当前库版本戳一致的快照：基础段快照以只读内存映射加载，
+        增量日志在基础段快照上重放墓碑与增量配方（基础段未变时复用当前索引的基础段）；
+        快照不存在或已过期时从数据库加载整库构建，并写入新快照供其他工作进程和下次启动使用
+        """
+        with self._library_index_lock:
+            library_stamp = DualFormulaLibraryHandler.get_library_stamp(session)
+            self._observe_library_stamp(library_stamp)
+            # 加锁期间可能已由其他调用完成重建
+            if self._library_index is not None and not self._library_index_stale and \
+                    library_stamp == self._library_stamp:
+                return self._library_index
+
+            # 标记需在加载前清除：加载期间发生的变更会再次置为失效
+            self._library_index_stale = False
+
+            if self.index_snapshot_dir:
+                try:
+                    index = SegmentedLibraryIndex.load_snapshot(
+                        self.index_snapshot_dir, library_stamp, current=self._library_index
+                    )
+                    if index is not None:
+                        self._replace_library_index(index, library_stamp)
+                        return index
+                except Exception as e:
+                    logger.warning(f"加载匹配索引快照失败，从数据库重建: {e}")
+
+            formulas = session.query(
+                Formulas.id, Formulas.formula_name, Formulas.product_type, Formulas.customer
+            ).all()
+            features = self.get_match_features([f.id for f in formulas], session, 'reference')
+            base = ReferenceLibraryIndex.build([tuple(f) for f in formulas], features)
+            logger.info(f"参考配方库索引构建完成: {base.size} 个配方, "
+                        f"{len(base.identifiers)} 个匹配标识符, {len(base.ingredient_names)} 个成分名称")
+            index = SegmentedLibraryIndex(base)
+            self._replace_library_index(index, library_stamp)
+            self._save_library_snapshot(index, library_stamp)
+            return index
+
+    def _replace_library_index(self, index: SegmentedLibraryIndex, library_stamp: Optional[Dict]):
+        """
+        替换当前内存索引并记录其对应的配方库版本戳（须持有索引锁）
 
-    def _calculate_composition_similarity(
-            self,
-            source_structure: Dict,
-            target_structure: Dict,
-            session
-    ) -> float:
-        """计算成分组成相似度（仅使用加权Jaccard）"""
+        匹配结果缓存以版本戳摘要为键，旧条目不会再命中，这里一并清空以释放内存
+        """
+        self._library_index = index
+        self._library_stamp = library_stamp
+        self._library_version = stamp_digest(library_stamp)
+        self.result_cache.clear()
+
+    def _save_library_snapshot(self, index: SegmentedLibraryIndex, library_stamp: Dict):
+        """写入索引快照或增量日志，供其他工作进程按版本戳加载（未配置快照目录时不写入）"""
+        if not self.index_snapshot_dir:
+            return
         try:
-            # 根据要求，组成相似度只使用加权Jaccard
-            weighted_jaccard = self._calculate_weighted_jaccard_by_category(
-                source_structure, target_structure, session
-            )
+            index.save_snapshot(self.index_snapshot_dir, library_stamp)
+        except Exception as e:
+            logger.warning(f"写入匹配索引快照失败，其他工作进程将从数据库重建: {e}")
 
-            logger.info(f"🔍 组成相似度计算结果:")
-            logger.info(f"  加权Jaccard: {weighted_jaccard:.4f}")
-            logger.info(f"  最终组成相似度: {weighted_jaccard:.4f} (仅使用加权Jaccard)")
+    def invalidate_library_index(self):
+        """参考配方库发生变更后标记索引失效，下次匹配时重建"""
+        self._library_index_stale = True
+        self._reset_library_check()
 
-            return weighted_jaccard
+    def _reset_library_check(self):
+        """本进程写入配方库后，下次获取版本戳时立即读取数据库而不沿用节流期内的旧版本戳"""
+        self._observed_library_stamp = None
+        self.result_cache.clear()
 
-        except Exception as e:
-            logger.error(f"计算成分组成相似度失败: {e}")
-            return 0.0
+    def apply_library_changes(self, session, upserted_ids: Sequence[int] = (), deleted_ids: Sequence[int] = ()):
+        """
+        参考配方库变更后增量更新内存索引（变更已提交到数据库后调用）
 
-    def _calculate_proportion_similarity(
-            self,
-            source_structure: Dict,
-            target_structure: Dict
-    ) -> float:
-        """计算成分比例相似度（使用并集进行加权余弦相似度计算）"""
-        try:
-            # 使用提取成分列表方法，保持复配整体性
-            source_ingredients_list = self._extract_ingredients_list(source_structure)
-            target_ingredients_list = self._extract_ingredients_list(target_structure)
-
-            # 构建成分比例字典
-            source_proportions = {}
-            target_proportions = {}
-
-            # 处理源配方比例（复配作为整体）
-            for ing in source_ingredients_list:
-                name = ing['chinese_name']
-                content = ing.get('content', 0)
-                source_proportions[name] = content
-
-            # 处理目标配方比例（复配作为整体）
-            for ing in target_ingredients_list:
-                name = ing['chinese_name']
-                content = ing.get('content', 0)
-                target_proportions[name] = content
-
-            # 构建并集的所有成分列表
-            all_ingredients = sorted(list(set(source_proportions.keys()) | set(target_proportions.keys())))
-
-            if len(all_ingredients) == 0:
-                return 0.0
-
-            # 构建比例向量（基于并集）
-            source_vector = []
-            target_vector = []
-
-            for ingredient in all_ingredients:
-                source_vector.append(source_proportions.get(ingredient, 0))
-                target_vector.append(target_proportions.get(ingredient, 0))
-
-            # 计算加权余弦相似度
-            if np.sum(source_vector) == 0 or np.sum(target_vector) == 0:
-                return 0.0
-
-            source_array = np.array(source_vector).reshape(1, -1)
-            target_array = np.array(target_vector).reshape(1, -1)
-
-            cosine_sim = cosine_similarity(source_array, target_array)[0, 0]
-
-            # 记录余弦相似度计算结果
-            logger.info(f"📊 比例相似度计算结果:")
-            logger.info(f"  成分并集数量: {len(all_ingredients)}")
-            logger.info(f"  源配方向量: {source_vector[:5]}...({len(source_vector)} 个成分)" if len(source_vector) > 5 else f"  源配方向量: {source_vector}")
-            logger.info(f"  目标配方向量: {target_vector[:5]}...({len(target_vector)} 个成分)" if len(target_vector) > 5 else f"  目标配方向量: {target_vector}")
-            logger.info(f"  余弦相似度原始值: {cosine_sim:.6f}")
-
-            # 精度修正：避免浮点数误差
-            if not np.isnan(cosine_sim):
-                # 如果非常接近1.0，则认为是完全相同
-                if abs(cosine_sim - 1.0) < 1e-10:
-                    cosine_sim = 1.0
-                    logger.info(f"  余弦相似度修正为: {cosine_sim:.6f} (接近1.0)")
-                # 如果非常接近0.0，则认为是完全不同
-                elif abs(cosine_sim) < 1e-10:
-                    cosine_sim = 0.0
-                    logger.info(f"  余弦相似度修正为: {cosine_sim:.6f} (接近0.0)")
-                else:
-                    logger.info(f"  余弦相似度最终值: {cosine_sim:.6f}")
-                return float(cosine_sim)
-            else:
-                logger.warning(f"  余弦相似度计算结果为NaN，返回0.0")
-                return 0.0
+        只加载新增/编辑配方的特征并重新编码增量段，基础段中删除或被替换的配方标记为墓碑，代价与整库规模无关；
+        增量段或墓碑超过阈值时压缩为新的基础段。更新后的索引原子替换当前索引，下一次匹配立即可见，
+        并写入增量日志（压缩后写入基础段快照），其他工作进程发现版本戳变化后据此加载而不必全量重建。
+
+        索引尚未构建或已失效时不做处理；数据库中的库版本号不等于当前索引版本号加上本会话递增的次数
+        （其他工作进程同时写入，或本会话有写入被回滚）或增量更新失败时，退回为标记失效、下次匹配重新加载
+
+        Args:
+            upserted_ids: 新增或编辑的参考配方ID
+            deleted_ids: 删除的参考配方ID
+        """
+        with self._library_index_lock:
+            own_changes = SystemConfigManager.pop_data_version_bumps(session, LIBRARY_VERSION_KEY)
+            index = self._library_index
+            if index is None or self._library_index_stale:
+                # 索引将在下次匹配时全量构建，但已缓存的单对匹配结果同样需要失效
+                self._reset_library_check()
+                return
 
+            try:
+                # 变更已提交，读取的版本戳包含本次变更
+                library_stamp = DualFormulaLibraryHandler.get_library_stamp(session)
+                expected_stamp = dict(self._library_stamp, version=self._library_stamp['version'] + own_changes)
+                if library_stamp != expected_stamp:
+                    raise ValueError(f"库版本号 {library_stamp['version']} 与预期 {expected_stamp['version']} 不一致，"
+                                     f"期间有其他写入")
+                upserts = []
+                removals = list(deleted_ids)
+                if upserted_ids:
+                    formulas = session.query(
+                        Formulas.id, Formulas.formula_name, Formulas.product_type, Formulas.customer
+                    ).filter(Formulas.id.in_(list(upserted_ids))).all()
+                    features = self.get_match_features([f.id for f in formulas], session, 'reference')
+                    upserts = [(tuple(f), features.get(f.id)) for f in formulas]
+                    # 查询不到的配方（已被并发删除）按删除处理
+                    removals.extend(set(upserted_ids) - {f.id for f in formulas})
+                index = index.apply_changes(upserts, removals)
+                if index.needs_compaction:
+                    index = index.compact()
+            except Exception as e:
+                logger.warning(f"匹配索引增量更新失败，下次匹配时重新加载: {e}")
+                self._library_index_stale = True
+                self._reset_library_check()
+                return
+
+            self._observe_library_stamp(library_stamp)
+            self._replace_library_index(index, library_stamp)
+            self._save_library_snapshot(index, library_stamp)
+            logger.info(f"匹配索引增量更新: 新增/替换 {len(upserted_ids)} 个, 删除 {len(deleted_ids)} 个, "
+                        f"当前 {index.live_count} 个配方")
+
+    def get_lsh_index(self, library_index: ReferenceLibraryIndex,
+                      parameters: Optional[LSHParameters] = None) -> MinHashLSHIndex:
+        """
+        获取索引段对应的MinHash/LSH索引（索引段变化后随之重建，仅新增墓碑时沿用已有签名）
+
+        只缓存当前内存索引各段的LSH索引；已被替换的索引段（分页排名暂存的旧索引）临时构建，不替换缓存
+        """
+        parameters = parameters or self.lsh_parameters
+        if parameters != self.lsh_parameters:
+            # 非当前配置的参数（召回率评估）临时构建，不缓存
+            return MinHashLSHIndex(library_index, parameters)
+
+        with self._lsh_index_lock:
+            for lsh_index in self._lsh_indexes:
+                if lsh_index.library_index is library_index:
+                    return lsh_index
+            # 仅新增墓碑时各行不变，沿用已有签名
+            reusable = next((lsh_index for lsh_index in self._lsh_indexes
+                             if lsh_index.library_index.formula_ids is library_index.formula_ids), None)
+            lsh_index = reusable.rebind(library_index) if reusable is not None \
+                else MinHashLSHIndex(library_index, parameters)
+
+            current = self._library_index.segments if self._library_index is not None else []
+            if any(segment is library_index for segment in current):
+                self._lsh_indexes = [cached for cached in self._lsh_indexes
+                                     if any(segment is cached.library_index for segment in current)] + [lsh_index]
+            return lsh_index
+
+    def extract_match_features(self, structure: Dict) -> Tuple[Dict[str, List[str]], Dict[str, float]]:
+        """
+        提取配方匹配特征
+
+        Returns:
+            (分类 -> 去重后的匹配标识符列表, 成分名称 -> 含量)，复配作为整体
+        """
+        ingredients_list = self._extract_ingredients_list(structure)
+
+        by_category = self._group_ingredients_by_category(ingredients_list, None)
+        category_identifiers = {
+            category: list(dict.fromkeys(identifiers)) for category, identifiers in by_category.items()
+        }
+
+        proportions = {}
+        for ing in ingredients_list:
+            proportions[ing['chinese_name']] = ing.get('content', 0)
+
+        return category_identifiers, proportions
+
+    def get_match_features(self, formula_ids: Sequence[int], session, table_type: str) -> Dict[int, MatchFeatures]:
+        """
+        读取配方匹配特征：优先使用已持久化的特征，缺失或规则版本过期的配方即时计算并写回
+
+        Args:
+            formula_ids: 配方ID列表
+            table_type: 'reference' 或 'to_be_matched'
+        """
+        formula_ids = list(dict.fromkeys(formula_ids))
+        features = DualFormulaLibraryHandler.get_match_features(
+            formula_ids, session, table_type, MATCH_FEATURE_VERSION
+        )
+        missing_ids = [formula_id for formula_id in formula_ids if formula_id not in features]
+        if missing_ids:
+            features.update(self.refresh_match_features(session, missing_ids, table_type))
+        return features
+
+    def refresh_match_features(self, session, formula_ids: Sequence[int], table_type: str) -> Dict[int, MatchFeatures]:
+        """
+        由配方结构重新计算匹配特征并持久化（上传、编辑配方后调用）
+
+        写入失败时只记录警告，返回的特征仍可用于本次匹配
+        """
+        structures = DualFormulaLibraryHandler.get_formula_structures(list(formula_ids), session, table_type)
+        features = {formula_id: self.extract_match_features(structure) for formula_id, structure in structures.items()}
+        try:
+            DualFormulaLibraryHandler.save_match_features(session, table_type, features, MATCH_FEATURE_VERSION)
+            session.commit()
         except Exception as e:
-            logger.error(f"计算成分比例相似度失败: {e}")
-            return 0.0
+            session.rollback()
+            logger.warning(f"保存配方匹配特征失败: {e}")
+        return features
 
-    def _calculate_weighted_jaccard_by_category(
+    def backfill_match_features(self, session, table_type: str, batch_size: int = 500) -> int:
+        """
+        为尚无当前版本匹配特征的配方批量计算并持久化特征
+
+        Returns:
+            补齐的配方数量
+        """
+        formula_model = Formulas if table_type == 'reference' else FormulasToBeMatched
+        formula_ids = [row[0] for row in session.query(formula_model.id).order_by(formula_model.id).all()]
+        stored_ids = {row[0] for row in session.query(FormulaMatchFeatures.formula_id).filter(
+            FormulaMatchFeatures.table_type == table_type,
+            FormulaMatchFeatures.feature_version == MATCH_FEATURE_VERSION
+        ).all()}
+
+        missing_ids = [formula_id for formula_id in formula_ids if formula_id not in stored_ids]
+        for i in range(0, len(missing_ids), batch_size):
+            self.refresh_match_features(session, missing_ids[i:i + batch_size], table_type)
+
+        if missing_ids:
+            logger.info(f"已补齐 {len(missing_ids)} 个配方的匹配特征 ({table_type})")
+        return len(missing_ids)
+
+    def _score_index_rows(
             self,
-            source_structure: Dict,
-            target_structure: Dict,
-            session
-    ) -> float:
-        """按分类计算加权Jaccard相似度"""
-        try:
-            logger.info(f"🔍 开始计算加权Jaccard相似度...")
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            source: SourceFeatures,
+            rows: Optional[np.ndarray] = None
+    ) -> 'IndexBatchScores':
+        """
+        在内存索引上一次性计算待匹配配方与多个参考配方的相似度（与_match_single_pair算法一致）
 
-            # 按分类分组成分 - 展开成分列表
-            source_ingredients_list = self._extract_ingredients_list(source_structure)
-            target_ingredients_list = self._extract_ingredients_list(target_structure)
+        各分类交集数量与比例点积均由稀疏矩阵-向量乘法得到，其余为逐元素的数组运算
 
-            logger.info(f"  源配方成分总数: {len(source_ingredients_list)}")
-            logger.info(f"  目标配方成分总数: {len(target_ingredients_list)}")
+        Args:
+            rows: 候选行号，None表示整个配方库
+        """
+        target_counts = library_index.category_counts if rows is None else library_index.category_counts[rows]
+        intersections = library_index.category_intersections(source, rows)
+
+        # 分类Jaccard，只对实际存在成分的分类加权平均
+        source_counts = source.category_counts.astype(np.float64)
+        sizes = source_counts[np.newaxis, :] + target_counts
+        active = sizes > 0
+        unions = sizes - intersections
+        with np.errstate(divide='ignore', invalid='ignore'):
+            category_similarities = np.where(unions > 0, intersections / unions, 0.0)
+
+        composition = self._weighted_composition(parameters, category_similarities, active)
+
+        # 比例余弦相似度
+        target_sums = library_index.proportion_sums if rows is None else library_index.proportion_sums[rows]
+        target_norms = library_index.proportion_norms if rows is None else library_index.proportion_norms[rows]
+        proportion = np.zeros(len(target_norms), dtype=np.float64)
+        if source.proportion_sum != 0 and source.proportion_norm > 0:
+            valid = (target_sums != 0) & (target_norms > 0)
+            dots = library_index.proportion_dots(source, rows)
+            proportion[valid] = dots[valid] / (source.proportion_norm * target_norms[valid])
+            proportion = self._snap_similarities(proportion)
+
+        total = self._snap_similarities(
+            parameters.composition_weight * composition +
+            parameters.proportion_weight * proportion
+        )
 
-            source_by_category = self._group_ingredients_by_category(
-                source_ingredients_list, session
-            )
-            target_by_category = self._group_ingredients_by_category(
-                target_ingredients_list, session
-            )
+        row_numbers = np.arange(library_index.size) if rows is None else np.asarray(rows)
+        return IndexBatchScores(
+            rows=row_numbers,
+            total=total,
+            composition=composition,
+            proportion=proportion,
+            category_similarities=category_similarities,
+            active_categories=active
+        )
 
-            logger.info(f"  源配方分类: {list(source_by_category.keys())}")
-            logger.info(f"  目标配方分类: {list(target_by_category.keys())}")
+    @staticmethod
+    def _weighted_composition(parameters: DualLibraryMatchingParameters, category_similarities: np.ndarray,
+                              active: np.ndarray) -> np.ndarray:
+        """按分类权重对实际存在成分的分类相似度加权平均"""
+        default_weight = parameters.category_weights.get("其他", 0.15)
+        weights = np.asarray([parameters.category_weights.get(category, default_weight)
+                              for category in STANDARD_CATEGORIES], dtype=np.float64)
+        weighted_similarity = (category_similarities * weights * active).sum(axis=-1)
+        total_weight = (weights * active).sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total_weight > 0, weighted_similarity / total_weight, 0.0)
+
+    def _score_upper_bounds(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            source: SourceFeatures,
+            rows: np.ndarray
+    ) -> np.ndarray:
+        """
+        候选配方总相似度上界（只依赖各分类标识符数量，无需计算交集）
 
-            # 详细显示各分类的成分（显示数量，标识符列表在debug模式下显示）
-            for category, ingredients in source_by_category.items():
-                logger.info(f"    源配方-{category}: {len(ingredients)}个成分")
-                logger.debug(f"      标识符列表: {ingredients}")
-            for category, ingredients in target_by_category.items():
-                logger.info(f"    目标配方-{category}: {len(ingredients)}个成分")
-                logger.debug(f"      标识符列表: {ingredients}")
+        分类交集不超过 m = min(待匹配配方在索引词表内可命中的标识符列数, 待匹配配方标识符数, 参考配方标识符数)，
+        Jaccard上界为 m / (s + t - m)；比例余弦相似度上界为1（任一方比例向量无效时为0）
+        """
+        category_count = len(STANDARD_CATEGORIES)
+        target_counts = library_index.category_counts[rows].astype(np.float64)
+        source_counts = source.category_counts.astype(np.float64)
+        vocabulary_counts = np.bincount(source.member_columns % category_count, minlength=category_count)
+
+        max_intersections = np.minimum(np.minimum(vocabulary_counts, source_counts)[np.newaxis, :], target_counts)
+        sizes = source_counts[np.newaxis, :] + target_counts
+        unions = sizes - max_intersections
+        with np.errstate(divide='ignore', invalid='ignore'):
+            jaccard_bounds = np.where(unions > 0, max_intersections / unions, 0.0)
+        composition_bounds = self._weighted_composition(parameters, jaccard_bounds, sizes > 0)
+
+        proportion_bounds = np.zeros(len(rows), dtype=np.float64)
+        if source.proportion_sum != 0 and source.proportion_norm > 0:
+            valid = (library_index.proportion_sums[rows] != 0) & (library_index.proportion_norms[rows] > 0)
+            proportion_bounds[valid] = 1.0
+
+        return (parameters.composition_weight * composition_bounds +
+                parameters.proportion_weight * proportion_bounds)
+
+    def _top_k_index_rows(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            source: SourceFeatures,
+            scope: Optional[np.ndarray],
+            k: int
+    ) -> List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]:
+        """
+        倒排索引召回 + 上界剪枝的Top-K检索，结果与全库打分后稳定排序取前K个完全一致
 
-            # 计算各分类的Jaccard相似度
-            category_similarities = {}
-            all_categories = set(source_by_category.keys()) | set(target_by_category.keys())
+        1. 倒排表召回与待匹配配方至少共享一个标识符或成分名称的候选，其余配方相似度必为0
+        2. 候选按相似度上界降序分批精确打分，最小堆维护当前前K名，
+           剩余候选的上界低于第K名时提前结束
+        3. 正分结果不足K个且阈值允许时，按配方库顺序补入相似度为0的配方
 
-            logger.info(f"  参与计算的分类: {sorted(all_categories)}")
+        Args:
+            scope: 限定的行号范围（升序，严格模式），None表示整个配方库
+        """
+        if k <= 0:
+            return []
+        threshold = parameters.min_similarity_threshold
+        tolerance = self.UPPER_BOUND_TOLERANCE
+
+        candidates = library_index.candidate_rows(source, scope)
+        upper_bounds = self._score_upper_bounds(parameters, library_index, source, candidates)
+        reachable = upper_bounds + tolerance >= threshold
+        candidates, upper_bounds = candidates[reachable], upper_bounds[reachable]
+        # 上界降序，同上界按配方库顺序
+        order = np.lexsort((candidates, -upper_bounds))
+
+        # 堆元素 (总相似度, -行号, 打分结果)，堆顶为当前第K名（同分时行号靠后者排名更低）
+        heap = []
+        scored_count = 0
+        for start in range(0, len(order), self.TOP_K_BLOCK_SIZE):
+            block = order[start:start + self.TOP_K_BLOCK_SIZE]
+            if len(heap) == k and upper_bounds[block[0]] + tolerance < heap[0][0]:
+                break
+
+            block_rows = candidates[block]
+            batch_scores = self._score_index_rows(parameters, library_index, source, block_rows)
+            scored_count += len(block_rows)
+            passed = np.flatnonzero(batch_scores.total >= threshold)
+            for i in passed[np.lexsort((block_rows[passed], -batch_scores.total[passed]))]:
+                key = (float(batch_scores.total[i]), -int(block_rows[i]))
+                if len(heap) < k:
+                    heapq.heappush(heap, key + (batch_scores.scores_at(i),))
+                elif key > heap[0][:2]:
+                    heapq.heapreplace(heap, key + (batch_scores.scores_at(i),))
+                else:
+                    break
 
-            for category in all_categories:
-                source_set = set(source_by_category.get(category, []))
-                target_set = set(target_by_category.get(category, []))
+        top_scored = [entry[2] for entry in sorted(heap, key=lambda entry: (-entry[0], -entry[1]))
+                      if entry[0] > 0]
+        logger.info(f"倒排索引召回 {len(candidates)} 个候选配方，精确计算 {scored_count} 个")
 
-                intersection = len(source_set & target_set)
-                union = len(source_set | target_set)
+        return self._fill_zero_scored(parameters, library_index, source, scope, top_scored, k)
 
-                if union > 0:
-                    category_similarities[category] = intersection / union
-                else:
-                    category_similarities[category] = 0.0
-
-                logger.info(
-                    f"  分类 '{category}': 交集={intersection}, 并集={union}, 相似度={category_similarities[category]:.4f}")
-                if intersection > 0:
-                    logger.debug(f"    共同标识符: {sorted(source_set & target_set)}")
-                if len(source_set - target_set) > 0:
-                    logger.debug(f"    源独有标识符: {sorted(source_set - target_set)}")
-                if len(target_set - source_set) > 0:
-                    logger.debug(f"    目标独有标识符: {sorted(target_set - source_set)}")
-
-            # 加权平均 - 只对实际存在成分的分类进行计算
-            logger.info(f"  开始计算加权平均...")
-            weighted_similarity = 0.0
-            total_weight = 0.0
-
-            # 找出实际有成分的分类（源配方或目标配方中至少有一个有该分类）
-            active_categories = set()
-            for category in all_categories:
-                source_set = set(source_by_category.get(category, []))
-                target_set = set(target_by_category.get(category, []))
-                # 只有当源配方或目标配方中至少有一个配方包含该分类时，才参与计算
-                if len(source_set) > 0 or len(target_set) > 0:
-                    active_categories.add(category)
-
-            logger.info(f"  有效分类（有成分的分类）: {sorted(active_categories)}")
-
-            # 只对有效分类进行权重计算
-            for category in active_categories:
-                if category in category_similarities:
-                    similarity = category_similarities[category]
-                    weight = self.parameters.category_weights.get(category,
-                                                                  self.parameters.category_weights.get("其他", 0.15))
-                    contribution = weight * similarity
-                    weighted_similarity += contribution
-                    total_weight += weight
-
-                    logger.info(
-                        f"    分类 '{category}': 相似度={similarity:.4f}, 权重={weight:.2f}, 贡献={contribution:.4f}")
-
-            # 显示被跳过的空分类
-            skipped_categories = set(self.parameters.category_weights.keys()) - active_categories
-            if skipped_categories:
-                logger.info(f"  跳过的空分类: {sorted(skipped_categories)}")
-
-            final_weighted = weighted_similarity / total_weight if total_weight > 0 else 0.0
-            logger.info(f"  参与计算的总权重: {total_weight:.2f}")
-            logger.info(f"  加权总分: {weighted_similarity:.4f}")
-            logger.info(f"  最终加权Jaccard: {final_weighted:.4f}")
-
-            return final_weighted
+    def _fill_zero_scored(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            source: SourceFeatures,
+            scope: Optional[np.ndarray],
+            top_scored: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]],
+            k: int
+    ) -> List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]:
+        """正分结果不足K个且阈值允许时，相似度为0的配方按配方库顺序排在其后"""
+        if len(top_scored) >= k or parameters.min_similarity_threshold > 0:
+            return top_scored
+        positive_rows = np.asarray([row for row, _ in top_scored], dtype=np.int64)
+        scope_rows = library_index.live_rows() if scope is None else scope
+        zero_rows = scope_rows[~np.isin(scope_rows, positive_rows)][:k - len(top_scored)]
+        zero_scores = self._score_index_rows(parameters, library_index, source, zero_rows)
+        top_scored.extend(zero_scores.scores_at(i) for i in range(len(zero_rows)))
+        return top_scored
+
+    def _lsh_top_k_index_rows(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            category_identifiers: Dict[str, List[str]],
+            source: SourceFeatures,
+            scope: Optional[np.ndarray],
+            k: int,
+            lsh_index: Optional[MinHashLSHIndex] = None
+    ) -> List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]:
+        """
+        MinHash/LSH近似召回 + 精确重排的Top-K检索
 
-        except Exception as e:
-            logger.error(f"计算加权Jaccard相似度失败: {e}")
-            return 0.0
+        只对与待匹配配方至少一个band签名相同的参考配方精确打分，未被召回的配方不参与排名
+        """
+        lsh_index = lsh_index or self.get_lsh_index(library_index)
+        candidates = lsh_index.query(
+            identifier for identifiers in category_identifiers.values() for identifier in identifiers
+        )
+        if scope is not None:
+            candidates = candidates[np.isin(candidates, scope)]
 
-    def _calculate_compound_similarity(self, source_compound: Dict, target_compound: Dict) -> float:
-        """计算复配成分相似度（基于catalog_id的Jaccard算法）"""
-        try:
-            if source_compound.get('type') != 'compound' or target_compound.get('type') != 'compound':
-                return 0.0
+        batch_scores = self._score_index_rows(parameters, library_index, source, candidates)
+        passed = np.flatnonzero(batch_scores.total >= parameters.min_similarity_threshold)
+        order = passed[np.argsort(-batch_scores.total[passed], kind='stable')]
+        logger.info(f"LSH召回 {len(candidates)} 个候选配方")
+        return [batch_scores.scores_at(i) for i in order[:k]]
 
-            # 获取复配中成分的catalog_id集合，确保匹配一致性
-            source_catalog_ids = set()
-            target_catalog_ids = set()
+    def evaluate_lsh_recall(
+            self,
+            session,
+            sample_size: int = 50,
+            parameters: Optional[LSHParameters] = None
+    ) -> Dict:
+        """
+        评估LSH近似召回相对精确检索的Recall@K
 
-            # 从components_detail中提取catalog_id
-            source_components = source_compound.get('components_detail', [])
-            target_components = target_compound.get('components_detail', [])
+        以待匹配配方库中最近的sample_size个配方为查询，K为当前max_results；
+        只统计精确结果中相似度大于0的配方
 
-            for comp in source_components:
-                catalog_id = comp.get('catalog_id')
-                if catalog_id:
-                    source_catalog_ids.add(catalog_id)
-                else:
-                    logger.warning(f"复配子成分缺少catalog_id: {comp.get('chinese_name', '未知')}")
+        Args:
+            parameters: 待评估的LSH参数，None表示当前配置
+        """
+        matching_parameters = self.get_parameters(session)
+        parameters = parameters or self.lsh_parameters
+        sample_size = max(1, min(sample_size, LSH_RECALL_MAX_SAMPLE_SIZE))
+        library_index = self.get_library_index(session)
+        segments = library_index.segments
+
+        started = time.perf_counter()
+        lsh_indexes = [self.get_lsh_index(segment, parameters) for segment in segments]
+        build_seconds = time.perf_counter() - started
+
+        source_ids = [row[0] for row in session.query(FormulasToBeMatched.id).order_by(
+            FormulasToBeMatched.id.desc()
+        ).limit(sample_size).all()]
+        source_features = self.get_match_features(source_ids, session, 'to_be_matched')
+
+        k = matching_parameters.max_results
+        recalls = []
+        candidate_fractions = []
+        exact_seconds = lsh_seconds = 0.0
+        for source_id in source_ids:
+            category_identifiers, proportions = source_features[source_id]
+            exact_top, approximate_top = [], []
+            candidate_count = 0
+            for segment, lsh_index in zip(segments, lsh_indexes):
+                source = segment.encode_source(category_identifiers, proportions,
+                                               matching_parameters.compound_threshold)
+
+                started = time.perf_counter()
+                exact_top = self._merge_top_scored(exact_top, segment, self._top_k_index_rows(
+                    matching_parameters, segment, source, None, k
+                ), k)
+                exact_seconds += time.perf_counter() - started
+
+                started = time.perf_counter()
+                approximate_top = self._merge_top_scored(approximate_top, segment, self._lsh_top_k_index_rows(
+                    matching_parameters, segment, category_identifiers, source, None, k, lsh_index
+                ), k)
+                lsh_seconds += time.perf_counter() - started
+
+                candidate_count += len(lsh_index.query(
+                    identifier for identifiers in category_identifiers.values() for identifier in identifiers
+                ))
+
+            exact_ids = {formula_id for formula_id, scores in exact_top if scores[0] > 0}
+            approximate_ids = {formula_id for formula_id, _ in approximate_top}
+            candidate_fractions.append(candidate_count / library_index.live_count if library_index.live_count else 0.0)
+            if exact_ids:
+                recalls.append(len(exact_ids & approximate_ids) / len(exact_ids))
+
+        query_count = len(source_ids)
+        return {
+            'bands': parameters.bands,
+            'rows': parameters.rows,
+            'similarity_threshold': round(parameters.similarity_threshold, 4),
+            'k': k,
+            'library_size': library_index.live_count,
+            'query_count': query_count,
+            'evaluated_count': len(recalls),
+            'recall_at_k': round(float(np.mean(recalls)), 4) if recalls else None,
+            'min_recall_at_k': round(float(np.min(recalls)), 4) if recalls else None,
+            'avg_candidate_fraction': round(float(np.mean(candidate_fractions)), 4) if candidate_fractions else 0.0,
+            'lsh_build_ms': round(build_seconds * 1000, 1),
+            'avg_exact_ms': round(exact_seconds * 1000 / query_count, 2) if query_count else 0.0,
+            'avg_lsh_ms': round(lsh_seconds * 1000 / query_count, 2) if query_count else 0.0
+        }
 
-            for comp in target_components:
-                catalog_id = comp.get('catalog_id')
-                if catalog_id:
-                    target_catalog_ids.add(catalog_id)
-                else:
-                    logger.warning(f"复配子成分缺少catalog_id: {comp.get('chinese_name', '未知')}")
+    # ==================== 参考配方库近似重复检测 ====================
 
-            if not source_catalog_ids or not target_catalog_ids:
-                return 0.0
+    def find_duplicate_pairs(
+            self,
+            session,
+            threshold: float,
+            parameters: Optional[DualLibraryMatchingParameters] = None
+    ) -> List[Tuple[int, int, float, float, float]]:
+        """
+        参考配方库内部两两比较，找出总相似度不低于threshold的配方对（与匹配相同的两段式相似度）
 
-            # 计算基于catalog_id的Jaccard相似度
-            intersection = len(source_catalog_ids & target_catalog_ids)
-            union = len(source_catalog_ids | target_catalog_ids)
-            compound_similarity = intersection / union if union > 0 else 0.0
+        逐行自连接，避免全量O(n²)比较：
+        1. 只与配方ID更大、且共享至少一个匹配标识符或成分名称的配方比较（其余配方相似度必为0）；
+           其他索引段的配方在该段词表下重新编码后比较，每对配方仍以ID较小者为待匹配方
+        2. 按各分类标识符数量得到的相似度上界（大小约束）低于阈值的配方不做精确计算
 
-            logger.info(f"🔍 复配相似度: {compound_similarity:.4f} (交集:{intersection}, 并集:{union})")
-            logger.info(f"  源复配catalog_ids: {sorted(source_catalog_ids)}")
-            logger.info(f"  目标复配catalog_ids: {sorted(target_catalog_ids)}")
+        Returns:
+            [(配方ID, 重复配方ID, 总相似度, 组成相似度, 比例相似度)]，按配方ID、重复配方ID升序，配方ID小于重复配方ID
+        """
+        parameters = parameters or self.get_parameters(session)
+        library_index = self.get_library_index(session)
+        segments = library_index.segments
+        tolerance = self.UPPER_BOUND_TOLERANCE
+
+        pairs = []
+        candidate_count = scored_count = 0
+        for segment in segments:
+            for row in segment.live_rows():
+                formula_id = int(segment.formula_ids[row])
+                for target in segments:
+                    if target is segment:
+                        source = segment.row_features(row, parameters.compound_threshold)
+                        candidates = segment.overlapping_rows(source, after_row=row)
+                    else:
+                        source = target.encode_source(*segment.row_match_features(row), parameters.compound_threshold)
+                        candidates = target.overlapping_rows(source)
+                        candidates = candidates[target.formula_ids[candidates] > formula_id]
+                    if len(candidates) == 0:
+                        continue
+                    candidate_count += len(candidates)
+
+                    upper_bounds = self._score_upper_bounds(parameters, target, source, candidates)
+                    candidates = candidates[upper_bounds + tolerance >= threshold]
+                    if len(candidates) == 0:
+                        continue
+                    scored_count += len(candidates)
+
+                    batch_scores = self._score_index_rows(parameters, target, source, candidates)
+                    for i in np.flatnonzero(batch_scores.total >= threshold):
+                        pairs.append((formula_id, int(target.formula_ids[candidates[i]]),
+                                      float(batch_scores.total[i]), float(batch_scores.composition[i]),
+                                      float(batch_scores.proportion[i])))
+
+        pairs.sort(key=lambda pair: pair[:2])
+        logger.info(f"近似重复检测: {library_index.live_count} 个配方, 共享成分的配方对 {candidate_count} 个, "
+                    f"精确计算 {scored_count} 个, 阈值 {threshold} 以上 {len(pairs)} 个")
+        return pairs
+
+    @staticmethod
+    def cluster_duplicate_pairs(pairs: List[Tuple[int, int, float, float, float]]) -> List[List[int]]:
+        """按重复对的连通关系（并查集）聚成重复簇，簇内配方ID升序，簇按大小降序、最小配方ID升序排列"""
+        parents: Dict[int, int] = {}
+
+        def find(formula_id: int) -> int:
+            root = parents.setdefault(formula_id, formula_id)
+            while root != parents[root]:
+                root = parents[root]
+            while parents[formula_id] != root:
+                parents[formula_id], formula_id = root, parents[formula_id]
+            return root
+
+        for formula_id, duplicate_id, *_ in pairs:
+            root_a, root_b = find(formula_id), find(duplicate_id)
+            if root_a != root_b:
+                parents[max(root_a, root_b)] = min(root_a, root_b)
+
+        clusters = defaultdict(list)
+        for formula_id in parents:
+            clusters[find(formula_id)].append(formula_id)
+        return sorted((sorted(members) for members in clusters.values()),
+                      key=lambda members: (-len(members), members[0]))
+
+    def detect_duplicate_formulas(
+            self,
+            session,
+            threshold: float,
+            parameters: Optional[DualLibraryMatchingParameters] = None
+    ) -> Dict:
+        """近似重复检测并保存结果（整体替换上次的检测结果）"""
+        started = time.perf_counter()
+        pairs = self.find_duplicate_pairs(session, threshold, parameters)
+        clusters = self.cluster_duplicate_pairs(pairs)
+
+        cluster_of = {formula_id: number for number, members in enumerate(clusters, start=1) for formula_id in members}
+        DualFormulaLibraryHandler.save_duplicate_pairs(session, [
+            {
+                'cluster_id': cluster_of[formula_id],
+                'formula_id': formula_id,
+                'duplicate_formula_id': duplicate_id,
+                'similarity_score': total_similarity,
+                'composition_similarity': composition_similarity,
+                'proportion_similarity': proportion_similarity
+            }
+            for formula_id, duplicate_id, total_similarity, composition_similarity, proportion_similarity in pairs
+        ], threshold)
+        session.commit()
 
-            return compound_similarity
+        return {
+            'threshold': threshold,
+            'pair_count': len(pairs),
+            'cluster_count': len(clusters),
+            'duplicate_formula_count': sum(len(members) - 1 for members in clusters),
+            'elapsed_seconds': round(time.perf_counter() - started, 2)
+        }
 
-        except Exception as e:
-            logger.error(f"计算复配相似度失败: {e}")
-            return 0.0
+    @staticmethod
+    def _snap_similarities(values: np.ndarray) -> np.ndarray:
+        """精度修正（数组版）：非常接近1.0或0.0的值修正为1.0或0.0"""
+        values = np.where(np.abs(values - 1.0) < 1e-10, 1.0, values)
+        return np.where(np.abs(values) < 1e-10, 0.0, values)
 
-    def _is_compound_match_success(self, similarity: float) -> bool:
-        """判断复配是否匹配成功（相似度>60%）"""
-        return similarity >= self.parameters.compound_threshold
+    def _materialize_index_results(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_formula: FormulasToBeMatched,
+            source_structure: Dict,
+            top_scored: List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]],
+            session,
+            formulas_by_id: Optional[Dict[int, Formulas]] = None,
+            target_structures: Optional[Dict[int, Dict]] = None
+    ) -> List[DualLibraryMatchResult]:
+        """
+        为排名靠前的 (配方ID, 打分结果) 批量加载目标配方，补全共同成分等展示信息
 
-    def _calculate_category_similarities(
+        批量匹配时可传入已为多个待匹配配方一次性加载的目标配方及结构
+        """
+        if not top_scored:
+            return []
+
+        target_ids = [formula_id for formula_id, _ in top_scored]
+        if formulas_by_id is None:
+            formulas_by_id = {
+                formula.id: formula
+                for formula in session.query(Formulas).filter(Formulas.id.in_(target_ids)).all()
+            }
+        if target_structures is None:
+            target_structures = DualFormulaLibraryHandler.get_formula_structures(target_ids, session, 'reference')
+
+        results = []
+        for target_id, (_, scores) in zip(target_ids, top_scored):
+            target_formula = formulas_by_id.get(target_id)
+            if target_formula is None:
+                logger.warning(f"参考配方 {target_id} 已不存在，跳过")
+                continue
+            total_similarity, composition_similarity, proportion_similarity, category_similarities = scores
+            results.append(self._build_match_result(
+                parameters, source_formula, source_structure, target_formula, target_structures[target_id],
+                total_similarity, composition_similarity, proportion_similarity, category_similarities
+            ))
+        return results
+
+    def _match_single_pair(
             self,
+            source_formula: FormulasToBeMatched,
             source_structure: Dict,
-            target_structure: Dict,
-            session
-    ) -> Dict[str, float]:
-        """计算各分类的相似度"""
+            target_formula_id: int,
+            session,
+            target_formula: Optional[Formulas] = None,
+            target_structure: Optional[Dict] = None,
+            parameters: Optional[DualLibraryMatchingParameters] = None,
+            explain: bool = False
+    ) -> Optional[DualLibraryMatchResult]:
+        """
+        匹配单个配方对（可传入已批量加载的目标配方及结构，避免重复查询；parameters为None时读取当前配置）
+
+        explain为True时在match_details['explanation']中附带相似度计算明细
+        """
         try:
-            # 展开成分列表
-            source_ingredients_list = self._extract_ingredients_list(source_structure)
-            target_ingredients_list = self._extract_ingredients_list(target_structure)
+            parameters = parameters or self.get_parameters(session)
 
-            source_by_category = self._group_ingredients_by_category(
-                source_ingredients_list, session
+            cache_key = (
+                'pair', source_formula.id, source_formula.updated_at, target_formula_id,
+                self.get_library_version(session), parameters.fingerprint, explain
             )
-            target_by_category = self._group_ingredients_by_category(
-                target_ingredients_list, session
+            cached_result = self.result_cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+
+            # 获取目标配方
+            if target_formula is None:
+                target_formula = session.query(Formulas).filter(
+                    Formulas.id == target_formula_id
+                ).first()
+
+            if not target_formula:
+                return None
+
+            # 获取目标配方结构
+            if target_structure is None:
+                target_structure = DualFormulaLibraryHandler.get_formula_structure(
+                    target_formula_id, session, 'reference'
+                )
+
+            # 读取预先计算的匹配特征，计算两段式相似度
+            source_features = self.get_match_features(
+                [source_formula.id], session, 'to_be_matched'
+            )[source_formula.id]
+            target_features = self.get_match_features([target_formula.id], session, 'reference')[target_formula.id]
+            total_similarity, composition_similarity, proportion_similarity, category_similarities = \
+                self._score_feature_pair(parameters, source_features, target_features)
+
+            result = self._build_match_result(
+                parameters, source_formula, source_structure, target_formula, target_structure,
+                total_similarity, composition_similarity, proportion_similarity, category_similarities
             )
+            if explain:
+                result.match_details['explanation'] = self.explain_match(
+                    parameters, source_structure, target_structure, session
+                )
+            self.result_cache.put(cache_key, result)
+            return result
 
-            similarities = {}
-            all_categories = set(source_by_category.keys()) | set(target_by_category.keys())
+        except Exception as e:
+            logger.error(f"单个配方匹配失败: {e}")
+            return None
 
-            for category in all_categories:
-                source_set = set(source_by_category.get(category, []))
-                target_set = set(target_by_category.get(category, []))
+    def _build_match_result(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_formula: FormulasToBeMatched,
+            source_structure: Dict,
+            target_formula: Formulas,
+            target_structure: Dict,
+            total_similarity: float,
+            composition_similarity: float,
+            proportion_similarity: float,
+            category_similarities: Dict[str, float]
+    ) -> DualLibraryMatchResult:
+        """根据相似度得分构建匹配结果（共同成分、匹配详情等）"""
+        # 获取共同成分信息
+        common_ingredients = self._get_common_ingredients(
+            source_structure, target_structure
+        )
 
-                intersection = len(source_set & target_set)
-                union = len(source_set | target_set)
+        # 构建匹配详情
+        source_ingredients_list = self._extract_ingredients_list(source_structure)
+        target_ingredients_list = self._extract_ingredients_list(target_structure)
+
+        match_details = {
+            "source_ingredients_count": len(source_ingredients_list),
+            "target_ingredients_count": len(target_ingredients_list),
+            "composition_method": "weighted_jaccard",
+            "proportion_method": "weighted_cosine",
+            "algorithm_version": "dual_library_v1.0",
+            "parameters": {
+                "composition_weight": parameters.composition_weight,
+                "proportion_weight": parameters.proportion_weight,
+                "category_weights": parameters.category_weights
+            }
+        }
 
-                similarities[category] = intersection / union if union > 0 else 0.0
+        # 创建匹配结果
+        return DualLibraryMatchResult(
+            source_formula_id=source_formula.id,
+            source_formula_name=source_formula.formula_name,
+            target_formula_id=target_formula.id,
+            target_formula_name=target_formula.formula_name,
+            similarity_score=total_similarity,
+            composition_similarity=composition_similarity,
+            proportion_similarity=proportion_similarity,
+            category_similarities=category_similarities,
+            common_ingredients=common_ingredients,
+            common_ingredients_count=len(common_ingredients),
+            total_ingredients_count=len(set([ing['chinese_name'] for ing in source_ingredients_list])),
+            match_details=match_details
+        )
 
-            return similarities
+    def _score_feature_pair(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_features: MatchFeatures,
+            target_features: MatchFeatures
+    ) -> Tuple[float, float, float, Dict[str, float]]:
+        """
+        由匹配特征计算单个配方对的相似度（与内存索引批量打分算法一致）
 
-        except Exception as e:
-            logger.error(f"计算分类相似度失败: {e}")
-            return {}
+        Returns:
+            (总相似度, 组成相似度, 比例相似度, 分类相似度)
+        """
+        source_categories, source_proportions = source_features
+        target_categories, target_proportions = target_features
+
+        # 成分组成相似度：分类Jaccard，只对实际存在成分的分类加权平均
+        category_similarities = {}
+        weighted_similarity = 0.0
+        total_weight = 0.0
+        default_weight = parameters.category_weights.get("其他", 0.15)
+        for category in set(source_categories.keys()) | set(target_categories.keys()):
+            source_set = set(source_categories.get(category, []))
+            target_set = set(target_categories.get(category, []))
+            intersection, _ = self._match_category_identifiers(parameters, source_set, target_set)
+            union = len(source_set) + len(target_set) - intersection
+            if union == 0:
+                continue
+            category_similarities[category] = intersection / union
+            weight = parameters.category_weights.get(category, default_weight)
+            weighted_similarity += weight * category_similarities[category]
+            total_weight += weight
+        composition_similarity = weighted_similarity / total_weight if total_weight > 0 else 0.0
+
+        # 成分比例相似度：成分并集上的余弦相似度
+        proportion_similarity = 0.0
+        all_ingredients = sorted(set(source_proportions.keys()) | set(target_proportions.keys()))
+        source_vector = np.asarray([source_proportions.get(name, 0) for name in all_ingredients], dtype=np.float64)
+        target_vector = np.asarray([target_proportions.get(name, 0) for name in all_ingredients], dtype=np.float64)
+        norms = np.linalg.norm(source_vector) * np.linalg.norm(target_vector)
+        if all_ingredients and np.sum(source_vector) != 0 and np.sum(target_vector) != 0 and norms > 0:
+            proportion_similarity = float(self._snap_similarities(
+                np.asarray([np.dot(source_vector, target_vector) / norms])
+            )[0])
+
+        total_similarity = float(self._snap_similarities(np.asarray([
+            parameters.composition_weight * composition_similarity +
+            parameters.proportion_weight * proportion_similarity
+        ]))[0])
+        return total_similarity, composition_similarity, proportion_similarity, category_similarities
+
+    def _match_category_identifiers(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_set: set,
+            target_set: set
+    ) -> Tuple[int, List[Tuple[str, str, float]]]:
+        """
+        单个分类的交集数量（与内存索引打分一致）
+
+        参考配方的标识符与待匹配配方某个标识符相同，或为与某个源复配组成成分Jaccard达到复配阈值的复配时计为命中；
+        一个源复配可能命中多个参考复配，交集不超过待匹配配方在该分类的标识符数
+
+        Returns:
+            (交集数量, [(源复配签名, 命中的相近参考复配签名, 复配相似度)])
+        """
+        source_compounds = [(identifier, catalog_ids) for identifier, catalog_ids in
+                            ((identifier, parse_compound_signature(identifier)) for identifier in sorted(source_set))
+                            if catalog_ids]
+        matched_count = 0
+        compound_matches = []
+        for identifier in sorted(target_set):
+            if identifier in source_set:
+                matched_count += 1
+                continue
+            target_catalog_ids = parse_compound_signature(identifier)
+            if not target_catalog_ids:
+                continue
+            similarities = [(source_identifier, compound_jaccard(catalog_ids, target_catalog_ids))
+                            for source_identifier, catalog_ids in source_compounds]
+            similar = [(source_identifier, similarity) for source_identifier, similarity in similarities
+                       if self._is_compound_match_success(parameters, similarity)]
+            if similar:
+                matched_count += 1
+                source_identifier, similarity = max(similar, key=lambda item: item[1])
+                compound_matches.append((source_identifier, identifier, similarity))
+        return min(matched_count, len(source_set)), compound_matches
+
+    def explain_match(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_structure: Dict,
+            target_structure: Dict,
+            session=None
+    ) -> Dict:
+        """
+        生成单个配方对的相似度计算明细（explain模式，仅用于用户查看的配方对）
+
+        包括各分类的交集/并集、权重与贡献，共同及各自独有的匹配标识符，
+        比例向量，以及复配整体名称与其组成成分
+        """
+        source_ingredients_list = self._extract_ingredients_list(source_structure)
+        target_ingredients_list = self._extract_ingredients_list(target_structure)
+        source_by_category, source_proportions = self.extract_match_features(source_structure)
+        target_by_category, target_proportions = self.extract_match_features(target_structure)
+
+        categories = []
+        weighted_similarity = 0.0
+        total_weight = 0.0
+        default_weight = parameters.category_weights.get("其他", 0.15)
+        for category in sorted(set(source_by_category.keys()) | set(target_by_category.keys())):
+            source_set = set(source_by_category.get(category, []))
+            target_set = set(target_by_category.get(category, []))
+            intersection, compound_matches = self._match_category_identifiers(parameters, source_set, target_set)
+            union = len(source_set) + len(target_set) - intersection
+            similarity = intersection / union if union > 0 else 0.0
+            weight = parameters.category_weights.get(category, default_weight)
+            if union > 0:
+                weighted_similarity += weight * similarity
+                total_weight += weight
+            categories.append({
+                "category": category,
+                "source_count": len(source_set),
+                "target_count": len(target_set),
+                "intersection": intersection,
+                "union": union,
+                "similarity": similarity,
+                "weight": weight,
+                "contribution": weight * similarity,
+                "common_identifiers": sorted(source_set & target_set),
+                "similar_compounds": [
+                    {"source": source_identifier, "target": target_identifier, "similarity": similarity}
+                    for source_identifier, target_identifier, similarity in compound_matches
+                ],
+                "source_only_identifiers": sorted(source_set - target_set),
+                "target_only_identifiers": sorted(target_set - source_set)
+            })
+
+        all_ingredients = sorted(set(source_proportions.keys()) | set(target_proportions.keys()))
+
+        def compounds(ingredients_list):
+            return [{"name": ing['chinese_name'],
+                     "components": [comp.get('chinese_name', '') for comp in ing.get('components_detail', [])]}
+                    for ing in ingredients_list if ing.get('type') == 'compound']
+
+        # 复配两两相似度（组成成分catalog_id集合的Jaccard）
+        compound_similarities = []
+        for source_ing in source_ingredients_list:
+            for target_ing in target_ingredients_list:
+                if source_ing.get('type') != 'compound' or target_ing.get('type') != 'compound':
+                    continue
+                similarity = self._calculate_compound_similarity(source_ing, target_ing)
+                compound_similarities.append({
+                    "source": source_ing['chinese_name'],
+                    "target": target_ing['chinese_name'],
+                    "similarity": similarity,
+                    "matched": self._is_compound_match_success(parameters, similarity)
+                })
+
+        return {
+            "categories": categories,
+            "skipped_categories": sorted(set(parameters.category_weights.keys()) -
+                                         {item["category"] for item in categories}),
+            "total_weight": total_weight,
+            "weighted_similarity": weighted_similarity,
+            "composition_similarity": weighted_similarity / total_weight if total_weight > 0 else 0.0,
+            "proportion": {
+                "union_count": len(all_ingredients),
+                "source_vector": [source_proportions.get(name, 0) for name in all_ingredients],
+                "target_vector": [target_proportions.get(name, 0) for name in all_ingredients],
+                "ingredients": all_ingredients
+            },
+            "source_compounds": compounds(source_ingredients_list),
+            "target_compounds": compounds(target_ingredients_list),
+            "compound_similarities": compound_similarities
+        }
+
+    def _calculate_compound_similarity(self, source_compound: Dict, target_compound: Dict) -> float:
+        """计算复配成分相似度（组成成分catalog_id集合的Jaccard，与复配签名索引的计算一致）"""
+        if source_compound.get('type') != 'compound' or target_compound.get('type') != 'compound':
+            return 0.0
+
+        source_catalog_ids = frozenset(map(str, source_compound.get('component_catalog_ids', [])))
+        target_catalog_ids = frozenset(map(str, target_compound.get('component_catalog_ids', [])))
+        if not source_catalog_ids or not target_catalog_ids:
+            return 0.0
+        return compound_jaccard(source_catalog_ids, target_catalog_ids)
+
+    @staticmethod
+    def _is_compound_match_success(parameters: DualLibraryMatchingParameters, similarity: float) -> bool:
+        """判断复配是否匹配成功（至少共享一个成分，且相似度不低于复配匹配阈值）"""
+        return similarity > 0 and similarity >= parameters.compound_threshold
 
     def _extract_ingredients_list(self, structure: Dict) -> List[Dict]:
         """从配方结构中提取成分列表 - 复配作为整体处理"""
@@ -634,20 +1668,16 @@ class DualLibraryMatchingEngine:
                 # 复配成分作为整体
                 components = ing.get('components', [])
                 if components:
-                    # 创建复配整体标识 - 基于成分组合而非ingredient_id
-                    # 使用成分的中文名称排序后生成唯一标识
+                    # 复配整体名称（比例向量与展示使用；匹配标识见 _group_ingredients_by_category 的复配签名）
+                    # 使用成分的中文名称排序后生成稳定名称
                     component_names = sorted([comp.get('chinese_name', '') for comp in components])
                     # 取前3个主要成分作为标识（避免名称过长）
                     main_identifiers = component_names[:3]
                     compound_identifier = '_'.join(main_identifiers)
                     # 生成简化的哈希值避免名称过长
-                    import hashlib
                     compound_hash = hashlib.md5(compound_identifier.encode('utf-8')).hexdigest()[:8]
                     compound_name = f"复配_{compound_hash}"
 
-                    # 调试信息：记录复配名称生成
-                    logger.info(f"🔍 复配名称生成: {compound_name} <- 成分: {main_identifiers}")
-
                     # 获取复配中所有成分的catalog_id列表（用于匹配）
                     component_catalog_ids = []
                     for comp in components:
@@ -737,21 +1767,18 @@ class DualLibraryMatchingEngine:
                         chinese_name = ingredient.get('chinese_name', '')
                         if chinese_name:
                             grouped[standard_category].append(f"name_{chinese_name}")
-                        logger.warning(f"单配成分缺少catalog_id: {chinese_name}")
                 else:
-                    # 复配成分：使用复配名称作为标识符，添加前缀保持一致性
+                    # 复配成分：按全部组成成分的catalog_id集合生成复配签名，匹配时可命中组成相近的复配；
+                    # 组成成分都缺少catalog_id时使用复配名称作为标识符
+                    component_catalog_ids = ingredient.get('component_catalog_ids')
                     chinese_name = ingredient.get('chinese_name', '')
-                    if chinese_name:
+                    if component_catalog_ids:
+                        grouped[standard_category].append(compound_signature(component_catalog_ids))
+                    elif chinese_name:
                         grouped[standard_category].append(f"compound_{chinese_name}")
 
-                logger.debug(
-                    f"成分映射: {ingredient.get('chinese_name', '未知')} | 原始用途: '{raw_purpose}' | 标准分类: '{standard_category}'")
-
             # 只返回有成分的分类，不创建空分类
-            result = {k: v for k, v in grouped.items() if v}  # 过滤掉空列表
-
-            logger.info(f"分类映射结果（成分数量）: {[(k, len(v)) for k, v in result.items()]}")
-            return result
+            return {k: v for k, v in grouped.items() if v}  # 过滤掉空列表
 
         except Exception as e:
             logger.error(f"成分分类失败: {e}")
@@ -798,15 +1825,32 @@ class DualLibraryMatchingEngine:
             self,
             source_formula_ids: List[int],
             session,
-            target_formulas: List[int] = None
+            target_formulas: List[int] = None,
+            strict_mode: bool = False,
+            retrieval_mode: Optional[str] = None,
+            parameters: Optional[DualLibraryMatchingParameters] = None
     ) -> Dict[int, List[DualLibraryMatchResult]]:
-        """批量匹配多个配方"""
-        results = {}
+        """
+        批量匹配多个配方
 
+        精确召回匹配整个配方库（或严格范围）时，全部待匹配配方堆叠为稀疏矩阵，按参考配方分块以矩阵-矩阵乘法
+        一次打分，结果与逐个调用match_formula_against_library完全一致；指定目标配方或LSH召回时逐个匹配
+
+        Returns:
+            {待匹配配方ID: 匹配结果列表}，不存在或匹配失败的配方为空列表
+        """
+        parameters = parameters or self.get_parameters(session)
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+
+        if target_formulas is None and retrieval_mode == 'exact':
+            return self._batch_match_library(parameters, source_formula_ids, session, strict_mode)
+
+        results = {}
         for source_id in source_formula_ids:
             try:
                 match_results = self.match_formula_against_library(
-                    source_id, session, target_formulas
+                    source_id, session, target_formulas, strict_mode=strict_mode,
+                    retrieval_mode=retrieval_mode, parameters=parameters
                 )
                 results[source_id] = match_results
             except Exception as e:
@@ -815,6 +1859,176 @@ class DualLibraryMatchingEngine:
 
         return results
 
+    def _batch_match_library(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            source_formula_ids: List[int],
+            session,
+            strict_mode: bool
+    ) -> Dict[int, List[DualLibraryMatchResult]]:
+        """多对多批量匹配：已缓存的配方直接返回，其余配方一起分块打分，目标配方与结构一次性加载"""
+        source_formula_ids = list(dict.fromkeys(source_formula_ids))
+        library_index = self.get_library_index(session)
+        library_version = self._library_version
+
+        source_formulas = {}
+        chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+        for i in range(0, len(source_formula_ids), chunk_size):
+            source_formulas.update((formula.id, formula) for formula in session.query(FormulasToBeMatched).filter(
+                FormulasToBeMatched.id.in_(source_formula_ids[i:i + chunk_size])
+            ).all())
+
+        results = {}
+        pending_ids = []
+        for source_id in source_formula_ids:
+            source_formula = source_formulas.get(source_id)
+            if source_formula is None:
+                logger.error(f"批量匹配配方 {source_id} 失败: 待匹配配方不存在")
+                results[source_id] = []
+                continue
+            cached_results = self.result_cache.get(self._match_cache_key(
+                source_formula, library_version, parameters, strict_mode, 'exact'
+            ))
+            if cached_results is not None:
+                results[source_id] = cached_results
+            else:
+                pending_ids.append(source_id)
+
+        if pending_ids:
+            features = self.get_match_features(pending_ids, session, 'to_be_matched')
+            # 严格范围只取决于产品类型与客户，相同组合的配方作为一组，只在该组的候选范围内打分
+            groups = defaultdict(list)
+            for position, source_id in enumerate(pending_ids):
+                source_formula = source_formulas[source_id]
+                key = (source_formula.product_type or "", source_formula.customer or "") if strict_mode else None
+                groups[key].append(position)
+
+            top_scored_lists = [[] for _ in pending_ids]
+            for segment in library_index.segments:
+                sources = [segment.encode_source(*features[source_id], parameters.compound_threshold)
+                           for source_id in pending_ids]
+                for key, positions in groups.items():
+                    scope = None if key is None else segment.strict_scope_rows(*key)
+                    group_top_lists = self._batch_top_k_index_rows(
+                        parameters, segment, [sources[position] for position in positions], scope,
+                        parameters.max_results
+                    )
+                    for position, segment_top in zip(positions, group_top_lists):
+                        top_scored_lists[position] = self._merge_top_scored(
+                            top_scored_lists[position], segment, segment_top, parameters.max_results
+                        )
+
+            # 全部待匹配配方的前N名目标配方与结构一次性加载
+            target_ids = sorted({formula_id for top_scored in top_scored_lists for formula_id, _ in top_scored})
+            formulas_by_id = {}
+            for i in range(0, len(target_ids), chunk_size):
+                formulas_by_id.update((formula.id, formula) for formula in session.query(Formulas).filter(
+                    Formulas.id.in_(target_ids[i:i + chunk_size])
+                ).all())
+            target_structures = DualFormulaLibraryHandler.get_formula_structures(target_ids, session, 'reference')
+            source_structures = DualFormulaLibraryHandler.get_formula_structures(pending_ids, session, 'to_be_matched')
+
+            cacheable = library_index is self._library_index and library_version == self._library_version
+            for source_id, top_scored in zip(pending_ids, top_scored_lists):
+                source_formula = source_formulas[source_id]
+                match_results = self._materialize_index_results(
+                    parameters, source_formula, source_structures[source_id], top_scored, session,
+                    formulas_by_id, target_structures
+                )
+                if cacheable:
+                    self.result_cache.put(self._match_cache_key(
+                        source_formula, library_version, parameters, strict_mode, 'exact'
+                    ), match_results)
+                results[source_id] = match_results
+
+        logger.info(f"批量匹配完成: {len(source_formula_ids)} 个待匹配配方, 其中 {len(pending_ids)} 个参与矩阵打分")
+        return {source_id: results[source_id] for source_id in source_formula_ids}
+
+    def _batch_top_k_index_rows(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            sources: List[SourceFeatures],
+            scope: Optional[np.ndarray],
+            k: int
+    ) -> List[List[Tuple[int, Tuple[float, float, float, Dict[str, float]]]]]:
+        """
+        多对多Top-K检索：只对与这批待匹配配方中至少一个共享标识符或成分名称的行打分，按行分块，
+        每块一次矩阵-矩阵乘法为全部待匹配配方打分，逐块与各自当前的前K名合并（同分按配方库顺序）；
+        正分结果不足K个时按配方库顺序补入相似度为0的配方，与_top_k_index_rows的结果完全一致
+
+        Args:
+            scope: 这批待匹配配方共同的候选行号范围（升序，严格模式），None表示整个配方库
+        """
+        if k <= 0 or not sources:
+            return [[] for _ in sources]
+
+        batch = library_index.encode_source_batch(sources)
+        candidates = library_index.batch_candidate_rows(sources, scope)
+
+        block_size = max(1, self.BATCH_SCORE_BUDGET // (batch.size * len(STANDARD_CATEGORIES)))
+        top_rows = np.empty((batch.size, 0), dtype=np.int64)
+        top_scores = np.empty((batch.size, 0), dtype=np.float64)
+        for start in range(0, len(candidates), block_size):
+            rows = candidates[start:start + block_size]
+            total = self._score_index_block(parameters, library_index, batch, rows)
+            # 相似度为0的配方最后按配方库顺序补入
+            passed = (total >= parameters.min_similarity_threshold) & (total > 0)
+
+            candidate_scores = np.hstack([top_scores, np.where(passed, total, -np.inf)])
+            candidate_rows = np.hstack([top_rows, np.broadcast_to(rows, (batch.size, len(rows)))])
+            order = np.lexsort((candidate_rows, -candidate_scores), axis=-1)[:, :k]
+            top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            top_rows = np.take_along_axis(candidate_rows, order, axis=1)
+
+        # 前K名的分项得分与单配方路径使用同一打分函数计算
+        top_scored_lists = []
+        for source, rows, scores in zip(sources, top_rows, top_scores):
+            rows = rows[np.isfinite(scores)]
+            batch_scores = self._score_index_rows(parameters, library_index, source, rows)
+            top_scored = [batch_scores.scores_at(i) for i in range(len(rows))]
+            top_scored_lists.append(self._fill_zero_scored(parameters, library_index, source, scope, top_scored, k))
+        return top_scored_lists
+
+    def _score_index_block(
+            self,
+            parameters: DualLibraryMatchingParameters,
+            library_index: ReferenceLibraryIndex,
+            batch: SourceBatch,
+            rows: np.ndarray
+    ) -> np.ndarray:
+        """
+        一批待匹配配方与一块参考配方行的总相似度（与_score_index_rows算法一致）
+
+        Returns:
+            形状为 (批大小, 行数) 的数组
+        """
+        target_counts = library_index.category_counts[rows]
+        intersections = library_index.batch_category_intersections(batch, rows)
+
+        sizes = batch.category_counts[:, np.newaxis, :].astype(np.float64) + target_counts[np.newaxis, :, :]
+        active = sizes > 0
+        unions = sizes - intersections
+        with np.errstate(divide='ignore', invalid='ignore'):
+            category_similarities = np.where(unions > 0, intersections / unions, 0.0)
+        composition = self._weighted_composition(parameters, category_similarities, active)
+
+        target_norms = library_index.proportion_norms[rows]
+        source_valid = (batch.proportion_sums != 0) & (batch.proportion_norms > 0)
+        target_valid = (library_index.proportion_sums[rows] != 0) & (target_norms > 0)
+        valid = source_valid[:, np.newaxis] & target_valid[np.newaxis, :]
+        proportion = np.zeros(valid.shape, dtype=np.float64)
+        if valid.any():
+            dots = library_index.batch_proportion_dots(batch, rows)
+            norms = batch.proportion_norms[:, np.newaxis] * target_norms[np.newaxis, :]
+            proportion[valid] = dots[valid] / norms[valid]
+            proportion = self._snap_similarities(proportion)
+
+        return self._snap_similarities(
+            parameters.composition_weight * composition +
+            parameters.proportion_weight * proportion
+        )
+
     def get_matching_statistics(self, match_results: List[DualLibraryMatchResult]) -> Dict:
         """获取匹配统计信息"""
         if not match_results:
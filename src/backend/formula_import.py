@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参考配方库批量导入任务
+导入的文件按 客户/产品大类/产品小类/配方.xlsx 目录结构组织（zip压缩包或逐批上传的文件夹），
+后台任务用进程池并行解析，一次解析全部成分的原料目录条目，按批次批量写入配方与成分，
+每批写入后计算匹配特征并增量更新匹配索引；内容与已解析文件相同的文件直接使用缓存的解析结果，
+进度、逐个文件的失败原因以及与已有配方内容相同的文件可通过任务状态查询
+"""
+
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import PurePosixPath
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.backend.formula_parser import FormulaParser, file_content_hash
+from src.backend.sql.mysql_models import DualFormulaLibraryHandler, Formulas, FormulaIngredients
+
+logger = logging.getLogger(__name__)
+
+# 任务状态（与匹配任务一致）
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_JOB_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# 运行中任务所处阶段
+PHASE_EXTRACTING = 'extracting'
+PHASE_IMPORTING = 'importing'
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+# 同名校验时单条IN查询的名称数量
+NAME_QUERY_CHUNK = 500
+
+_FOLDER_NAME_STRIP = re.compile(r'[\'"<>:|?*]')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def process_folder_name(folder_name: str) -> str:
+    """处理文件夹名中的特殊字符：去除首尾空白、合并连续空白、移除引号与Windows文件名不允许的字符"""
+    if not folder_name:
+        return folder_name
+    return _FOLDER_NAME_STRIP.sub('', _WHITESPACE.sub(' ', folder_name.strip()))
+
+
+def parse_library_path(relative_path: str) -> Tuple[str, str, str]:
+    """
+    由库内相对路径得到配方信息（与前端文件夹导入的规则一致）
+
+    客户/产品大类/产品小类/配方.xlsx → 产品类型为“大类-小类”；客户/产品大类/配方.xlsx → 产品类型为大类；
+    更深的目录层级忽略，配方名称为去除扩展名的文件名
+
+    Returns:
+        (客户, 产品类型, 配方名称)
+
+    Raises:
+        ValueError: 目录层级不足
+    """
+    parts = PurePosixPath(relative_path).parts
+    if len(parts) < 3:
+        raise ValueError("目录层级不足，应为 客户/产品大类/[产品小类/]配方文件")
+
+    customer = parts[0]
+    category = process_folder_name(parts[1]) or '其他类'
+    subcategory = process_folder_name(parts[2]) if len(parts) > 3 else ''
+    product_type = f"{category}-{subcategory}" if subcategory else category
+    return customer, product_type, PurePosixPath(parts[-1]).stem
+
+
+def is_excel_path(relative_path: str) -> bool:
+    """是否为需要导入的Excel文件（忽略隐藏文件、Office锁文件与macOS压缩包元数据）"""
+    parts = PurePosixPath(relative_path).parts
+    if not parts or parts[0] == '__MACOSX':
+        return False
+    file_name = parts[-1]
+    return (file_name.lower().endswith(EXCEL_EXTENSIONS)
+            and not file_name.startswith(('.', '~$')))
+
+
+def strip_root_folder(paths: Sequence[str], has_root_folder: Optional[bool] = None) -> List[str]:
+    """
+    去除路径的主文件夹层级
+
+    has_root_folder为None时自动判断：全部文件位于同一个顶层文件夹下，且存在
+    主文件夹/客户/产品大类/产品小类/配方文件 五级的文件时视为带主文件夹
+    """
+    split_paths = [PurePosixPath(path).parts for path in paths]
+    if has_root_folder is None:
+        has_root_folder = bool(split_paths) and len({parts[0] for parts in split_paths}) == 1 and max(
+            len(parts) for parts in split_paths
+        ) >= 5
+    if not has_root_folder:
+        return [str(PurePosixPath(*parts)) for parts in split_paths]
+    return [str(PurePosixPath(*parts[1:])) if len(parts) > 1 else str(PurePosixPath(*parts)) for parts in split_paths]
+
+
+def _member_name(info: zipfile.ZipInfo) -> str:
+    """
+    压缩包成员的文件名：未设置UTF-8标志的成员由zipfile按cp437解码，
+    中文Windows创建的压缩包实际多为GBK编码，按UTF-8、GBK顺序重新解码
+    """
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        raw = name.encode('cp437', errors='replace')
+        for encoding in ('utf-8', 'gbk'):
+            try:
+                name = raw.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+    return name.replace('\\', '/')
+
+
+def extract_archive(archive_path: str, staging_dir: str, has_root_folder: Optional[bool] = None,
+                    max_total_bytes: Optional[int] = None) -> List[Tuple[str, str]]:
+    """
+    解压zip压缩包中的Excel文件
+
+    成员按序号写入staging_dir（不使用压缩包内的路径，避免路径穿越）；解压总大小超过max_total_bytes时拒绝
+
+    Returns:
+        [(库内相对路径, 本地文件路径)]，按相对路径排序
+
+    Raises:
+        ValueError: 不是有效的zip文件或解压后大小超出上限
+    """
+    try:
+        archive = zipfile.ZipFile(archive_path)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"不是有效的zip压缩包: {e}")
+
+    with archive:
+        members = []
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = _member_name(info)
+            if '..' in PurePosixPath(name).parts or name.startswith('/'):
+                continue
+            if is_excel_path(name):
+                members.append((name, info))
+
+        total_bytes = sum(info.file_size for _, info in members)
+        if max_total_bytes is not None and total_bytes > max_total_bytes:
+            raise ValueError(f"压缩包解压后大小 {total_bytes // (1024 * 1024)}MB 超出上限 "
+                             f"{max_total_bytes // (1024 * 1024)}MB")
+
+        relative_paths = strip_root_folder([name for name, _ in members], has_root_folder)
+        sources = []
+        for index, (relative_path, (name, info)) in enumerate(zip(relative_paths, members)):
+            local_path = os.path.join(staging_dir, f"{index:06d}{PurePosixPath(name).suffix.lower()}")
+            with archive.open(info) as source, open(local_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            sources.append((relative_path, local_path))
+
+    return sorted(sources)
+
+
+def build_ingredient_rows(formula_id: int, parsed_ingredients: List[Dict], catalog_lookup: Dict) -> List[Dict]:
+    """
+    由解析出的成分构建成分表记录（与单个上传的规则一致）：按序号分组，
+    同一序号只有一个成分为单配（配料序号为1），多个成分为复配（按出现顺序编号）
+    """
+    ingredient_groups: Dict[int, List[Dict]] = {}
+    for ingredient in parsed_ingredients:
+        ingredient_groups.setdefault(ingredient['sequence'], []).append(ingredient)
+
+    rows = []
+    for seq, group in ingredient_groups.items():
+        for sub_seq, ing in enumerate(group, 1):
+            catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
+            rows.append({
+                'formula_id': formula_id,
+                'ingredient_id': seq,
+                'ingredient_sequence': sub_seq,
+                'standard_chinese_name': ing['chinese_name'],
+                'inci_name': ing['inci_name'] or None,
+                'ingredient_content': ing['percentage'],
+                'catalog_id': catalog_match.catalog_id if catalog_match else None,
+                'component_content': ing.get('ingredient_percentage', 100.0),
+                'actual_component_content': ing.get('actual_percentage', ing['percentage']),
+                'purpose': ing.get('purpose', '').strip() or '未填写'
+            })
+    return rows
+
+
+@dataclass
+class ImportJob:
+    """批量导入任务（计数与失败信息由工作线程逐个文件写入，运行期间可读取）"""
+    job_id: str
+    staging_dir: str
+    archive_path: Optional[str] = None
+    sources: List[Tuple[str, str]] = field(default_factory=list)
+    has_root_folder: Optional[bool] = None
+    user_id: Optional[int] = None
+    created_by: Optional[str] = None
+    status: str = JOB_PENDING
+    phase: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    parsed_count: int = 0
+    parse_cache_hits: int = 0
+    imported_count: int = 0
+    ingredients_count: int = 0
+    catalog_method_counts: Dict[str, int] = field(default_factory=dict)
+    failures: Dict[str, str] = field(default_factory=dict)
+    content_hashes: Dict[str, str] = field(default_factory=dict)
+    same_file_formulas: Dict[str, List[Dict]] = field(default_factory=dict)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    future: Optional[Future] = None
+
+    @property
+    def total_count(self) -> int:
+        return len(self.sources)
+
+    @property
+    def completed_count(self) -> int:
+        return self.imported_count + len(self.failures)
+
+    def to_dict(self) -> Dict:
+        """任务状态、进度与逐个文件的失败原因"""
+        total_count = self.total_count
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "phase": self.phase,
+            "created_by": self.created_by,
+            "total_count": total_count,
+            "parsed_count": self.parsed_count,
+            "parse_cache_hits": self.parse_cache_hits,
+            "completed_count": self.completed_count,
+            "imported_count": self.imported_count,
+            "failed_count": len(self.failures),
+            "ingredients_count": self.ingredients_count,
+            "progress": round(self.completed_count / total_count, 4) if total_count else (
+                1.0 if self.status in FINISHED_JOB_STATUSES else 0.0),
+            "catalog_method_counts": dict(self.catalog_method_counts),
+            "failures": [{"path": path, "error": message} for path, message in list(self.failures.items())],
+            "same_file_formulas": [{"path": path, "formulas": formulas}
+                                   for path, formulas in list(self.same_file_formulas.items())],
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class FormulaImportManager:
+    """
+    批量导入任务管理器（线程安全）
+
+    导入任务逐个执行（同名校验依赖已提交的数据，并发导入会互相漏检），单个任务内部由进程池并行解析；
+    已结束的任务超过max_finished_jobs时按创建时间淘汰
+    """
+
+    def __init__(self, matching_engine, session_factory: Callable, catalog_resolver_factory: Callable,
+                 parse_cache=None, parse_workers: int = 1, parse_timeout: Optional[float] = None,
+                 parse_max_memory_mb: Optional[int] = None, batch_size: int = 200,
+                 max_archive_bytes: Optional[int] = None, max_finished_jobs: int = 50):
+        """
+        Args:
+            matching_engine: DualLibraryMatchingEngine实例
+            session_factory: 创建数据库会话的工厂（工作线程使用独立会话）
+            catalog_resolver_factory: 由数据库会话获取原料目录解析器
+            parse_cache: 按文件内容指纹缓存的解析结果（ParseResultCache），只读取不写入
+            parse_workers: 并行解析的工作进程数
+            parse_timeout: 单个文件的解析超时（秒）
+            parse_max_memory_mb: 单个解析进程的内存上限（MB）
+            batch_size: 每批写入的配方数量
+            max_archive_bytes: 压缩包解压后的大小上限
+            max_finished_jobs: 保留的已结束任务数量上限
+        """
+        self.matching_engine = matching_engine
+        self.session_factory = session_factory
+        self.catalog_resolver_factory = catalog_resolver_factory
+        self.parse_cache = parse_cache
+        self.parse_workers = max(1, parse_workers)
+        self.parse_timeout = parse_timeout
+        self.parse_max_memory_mb = parse_max_memory_mb
+        self.batch_size = max(1, batch_size)
+        self.max_archive_bytes = max_archive_bytes
+        self.max_finished_jobs = max_finished_jobs
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='formula-import')
+        self._jobs: Dict[str, ImportJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, staging_dir: str, archive_path: Optional[str] = None,
+               sources: Optional[List[Tuple[str, str]]] = None, has_root_folder: Optional[bool] = None,
+               user_id: Optional[int] = None, created_by: Optional[str] = None) -> ImportJob:
+        """
+        提交导入任务（任务结束后删除staging_dir）
+
+        Args:
+            staging_dir: 存放上传文件的临时目录，归任务所有
+            archive_path: zip压缩包路径（由任务解压）
+            sources: 已保存的文件 [(相对路径, 本地文件路径)]，相对路径可带主文件夹
+            has_root_folder: 路径是否带主文件夹，None为自动判断
+        """
+        if sources:
+            relative_paths = strip_root_folder([path for path, _ in sources], has_root_folder)
+            sources = sorted(zip(relative_paths, [local_path for _, local_path in sources]))
+        job = ImportJob(
+            job_id=uuid.uuid4().hex,
+            staging_dir=staging_dir,
+            archive_path=archive_path,
+            sources=sources or [],
+            has_root_folder=has_root_folder,
+            user_id=user_id,
+            created_by=created_by
+        )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune_finished_jobs()
+        job.future = self._executor.submit(self._run_job, job)
+        logger.info(f"提交批量导入任务 {job.job_id}: "
+                    f"{'压缩包' if archive_path else f'{len(job.sources)} 个文件'}")
+        return job
+
+    def get(self, job_id: str) -> Optional[ImportJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[ImportJob]:
+        """全部任务（按创建时间倒序）"""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[ImportJob]:
+        """取消任务：排队中的任务直接取消；运行中的任务停止解析，已写入的配方保留"""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED_JOB_STATUSES:
+            return job
+
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            shutil.rmtree(job.staging_dir, ignore_errors=True)
+        logger.info(f"取消批量导入任务 {job_id}")
+        return job
+
+    def shutdown(self):
+        """取消排队中的任务并等待运行中的任务停止"""
+        for job in self.list_jobs():
+            job.cancel_event.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for job in self.list_jobs():
+            if job.status == JOB_PENDING:
+                shutil.rmtree(job.staging_dir, ignore_errors=True)
+
+    def _prune_finished_jobs(self):
+        """淘汰最早创建的已结束任务（调用方持有锁）"""
+        finished = sorted((job for job in self._jobs.values() if job.status in FINISHED_JOB_STATUSES),
+                          key=lambda job: job.created_at)
+        for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job.job_id]
+
+    def _run_job(self, job: ImportJob):
+        """工作线程：解压、同名校验、并行解析并按批次写入"""
+        if job.cancel_event.is_set():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            shutil.rmtree(job.staging_dir, ignore_errors=True)
+            return
+
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        try:
+            if job.archive_path:
+                job.phase = PHASE_EXTRACTING
+                job.sources = extract_archive(job.archive_path, job.staging_dir, job.has_root_folder,
+                                              self.max_archive_bytes)
+                os.unlink(job.archive_path)
+            job.phase = PHASE_IMPORTING
+
+            with self.session_factory() as session:
+                pending = self._resolve_formula_infos(session, job)
+                self._import_files(session, job, pending)
+
+            cancelled = job.cancel_event.is_set() and job.completed_count < job.total_count
+            job.status = JOB_CANCELLED if cancelled else JOB_COMPLETED
+        except Exception as e:
+            logger.error(f"批量导入任务 {job.job_id} 执行失败: {e}")
+            job.status = JOB_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            shutil.rmtree(job.staging_dir, ignore_errors=True)
+            logger.info(f"批量导入任务 {job.job_id} 结束: {job.status}, "
+                        f"导入 {job.imported_count} 个, 失败 {len(job.failures)} 个")
+
+    def _resolve_formula_infos(self, session, job: ImportJob) -> List[Tuple[str, str, Tuple[str, str, str]]]:
+        """
+        由路径得到各文件的配方信息并做同名校验（参考配方库中已存在、压缩包内重复的配方记为失败）
+
+        Returns:
+            待解析的 [(相对路径, 本地文件路径, (客户, 产品类型, 配方名称))]
+        """
+        candidates = []
+        for relative_path, local_path in job.sources:
+            try:
+                candidates.append((relative_path, local_path, parse_library_path(relative_path)))
+            except ValueError as e:
+                job.failures[relative_path] = str(e)
+
+        names = list(dict.fromkeys(info[2] for _, _, info in candidates))
+        existing_names = set()
+        for start in range(0, len(names), NAME_QUERY_CHUNK):
+            existing_names.update(row[0] for row in session.query(Formulas.formula_name).filter(
+                Formulas.formula_name.in_(names[start:start + NAME_QUERY_CHUNK])
+            ).all())
+
+        pending = []
+        seen_paths: Dict[str, str] = {}
+        for relative_path, local_path, info in candidates:
+            formula_name = info[2]
+            if formula_name in existing_names:
+                job.failures[relative_path] = f"参考配方库中已存在名为 '{formula_name}' 的配方"
+            elif formula_name in seen_paths:
+                job.failures[relative_path] = f"与 {seen_paths[formula_name]} 配方名称重复"
+            else:
+                seen_paths[formula_name] = relative_path
+                pending.append((relative_path, local_path, info))
+        return pending
+
+    def _import_files(self, session, job: ImportJob, pending: List[Tuple[str, str, Tuple[str, str, str]]]):
+        """
+        内容与已解析文件相同的直接使用缓存的解析结果，其余文件并行解析；解析成功的配方每满batch_size个写入一批
+        （批量导入的解析结果不写入缓存，避免大量文件挤出单个上传的缓存条目）
+        """
+        to_parse = []
+        batch = []
+        for relative_path, local_path, info in pending:
+            with open(local_path, 'rb') as source:
+                content_hash = file_content_hash(source.read())
+            job.content_hashes[relative_path] = content_hash
+            cached_result = self.parse_cache.get(content_hash) if self.parse_cache is not None else None
+            if cached_result is not None:
+                job.parsed_count += 1
+                job.parse_cache_hits += 1
+                batch.append((relative_path, info, cached_result))
+            else:
+                to_parse.append((relative_path, local_path, info))
+
+        # 参考配方库与待匹配配方库中由相同内容文件创建的配方
+        existing = DualFormulaLibraryHandler.find_formulas_by_source_hashes(
+            session, list(dict.fromkeys(job.content_hashes.values()))
+        )
+        for relative_path, content_hash in job.content_hashes.items():
+            if content_hash in existing:
+                job.same_file_formulas[relative_path] = existing[content_hash]
+
+        parser = FormulaParser()
+        outcomes = parser.iter_parse_files([local_path for _, local_path, _ in to_parse], workers=self.parse_workers,
+                                           timeout=self.parse_timeout, max_memory_mb=self.parse_max_memory_mb)
+        try:
+            while len(batch) >= self.batch_size:
+                self._write_batch(session, job, batch[:self.batch_size])
+                batch = batch[self.batch_size:]
+            for outcome in outcomes:
+                relative_path, _, info = to_parse[outcome['index']]
+                job.parsed_count += 1
+                if not outcome['success']:
+                    job.failures[relative_path] = outcome['error']
+                    continue
+                batch.append((relative_path, info, outcome['result']))
+                if len(batch) >= self.batch_size:
+                    self._write_batch(session, job, batch)
+                    batch = []
+                if job.cancel_event.is_set():
+                    break
+        finally:
+            # 提前结束时关闭生成器，停止进程池中未开始的解析
+            outcomes.close()
+
+        if batch:
+            self._write_batch(session, job, batch)
+
+    def _write_batch(self, session, job: ImportJob, batch: List[Tuple[str, Tuple[str, str, str], Dict]]):
+        """一批配方：一次解析原料目录，批量写入配方与成分，提交后计算匹配特征并增量更新匹配索引"""
+        catalog_resolver = self.catalog_resolver_factory(session)
+        catalog_keys = list(dict.fromkeys(
+            (ing['chinese_name'], ing['inci_name'])
+            for _, _, parsed_result in batch for ing in parsed_result['ingredients']
+        ))
+        catalog_matches = catalog_resolver.resolve_many(catalog_keys)
+        catalog_lookup = dict(zip(catalog_keys, catalog_matches))
+
+        # 配方需要取得自增ID，逐行插入但只刷新一次；成分行数是配方的数十倍，使用批量插入
+        formulas = [
+            Formulas(formula_name=formula_name, product_type=product_type, customer=customer, user_id=job.user_id)
+            for _, (customer, product_type, formula_name), _ in batch
+        ]
+        try:
+            session.add_all(formulas)
+            session.flush()
+            ingredient_rows = []
+            for formula, (_, _, parsed_result) in zip(formulas, batch):
+                ingredient_rows.extend(build_ingredient_rows(formula.id, parsed_result['ingredients'], catalog_lookup))
+            session.bulk_insert_mappings(FormulaIngredients, ingredient_rows)
+            DualFormulaLibraryHandler.save_source_files(session, 'reference', {
+                formula.id: (job.content_hashes[relative_path], PurePosixPath(relative_path).name)
+                for formula, (relative_path, _, _) in zip(formulas, batch)
+            })
+            DualFormulaLibraryHandler.bump_library_version(session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"批量导入任务 {job.job_id} 写入失败: {e}")
+            for relative_path, _, _ in batch:
+                job.failures[relative_path] = f"写入数据库失败: {e}"
+            return
+
+        formula_ids = [formula.id for formula in formulas]
+        self.matching_engine.refresh_match_features(session, formula_ids, 'reference')
+        self.matching_engine.apply_library_changes(session, upserted_ids=formula_ids)
+
+        job.imported_count += len(batch)
+        job.ingredients_count += len(ingredient_rows)
+        for _, _, parsed_result in batch:
+            for ing in parsed_result['ingredients']:
+                catalog_match = catalog_lookup[(ing['chinese_name'], ing['inci_name'])]
+                method = catalog_match.method if catalog_match else 'unmatched'
+                job.catalog_method_counts[method] = job.catalog_method_counts.get(method, 0) + 1
+        logger.info(f"批量导入任务 {job.job_id}: 写入 {len(batch)} 个配方, {len(ingredient_rows)} 个成分")
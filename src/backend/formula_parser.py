@@ -7,20 +7,68 @@
 
 import pandas as pd
 import numpy as np
+import hashlib
+import multiprocessing
 import os
 import re
-from typing import Dict, List, Optional, Tuple
+import signal
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 from pathlib import Path
 import logging
 
+from openpyxl import load_workbook
+
 logger = logging.getLogger(__name__)
 
+# 在前多少行中查找表头
+HEADER_SEARCH_ROWS = 10
+
+# 流式解析时每次按列提取成分的行数
+EXTRACTION_CHUNK_ROWS = 4096
+
+# 并行解析进程池的启动方式：forkserver/spawn不继承父进程的线程与锁，可在Web服务进程中安全使用；
+# forkserver预先导入解析模块，工作进程无需重复导入pandas等依赖（不支持的平台使用spawn）
+PARSE_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# 读取单元格时视为缺失值的字符串（与pd.read_excel默认的na_values及Excel错误值一致）
+_MISSING_CELL_STRINGS = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+    'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+    '#DIV/0!', '#NAME?', '#NULL!', '#NUM!', '#REF!', '#VALUE!'
+])
+
+# pandas读取Excel时可转换为布尔值的字符串（与pd.read_excel默认的true_values/false_values一致）
+_BOOLEAN_CELL_STRINGS = frozenset(['True', 'TRUE', 'true', 'False', 'FALSE', 'false'])
+
 
 class FormulaParser:
-    """配方表解析器"""
+    """
+    配方表解析器
+
+    .xlsx文件默认使用流式模式：以只读方式逐行读取工作簿一次，在前几行中识别表头后逐行解析成分，
+    内存占用与工作表行数无关；.xls文件及关闭流式模式时使用pandas读取整个工作表
+    """
+
+    # 表头指纹 → 列映射缓存（所有解析器实例共享，重复出现的配方表模板跳过列名识别）
+    COLUMN_MAPPING_CACHE_SIZE = 256
+    _column_mapping_cache: 'OrderedDict[Tuple[str, ...], Dict[str, int]]' = OrderedDict()
+    _column_mapping_cache_lock = threading.Lock()
+
+    def __init__(self, streaming: bool = True):
+        """
+        初始化解析器
+
+        Args:
+            streaming: 是否以流式模式解析.xlsx文件
+        """
+        self.streaming = streaming
 
-    def __init__(self):
-        """初始化解析器"""
         # 支持的文件格式
         self.supported_formats = ['.xlsx', '.xls']
 
@@ -42,6 +90,13 @@ class FormulaParser:
             'notes': ['备注', '说明', '注释', 'remark']
         }
 
+        # 复配关键词
+        self.compound_keywords = [
+            '复配', '混合', '组合', '复合', '体系', '配方',
+            '多元', '综合', '复方', '混配'
+        ]
+        self._compound_pattern = re.compile('|'.join(re.escape(keyword) for keyword in self.compound_keywords))
+
     def parse_file(self, file_path: str) -> Dict:
         """
         解析配方表文件
@@ -59,22 +114,13 @@ class FormulaParser:
             if not self._validate_file(file_path):
                 raise ValueError(f"不支持的文件格式或文件不存在: {file_path}")
 
-            # 读取Excel文件
-            raw_data = self._read_excel_file(file_path)
-
-            # 查找表头行
-            header_row = self._find_header_row(raw_data)
-            if header_row is None:
-                raise ValueError("无法找到有效的表头行")
-
-            # 重新读取数据并设置表头
-            df = pd.read_excel(file_path, header=header_row)
-
-            # 提取配方名称
-            formula_name = self._extract_formula_name(raw_data, file_path)
-
-            # 解析成分数据
-            ingredients = self._parse_ingredients(df)
+            parsed = None
+            if self.streaming and Path(file_path).suffix.lower() == '.xlsx':
+                # 流式读取工作簿一次，同时完成表头识别、配方名称提取与成分解析
+                parsed = self._parse_xlsx_streaming(file_path)
+            if parsed is None:
+                parsed = self._parse_with_pandas(file_path)
+            header_row, formula_name, ingredients = parsed
 
             # 数据验证
             validation_result = self._validate_ingredients(ingredients)
@@ -95,26 +141,59 @@ class FormulaParser:
             logger.error(f"配方表解析失败: {e}")
             raise
 
-    def parse_multiple_files(self, file_paths: List[str]) -> List[Dict]:
+    def parse_content(self, content: bytes, suffix: str, cache=None) -> Tuple[str, Dict, bool]:
+        """
+        解析上传的文件内容，按内容指纹缓存解析结果
+
+        提供cache（ParseResultCache）时先按内容指纹查找，命中则不写临时文件也不解析；
+        未命中时写入临时文件解析，解析成功的结果写入缓存
+
+        Args:
+            content: 文件内容
+            suffix: 文件扩展名（.xlsx/.xls）
+            cache: 解析结果缓存
+
+        Returns:
+            (内容指纹, 解析结果, 是否命中缓存)
+        """
+        content_hash = file_content_hash(content)
+        if cache is not None:
+            cached_result = cache.get(content_hash)
+            if cached_result is not None:
+                logger.info(f"配方表内容与已解析的文件相同，使用缓存的解析结果: {content_hash[:12]}")
+                return content_hash, cached_result, True
+
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+            tmp_file.write(content)
+            tmp_path = tmp_file.name
+        try:
+            result = self.parse_file(tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+        if cache is not None:
+            cache.put(content_hash, result)
+        return content_hash, result, False
+
+    def parse_multiple_files(self, file_paths: List[str], workers: int = 1, timeout: Optional[float] = None,
+                             max_memory_mb: Optional[int] = None) -> Dict:
         """
         批量解析多个配方表文件
         
         Args:
             file_paths: 文件路径列表
+            workers: 并行解析的工作进程数，1为在当前进程中逐个解析
+            timeout: 并行模式下单个文件的解析超时（秒）
+            max_memory_mb: 并行模式下单个工作进程的内存上限（MB）
             
         Returns:
-            解析结果列表
+            解析结果汇总（成功与失败的文件均按输入顺序排列）
         """
-        results = []
-        failed_files = []
-
-        for file_path in file_paths:
-            try:
-                result = self.parse_file(file_path)
-                results.append(result)
-            except Exception as e:
-                logger.error(f"文件解析失败 {file_path}: {e}")
-                failed_files.append({'file_path': file_path, 'error': str(e)})
+        outcomes = sorted(self.iter_parse_files(file_paths, workers, timeout, max_memory_mb),
+                          key=lambda outcome: outcome['index'])
+        results = [outcome['result'] for outcome in outcomes if outcome['success']]
+        failed_files = [{'file_path': outcome['file_path'], 'error': outcome['error']}
+                        for outcome in outcomes if not outcome['success']]
 
         logger.info(f"批量解析完成: 成功{len(results)}个, 失败{len(failed_files)}个")
 
@@ -126,6 +205,71 @@ class FormulaParser:
             'failure_count': len(failed_files)
         }
 
+    def iter_parse_files(self, file_paths: Sequence[str], workers: int = 1, timeout: Optional[float] = None,
+                         max_memory_mb: Optional[int] = None) -> Iterator[Dict]:
+        """
+        逐个返回文件解析结果（并行模式下按完成顺序返回，每个文件解析完成后立即可用）
+
+        workers大于1时使用进程池并行解析（pandas与openpyxl的解析受GIL限制，线程无法并行）。
+        超时与内存上限只在并行模式下生效：超时由工作进程内的定时信号中断解析，内存上限通过限制
+        工作进程的地址空间使超限分配失败；工作进程意外退出时，未完成的文件逐个在独立进程中重试
+
+        Yields:
+            {'index': 输入序号, 'file_path': 文件路径, 'success': 是否成功, 'result': 解析结果} 或
+            {'index': 输入序号, 'file_path': 文件路径, 'success': False, 'error': 错误信息}
+        """
+        if workers <= 1 or len(file_paths) <= 1:
+            for index, file_path in enumerate(file_paths):
+                try:
+                    yield _parse_outcome(index, file_path, result=self.parse_file(file_path))
+                except Exception as e:
+                    logger.error(f"文件解析失败 {file_path}: {e}")
+                    yield _parse_outcome(index, file_path, error=str(e))
+            return
+
+        context = multiprocessing.get_context(PARSE_POOL_START_METHOD)
+        if PARSE_POOL_START_METHOD == 'forkserver':
+            context.set_forkserver_preload([__name__])
+        pending = list(enumerate(file_paths))
+        isolated = False
+        while pending:
+            # 首轮按workers并行；进程池崩溃后剩余文件每个使用单独的进程池，定位导致崩溃的文件
+            batches = [pending] if not isolated else [[item] for item in pending]
+            pending = []
+            for batch in batches:
+                executor = ProcessPoolExecutor(max_workers=1 if isolated else min(workers, len(batch)),
+                                               mp_context=context, initializer=_init_parse_worker,
+                                               initargs=(max_memory_mb,))
+                futures = {
+                    executor.submit(_parse_file_in_worker, file_path, self.streaming, timeout): (index, file_path)
+                    for index, file_path in batch
+                }
+                try:
+                    for future in as_completed(futures):
+                        index, file_path = futures.pop(future)
+                        try:
+                            yield _parse_outcome(index, file_path, result=future.result())
+                        except BrokenProcessPool:
+                            futures[future] = (index, file_path)
+                            raise
+                        except MemoryError:
+                            logger.error(f"文件解析失败 {file_path}: 内存超出上限")
+                            yield _parse_outcome(index, file_path, error=f"解析内存超出上限（{max_memory_mb}MB）")
+                        except Exception as e:
+                            logger.error(f"文件解析失败 {file_path}: {e}")
+                            yield _parse_outcome(index, file_path, error=str(e) or type(e).__name__)
+                except BrokenProcessPool:
+                    if isolated:
+                        index, file_path = batch[0]
+                        logger.error(f"文件解析失败 {file_path}: 解析进程意外退出")
+                        yield _parse_outcome(index, file_path, error="解析进程意外退出")
+                    else:
+                        logger.warning(f"解析进程意外退出，{len(futures)} 个未完成的文件将逐个重试")
+                        pending = sorted(futures.values())
+                finally:
+                    executor.shutdown(wait=True, cancel_futures=True)
+            isolated = True
+
     def _validate_file(self, file_path: str) -> bool:
         """验证文件是否有效"""
         if not os.path.exists(file_path):
@@ -143,30 +287,258 @@ class FormulaParser:
             logger.error(f"读取Excel文件失败: {e}")
             raise
 
-    def _find_header_row(self, df: pd.DataFrame) -> Optional[int]:
-        """查找表头行"""
-        for i in range(min(10, len(df))):  # 只在前10行查找
-            row_text = ""
-            for j in range(min(8, len(df.columns))):
-                cell = df.iloc[i, j]
-                if pd.notna(cell):
-                    row_text += str(cell).lower() + " "
+    def _parse_with_pandas(self, file_path: str) -> Tuple[int, str, List[Dict]]:
+        """
+        使用pandas读取整个工作表并解析
+
+        Returns:
+            (表头行号, 配方名称, 成分列表)
+        """
+        # 读取Excel文件
+        raw_data = self._read_excel_file(file_path)
+
+        # 查找表头行
+        header_row = self._find_header_row(raw_data)
+        if header_row is None:
+            raise ValueError("无法找到有效的表头行")
+
+        # 重新读取数据并设置表头
+        df = pd.read_excel(file_path, header=header_row)
+
+        # 提取配方名称
+        formula_name = self._extract_formula_name(raw_data, file_path)
+
+        # 解析成分数据
+        ingredients = self._parse_ingredients(df)
+        return header_row, formula_name, ingredients
+
+    def _parse_xlsx_streaming(self, file_path: str) -> Optional[Tuple[int, str, List[Dict]]]:
+        """
+        流式解析.xlsx文件（只读模式逐行读取，工作簿只打开一次）
+
+        行号、空行、单元格值与合并单元格（向前填充、空序号沿用前面最近的数字序号，跨块延续）的处理与pandas模式一致，
+        object列中相等的值（1与True、0与False）与pandas一样统一为先出现的值。
+        pandas按整列推断类型，流式读取只能逐个单元格转换：读取时记录成分相关列中出现的单元格类型，
+        整列会被pandas转换为数值或布尔值、且转换会改变解析结果时（如数值列中的布尔值、含空值的数值列中作为文本使用的整数）
+        返回None，由调用方改用pandas模式解析，保证两种模式的解析结果相同
+
+        Returns:
+            (表头行号, 配方名称, 成分列表)，需要改用pandas模式时为None
+        """
+        try:
+            workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+        except Exception as e:
+            logger.error(f"读取Excel文件失败: {e}")
+            raise
+
+        try:
+            rows = self._iter_sheet_rows(workbook.worksheets[0])
+
+            # 在前几行中查找表头，表头之前的行只用于提取配方名称
+            leading_rows = []
+            header_row = None
+            for row in rows:
+                leading_rows.append(row)
+                if self._is_header_row(row):
+                    header_row = len(leading_rows) - 1
+                    break
+                if len(leading_rows) >= HEADER_SEARCH_ROWS:
+                    break
+            if header_row is None:
+                raise ValueError("无法找到有效的表头行")
+
+            header = leading_rows[header_row]
+            column_mapping = self._get_column_mapping(
+                [f"Unnamed: {j}" if cell is None else cell for j, cell in enumerate(header)]
+            )
+
+            # 成分相关列 → 是否作为文本使用（序号列与含量列只按数值解析）
+            text_columns = {column_mapping.get(field, default) for field, default in
+                            (('chinese_name', 1), ('inci_name', 2), ('purpose', 6), ('notes', 7))}
+            numeric_columns = {0} | {column_mapping.get(field, default) for field, default in
+                                     (('percentage', 3), ('ingredient_percentage', 4), ('actual_percentage', 5))}
+            column_kinds = {j: set() for j in text_columns | numeric_columns}
+            column_counts = dict.fromkeys(column_kinds, 0)
+            # pandas读取object列时相等的值统一为先出现的值（1与True、0与False），逐列记录先出现的值
+            column_first_values = {j: {} for j in column_kinds}
+            row_count = 0
+
+            # 配方名称取自前5行（表头较靠前时包含表头后的成分行）
+            def data_rows() -> Iterator[tuple]:
+                nonlocal row_count
+                for row in rows:
+                    if len(leading_rows) < 5:
+                        leading_rows.append(row)
+                    row_count += 1
+                    for j, kinds in column_kinds.items():
+                        if j < len(row) and row[j] is not None:
+                            value = row[j]
+                            column_counts[j] += 1
+                            kinds.add(self._cell_kind(value))
+                            if isinstance(value, int) and value in (0, 1):
+                                first_value = column_first_values[j].setdefault(value, value)
+                                if type(first_value) is not type(value):
+                                    row = row[:j] + (first_value,) + row[j + 1:]
+                    yield row
+
+            # 向前填充后按块组成DataFrame按列提取成分，内存占用以块大小为界
+            ingredients = []
+            previous_sequence = None
+            chunk = []
+            for row in self._forward_fill_rows(data_rows()):
+                chunk.append(row)
+                if len(chunk) >= EXTRACTION_CHUNK_ROWS:
+                    chunk_ingredients, previous_sequence = self._extract_chunk(chunk, column_mapping, previous_sequence)
+                    ingredients.extend(chunk_ingredients)
+                    chunk = []
+            if chunk:
+                ingredients.extend(self._extract_chunk(chunk, column_mapping, previous_sequence)[0])
+
+            for j, kinds in column_kinds.items():
+                if self._pandas_converts_column(kinds, column_counts[j] < row_count, j in text_columns):
+                    logger.info(f"第{j + 1}列的取值会被pandas按整列类型转换，改用pandas模式解析: {file_path}")
+                    return None
+
+            formula_name = self._extract_formula_name(leading_rows, file_path)
+            return header_row, formula_name, ingredients
+        finally:
+            workbook.close()
+
+    def _extract_chunk(self, chunk: List[tuple], column_mapping: Dict[str, int],
+                       previous_sequence=None) -> Tuple[List[Dict], object]:
+        """
+        从流式读取的一块已向前填充的行中提取成分（空序号沿用的数字序号可来自前面的块）
+
+        Returns:
+            (成分列表, 本块结束时最近的数字序号)
+        """
+        df = pd.DataFrame(chunk, dtype=object)
+        previous_sequence = self._fill_blank_sequences(df, previous_sequence)
+        return self._extract_ingredients(df, column_mapping), previous_sequence
+
+    @staticmethod
+    def _cell_kind(value) -> str:
+        """单元格值在pandas整列类型推断中的类别"""
+        if isinstance(value, bool):
+            return 'bool'
+        if isinstance(value, int):
+            return 'int'
+        if isinstance(value, float):
+            return 'int' if value.is_integer() else 'float'
+        if isinstance(value, str):
+            if value in _BOOLEAN_CELL_STRINGS:
+                return 'bool_text'
+            try:
+                float(value)
+                return 'numeric_text'
+            except ValueError:
+                return 'text'
+        if isinstance(value, (datetime, date, time)):
+            return 'datetime'
+        return 'text'
+
+    @staticmethod
+    def _pandas_converts_column(kinds: set, has_missing: bool, text_column: bool) -> bool:
+        """
+        pandas按整列推断类型后，该列的取值是否与逐个单元格读取的值不同且会改变解析结果
+
+        Args:
+            kinds: 列中非空单元格的类别（_cell_kind）
+            has_missing: 列中是否有空单元格（含空行与较短的行）
+            text_column: 该列是否作为文本使用（序号列与含量列只按数值解析，整数与浮点数的差异不影响结果）
+        """
+        if not kinds or 'text' in kinds:
+            # 含普通文本的列保持object类型，单元格值不变
+            return False
+        if kinds <= {'bool', 'bool_text'}:
+            # 全为布尔值时为bool类型；含布尔字符串或空值时转换为布尔值或数值
+            return kinds != {'bool'} or has_missing
+        if kinds <= {'int', 'float', 'bool', 'numeric_text'}:
+            # 数值列：布尔值转为1/0；作为文本使用时数字字符串按数值格式化，含空值或小数时整数格式化为浮点数
+            if 'bool' in kinds:
+                return True
+            return text_column and ('numeric_text' in kinds or ('int' in kinds and (has_missing or 'float' in kinds)))
+        if kinds == {'datetime'}:
+            # 日期时间列转换为datetime64，作为文本使用时格式可能不同
+            return text_column
+        # 类别混合的列保持object类型
+        return False
+
+    @staticmethod
+    def _iter_sheet_rows(sheet) -> Iterator[tuple]:
+        """
+        逐行读取工作表的单元格值，行号与pandas读取Excel时一致：中间的空行保留为空元组，工作表末尾的空行丢弃；
+        单元格值按pandas的方式转换：空值、缺失值字符串与Excel错误值为None，整数值的浮点数转为int
+        """
+        pending_blank_rows = 0
+        for values in sheet.iter_rows(values_only=True):
+            end = len(values)
+            while end and (values[end - 1] is None or values[end - 1] == ''):
+                end -= 1
+            if end == 0:
+                pending_blank_rows += 1
+                continue
 
-            # 检查是否包含表头关键词
-            keyword_count = sum(1 for keyword in self.header_keywords
-                                if keyword.lower() in row_text)
+            for _ in range(pending_blank_rows):
+                yield ()
+            pending_blank_rows = 0
+
+            row = []
+            for value in values[:end]:
+                if isinstance(value, str):
+                    if value in _MISSING_CELL_STRINGS:
+                        value = None
+                elif isinstance(value, float):
+                    if np.isnan(value):
+                        value = None
+                    elif value.is_integer():
+                        value = int(value)
+                row.append(value)
+            yield tuple(row)
+
+    @staticmethod
+    def _forward_fill_rows(rows: Iterable[Sequence]) -> Iterator[tuple]:
+        """逐行向前填充缺失值（合并单元格的典型模式），与_handle_merged_cells按列填充的结果一致"""
+        last_values: List = []
+        for row in rows:
+            filled = []
+            for j in range(max(len(row), len(last_values))):
+                value = row[j] if j < len(row) else None
+                if value is None:
+                    value = last_values[j] if j < len(last_values) else None
+                filled.append(value)
+            last_values = filled
+            yield tuple(filled)
 
-            if keyword_count >= 3:  # 至少包含3个关键词
+    def _find_header_row(self, df: pd.DataFrame) -> Optional[int]:
+        """查找表头行"""
+        for i, row in enumerate(df.head(HEADER_SEARCH_ROWS).itertuples(index=False, name=None)):
+            if self._is_header_row(row):
                 return i
 
         return None
 
-    def _extract_formula_name(self, raw_data: pd.DataFrame, file_path: str) -> str:
-        """提取配方名称"""
+    def _is_header_row(self, row: Sequence) -> bool:
+        """判断是否为表头行（前8列至少包含3个表头关键词）"""
+        row_text = ""
+        for cell in row[:8]:
+            if pd.notna(cell):
+                row_text += str(cell).lower() + " "
+
+        # 检查是否包含表头关键词
+        keyword_count = sum(1 for keyword in self.header_keywords
+                            if keyword.lower() in row_text)
+
+        return keyword_count >= 3  # 至少包含3个关键词
+
+    def _extract_formula_name(self, raw_data, file_path: str) -> str:
+        """提取配方名称（raw_data为不设表头读取的DataFrame或前几行的单元格值）"""
+        if isinstance(raw_data, pd.DataFrame):
+            raw_data = list(raw_data.head(5).itertuples(index=False, name=None))
+
         # 尝试从前几行中提取配方名称
-        for i in range(min(5, len(raw_data))):
-            for j in range(min(3, len(raw_data.columns))):
-                cell = raw_data.iloc[i, j]
+        for row in raw_data[:5]:
+            for cell in row[:3]:
                 if pd.notna(cell):
                     cell_str = str(cell).strip()
                     # 如果包含"配方"、"产品"等关键词，且长度合适
@@ -178,54 +550,149 @@ class FormulaParser:
 
     def _parse_ingredients(self, df: pd.DataFrame) -> List[Dict]:
         """解析成分数据"""
-        ingredients = []
-
         # 处理合并单元格的NaN值 - 向前填充
         df_processed = self._handle_merged_cells(df)
 
         # 映射列名
-        column_mapping = self._map_columns(df_processed.columns)
+        column_mapping = self._get_column_mapping(df_processed.columns)
 
-        for idx, row in df_processed.iterrows():
-            try:
-                # 检查第一列是否为序号
-                seq_val = row.iloc[0]
-                if pd.notna(seq_val):
-                    seq_str = str(seq_val).strip()
-                    # 检查是否为数字（整数或浮点数）
-                    if self._is_number(seq_str):
-                        sequence = int(float(seq_str))
-
-                        # 提取其他字段
-                        chinese_name = self._safe_extract_text(row, column_mapping.get('chinese_name', 1))
-                        inci_name = self._safe_extract_text(row, column_mapping.get('inci_name', 2))
-                        percentage = self._extract_percentage(row, column_mapping.get('percentage', 3))
-                        ingredient_percentage = self._extract_percentage(row,
-                                                                         column_mapping.get('ingredient_percentage', 4))
-                        actual_percentage = self._extract_percentage(row, column_mapping.get('actual_percentage', 5))
-                        purpose = self._safe_extract_text(row, column_mapping.get('purpose', 6))
-                        notes = self._safe_extract_text(row, column_mapping.get('notes', 7))
-
-                        # 只添加有中文名称的成分
-                        if chinese_name and chinese_name.lower() not in ['nan', '', '无']:
-                            ingredient = {
-                                'sequence': sequence,
-                                'chinese_name': chinese_name,
-                                'inci_name': inci_name,
-                                'percentage': percentage,
-                                'ingredient_percentage': ingredient_percentage,
-                                'actual_percentage': actual_percentage,
-                                'purpose': purpose,
-                                'notes': notes,
-                                'is_compound': self._detect_compound(chinese_name, inci_name, purpose)
-                            }
-                            ingredients.append(ingredient)
-
-            except Exception as e:
-                logger.warning(f"解析第{idx}行时出错: {e}")
-                continue
+        return self._extract_ingredients(df_processed, column_mapping)
+
+    def _extract_ingredients(self, df: pd.DataFrame, column_mapping: Dict[str, int]) -> List[Dict]:
+        """
+        从已向前填充的数据中按列提取成分：序号、文本与含量整列转换（相同的单元格文本只解析一次），
+        筛选第一列为数字序号且有中文名称的行后按列检测复配
+        """
+        if df.empty:
+            return []
+
+        # 检查第一列是否为序号（整数或浮点数）
+        sequences = self._sequence_column(df.iloc[:, 0])
+
+        # 提取其他字段
+        chinese_names = self._text_column(df, column_mapping.get('chinese_name', 1))
+
+        # 只添加有序号和中文名称的成分
+        valid_names = ~pd.Series(chinese_names).str.lower().isin(['nan', '', '无']).to_numpy()
+        rows = np.flatnonzero(pd.notna(sequences) & valid_names)
+        if not len(rows):
+            return []
+        df = df.iloc[rows]
+
+        chinese_names = chinese_names[rows]
+        inci_names = self._text_column(df, column_mapping.get('inci_name', 2))
+        purposes = self._text_column(df, column_mapping.get('purpose', 6))
+        columns = zip(
+            sequences[rows].tolist(),
+            chinese_names.tolist(),
+            inci_names.tolist(),
+            self._percentage_column(df, column_mapping.get('percentage', 3)).tolist(),
+            self._percentage_column(df, column_mapping.get('ingredient_percentage', 4)).tolist(),
+            self._percentage_column(df, column_mapping.get('actual_percentage', 5)).tolist(),
+            purposes.tolist(),
+            self._text_column(df, column_mapping.get('notes', 7)).tolist(),
+            self._compound_column(chinese_names, inci_names, purposes).tolist()
+        )
+        return [
+            {
+                'sequence': sequence,
+                'chinese_name': chinese_name,
+                'inci_name': inci_name,
+                'percentage': percentage,
+                'ingredient_percentage': ingredient_percentage,
+                'actual_percentage': actual_percentage,
+                'purpose': purpose,
+                'notes': notes,
+                'is_compound': is_compound
+            }
+            for (sequence, chinese_name, inci_name, percentage, ingredient_percentage, actual_percentage,
+                 purpose, notes, is_compound) in columns
+        ]
 
-        return ingredients
+    @staticmethod
+    def _is_numeric_column(column: pd.Series) -> bool:
+        """整数或浮点数列（不含布尔列），可直接按数值转换"""
+        return pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype)
+
+    @staticmethod
+    def _map_unique_strings(column: pd.Series, parse, na_value) -> np.ndarray:
+        """
+        非空值转为字符串并去除首尾空白后解析，相同的字符串只解析一次；空值为na_value，返回object数组
+        """
+        codes, uniques = pd.factorize(column.astype(str), use_na_sentinel=True)
+        codes[column.isna().to_numpy()] = -1
+        parsed = np.empty(len(uniques) + 1, dtype=object)
+        parsed[:-1] = [parse(value.strip()) for value in uniques]
+        parsed[-1] = na_value
+        return parsed[codes]
+
+    def _sequence_column(self, column: pd.Series) -> np.ndarray:
+        """解析序号列，不是数字的行为None"""
+        if not self._is_numeric_column(column):
+            return self._map_unique_strings(column, self._parse_sequence, None)
+
+        values = column.to_numpy(dtype=float)
+        finite = np.isfinite(values)
+        sequences = np.full(len(values), None, dtype=object)
+        sequences[finite] = [int(value) for value in values[finite]]
+        return sequences
+
+    def _parse_sequence(self, seq_str: str) -> Optional[int]:
+        """解析序号，不是数字时返回None"""
+        if not self._is_number(seq_str):
+            return None
+        try:
+            return int(float(seq_str))
+        except (ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def _parse_percentage(val_str: str) -> float:
+        """解析含量（移除百分号并转换为浮点数），无法转换时为0.0"""
+        try:
+            return float(val_str.replace('%', '').strip())
+        except (ValueError, TypeError):
+            return 0.0
+
+    def _text_column(self, df: pd.DataFrame, col_idx: Optional[int]) -> np.ndarray:
+        """提取文本列（去除首尾空白，空值或列不存在时为空字符串）"""
+        if col_idx is None or col_idx >= df.shape[1]:
+            return np.full(len(df), "", dtype=object)
+        return self._map_unique_strings(df.iloc[:, col_idx], lambda value: value, "")
+
+    def _percentage_column(self, df: pd.DataFrame, col_idx: Optional[int]) -> np.ndarray:
+        """提取含量列（空值或列不存在时为0.0）"""
+        if col_idx is None or col_idx >= df.shape[1]:
+            return np.full(len(df), 0.0, dtype=object)
+
+        column = df.iloc[:, col_idx]
+        if not self._is_numeric_column(column):
+            return self._map_unique_strings(column, self._parse_percentage, 0.0)
+
+        values = column.to_numpy(dtype=float)
+        return np.where(np.isnan(values), 0.0, values).astype(object)
+
+    def _compound_column(self, chinese_names: np.ndarray, inci_names: np.ndarray, purposes: np.ndarray) -> np.ndarray:
+        """按列检测复配成分：中文名称、INCI名称与使用目的中包含任一复配关键词（关键词合并为一个正则表达式）"""
+        texts = chinese_names + ' ' + inci_names + ' ' + purposes
+        return np.array([self._compound_pattern.search(text.lower()) is not None for text in texts], dtype=bool)
+
+    def _get_column_mapping(self, columns: Sequence) -> Dict[str, int]:
+        """按表头指纹读取列映射缓存，未命中时识别列名并写入缓存"""
+        fingerprint = tuple(str(col).lower().strip() for col in columns)
+        cache = FormulaParser._column_mapping_cache
+        with FormulaParser._column_mapping_cache_lock:
+            mapping = cache.get(fingerprint)
+            if mapping is not None:
+                cache.move_to_end(fingerprint)
+                return dict(mapping)
+
+        mapping = self._map_columns(columns)
+        with FormulaParser._column_mapping_cache_lock:
+            cache[fingerprint] = dict(mapping)
+            while len(cache) > self.COLUMN_MAPPING_CACHE_SIZE:
+                cache.popitem(last=False)
+        return mapping
 
     def _map_columns(self, columns: List[str]) -> Dict[str, int]:
         """映射列名到索引"""
@@ -246,56 +713,52 @@ class FormulaParser:
 
     def _handle_merged_cells(self, df: pd.DataFrame) -> pd.DataFrame:
         """处理合并单元格的NaN值"""
-        df_copy = df.copy()
-
-        # 对每一列进行处理
-        for col in df_copy.columns:
-            # 向前填充NaN值（合并单元格的典型模式）
-            df_copy[col] = df_copy[col].ffill()
+        # 向前填充NaN值（合并单元格的典型模式）
+        df_copy = df.ffill()
 
         # 特别处理序号列的合并单元格
-        first_col = df_copy.iloc[:, 0]
-        for i in range(1, len(first_col)):
-            # 如果当前行的序号为NaN，但有中文名称，尝试找到对应的序号
-            if pd.isna(first_col.iloc[i]) or str(first_col.iloc[i]).strip() == '':
-                # 检查是否有中文名称（第二列通常是中文名称）
-                if len(df_copy.columns) > 1:
-                    chinese_name = df_copy.iloc[i, 1]
-                    if pd.notna(chinese_name) and str(chinese_name).strip():
-                        # 向前查找最近的序号
-                        for j in range(i - 1, -1, -1):
-                            prev_seq = first_col.iloc[j]
-                            if pd.notna(prev_seq) and self._is_number(str(prev_seq)):
-                                # 这是复配成分，使用相同的序号
-                                df_copy.iloc[i, 0] = prev_seq
-                                break
+        if len(df_copy.columns) > 1 and len(df_copy) > 1:
+            self._fill_blank_sequences(df_copy)
 
         return df_copy
 
-    def _safe_extract_text(self, row, col_idx: int) -> str:
-        """安全提取文本值"""
-        if col_idx is None or col_idx >= len(row):
-            return ""
-
-        value = row.iloc[col_idx]
-        if pd.notna(value):
-            return str(value).strip()
-        return ""
+    def _fill_blank_sequences(self, df: pd.DataFrame, previous_sequence=None):
+        """
+        序号为空但有中文名称（第二列通常是中文名称）的行视为复配成分，使用前面最近的数字序号（原地修改df）
 
-    def _extract_percentage(self, row, col_idx: int) -> float:
-        """提取百分比值"""
-        if col_idx is None or col_idx >= len(row):
-            return 0.0
+        Args:
+            previous_sequence: 前面的行（流式解析时为之前的块）中最近的数字序号，None表示没有
 
-        value = row.iloc[col_idx]
-        if pd.notna(value):
-            try:
-                # 移除百分号并转换为浮点数
-                val_str = str(value).replace('%', '').strip()
-                return float(val_str)
-            except (ValueError, TypeError):
-                return 0.0
-        return 0.0
+        Returns:
+            处理后最近的数字序号，没有时为previous_sequence
+        """
+        if len(df.columns) < 2 or df.empty:
+            return previous_sequence
+
+        first_col = df.iloc[:, 0]
+        if self._is_numeric_column(first_col):
+            blank_sequences = first_col.isna().to_numpy()
+            is_numeric = ~blank_sequences
+        else:
+            blank_sequences = self._map_unique_strings(first_col, lambda value: value == '', True).astype(bool)
+            is_numeric = self._map_unique_strings(first_col, self._is_number, False).astype(bool)
+        has_names = self._map_unique_strings(df.iloc[:, 1], bool, False).astype(bool)
+
+        positions = np.arange(len(first_col))
+        last_numeric = np.maximum.accumulate(np.where(is_numeric, positions, -1))
+        previous_numeric = np.concatenate(([-1], last_numeric[:-1]))
+        sequences = first_col.to_numpy()
+        candidates = blank_sequences & has_names
+        if previous_sequence is None:
+            candidates &= previous_numeric >= 0
+        else:
+            # 前面没有数字序号的行（位置为-1）取追加在末尾的previous_sequence
+            sequences = np.append(sequences.astype(object), [previous_sequence])
+        rows = np.flatnonzero(candidates)
+        if len(rows):
+            df.iloc[rows, 0] = sequences[previous_numeric[rows]]
+
+        return sequences[last_numeric[-1]] if last_numeric[-1] >= 0 else previous_sequence
 
     def _is_number(self, s: str) -> bool:
         """检查字符串是否为数字"""
@@ -305,18 +768,6 @@ class FormulaParser:
         except ValueError:
             return False
 
-    def _detect_compound(self, chinese_name: str, inci_name: str, purpose: str) -> bool:
-        """检测是否为复配成分"""
-        text = f"{chinese_name} {inci_name} {purpose}".lower()
-
-        # 复配关键词
-        compound_keywords = [
-            '复配', '混合', '组合', '复合', '体系', '配方',
-            '多元', '综合', '复方', '混配'
-        ]
-
-        return any(keyword in text for keyword in compound_keywords)
-
     def _validate_ingredients(self, ingredients: List[Dict]) -> Dict:
         """验证配方数据"""
         validation = {
@@ -370,3 +821,49 @@ class FormulaParser:
             validation['is_valid'] = False
 
         return validation
+
+
+def file_content_hash(content: bytes) -> str:
+    """文件内容指纹（SHA-256），字节完全相同的文件指纹相同"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def _parse_outcome(index: int, file_path: str, result: Optional[Dict] = None, error: Optional[str] = None) -> Dict:
+    """单个文件的解析结果"""
+    if error is not None:
+        return {'index': index, 'file_path': file_path, 'success': False, 'error': error}
+    return {'index': index, 'file_path': file_path, 'success': True, 'result': result}
+
+
+def _init_parse_worker(max_memory_mb: Optional[int]):
+    """解析工作进程初始化：设置地址空间上限（仅支持resource模块的平台）"""
+    if not max_memory_mb:
+        return
+    try:
+        import resource
+        limit = int(max_memory_mb) * 1024 * 1024
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        if hard_limit != resource.RLIM_INFINITY:
+            limit = min(limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard_limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"无法设置解析进程内存上限: {e}")
+
+
+def _raise_parse_timeout(signum, frame):
+    raise TimeoutError("解析超时")
+
+
+def _parse_file_in_worker(file_path: str, streaming: bool, timeout: Optional[float]) -> Dict:
+    """在工作进程中解析单个文件，超时通过定时信号中断（仅支持SIGALRM的平台）"""
+    use_alarm = bool(timeout) and hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_parse_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return FormulaParser(streaming=streaming).parse_file(file_path)
+    except TimeoutError:
+        raise TimeoutError(f"解析超时（超过{timeout}秒）")
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原料目录内存解析器
+将ingredient_catalog整表加载为规范化名称哈希表与字符二元组倒排索引，一次调用解析配方的全部成分，
+依次尝试：中文名精确匹配 → 规范化中文名匹配 → INCI名称匹配 → 字符二元组模糊匹配，并给出匹配置信度
+"""
+
+import logging
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func
+
+from src.backend.sql.mysql_models import IngredientCatalog
+
+logger = logging.getLogger(__name__)
+
+# 匹配方式及其置信度（模糊匹配的置信度为名称相似度）
+MATCH_EXACT = 'exact'
+MATCH_NORMALIZED = 'normalized'
+MATCH_INCI = 'inci'
+MATCH_FUZZY = 'fuzzy'
+MATCH_CONFIDENCE = {MATCH_EXACT: 1.0, MATCH_NORMALIZED: 0.95, MATCH_INCI: 0.9}
+
+# 规范化时统一的括号样式（全角括号由NFKC处理）
+_BRACKET_TRANSLATION = str.maketrans({
+    '【': '(', '】': ')', '〔': '(', '〕': ')', '［': '(', '］': ')', '[': '(', ']': ')',
+    '｛': '(', '｝': ')', '{': '(', '}': ')', '〈': '(', '〉': ')', '《': '(', '》': ')'
+})
+_WHITESPACE = re.compile(r'\s+')
+_DIGITS = re.compile(r'\d+')
+
+
+def normalize_ingredient_name(name: Optional[str]) -> str:
+    """
+    成分名称规范化：全角转半角（NFKC）、统一小写、去除全部空白、括号统一为半角圆括号
+    """
+    if not name:
+        return ''
+    normalized = unicodedata.normalize('NFKC', str(name)).casefold().translate(_BRACKET_TRANSLATION)
+    return _WHITESPACE.sub('', normalized)
+
+
+def _name_bigrams(normalized_name: str) -> List[str]:
+    """规范化名称的字符二元组（去重；单字名称使用该字本身）"""
+    if len(normalized_name) < 2:
+        return [normalized_name] if normalized_name else []
+    return list(dict.fromkeys(normalized_name[i:i + 2] for i in range(len(normalized_name) - 1)))
+
+
+@dataclass(frozen=True)
+class CatalogMatch:
+    """成分与原料目录的匹配结果"""
+    catalog_id: int
+    catalog_name: str
+    method: str
+    confidence: float
+
+
+class IngredientCatalogResolver:
+    """
+    原料目录解析器（构建后只读，可被多个请求并发使用）
+
+    - 精确匹配：中文名完全相同
+    - 规范化匹配：规范化后的中文名相同（全角/半角、空白、括号样式差异）
+    - INCI匹配：规范化后的INCI名称相同
+    - 模糊匹配：规范化中文名字符二元组的Dice系数不低于fuzzy_threshold，取相似度最高者；
+      名称中的数字序列必须完全一致（PEG-40与PEG-400、C12-15与C16-18是不同原料）
+
+    同一名称对应多个目录条目时取ID最小者，与原先按名称查询取第一条的结果一致
+    """
+
+    # 模糊匹配的默认最低相似度
+    FUZZY_THRESHOLD = 0.85
+
+    def __init__(self, entries: Sequence[Tuple[int, str, Optional[str]]], fuzzy_threshold: float = FUZZY_THRESHOLD,
+                 stamp: Optional[Tuple] = None):
+        """
+        Args:
+            entries: (目录ID, 中文名称, INCI名称) 列表
+            fuzzy_threshold: 模糊匹配的最低相似度，>1 表示关闭模糊匹配
+            stamp: 构建时的原料目录版本戳（用于判断是否需要重新加载）
+        """
+        self.fuzzy_threshold = fuzzy_threshold
+        self.stamp = stamp
+
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.catalog_ids = np.asarray([entry[0] for entry in entries], dtype=np.int64)
+        self.catalog_names = [entry[1] for entry in entries]
+
+        self._exact: Dict[str, int] = {}
+        self._normalized: Dict[str, int] = {}
+        self._inci: Dict[str, int] = {}
+        bigram_postings: Dict[str, List[int]] = defaultdict(list)
+        bigram_counts = []
+        self._digits: List[Tuple[str, ...]] = []
+        for position, (_, chinese_name, inci_name) in enumerate(entries):
+            normalized_name = normalize_ingredient_name(chinese_name)
+            self._exact.setdefault(chinese_name, position)
+            if normalized_name:
+                self._normalized.setdefault(normalized_name, position)
+            normalized_inci = normalize_ingredient_name(inci_name)
+            if normalized_inci:
+                self._inci.setdefault(normalized_inci, position)
+
+            bigrams = _name_bigrams(normalized_name)
+            for bigram in bigrams:
+                bigram_postings[bigram].append(position)
+            bigram_counts.append(len(bigrams))
+            self._digits.append(tuple(_DIGITS.findall(normalized_name)))
+
+        self._bigram_postings = {bigram: np.asarray(positions, dtype=np.int64)
+                                 for bigram, positions in bigram_postings.items()}
+        self._bigram_counts = np.asarray(bigram_counts, dtype=np.int64)
+
+        logger.info(f"原料目录解析器构建完成: {len(entries)} 个目录条目, {len(self._bigram_postings)} 个字符二元组")
+
+    @property
+    def size(self) -> int:
+        return len(self.catalog_ids)
+
+    @staticmethod
+    def catalog_stamp(session) -> Tuple:
+        """原料目录版本戳（条目数、最大ID、最近更新时间），目录变化后版本戳随之变化"""
+        count, max_id, last_updated = session.query(
+            func.count(IngredientCatalog.id), func.max(IngredientCatalog.id), func.max(IngredientCatalog.updated_at)
+        ).one()
+        return count, max_id, last_updated
+
+    @classmethod
+    def load(cls, session, fuzzy_threshold: float = FUZZY_THRESHOLD) -> 'IngredientCatalogResolver':
+        """一次查询加载整个原料目录"""
+        stamp = cls.catalog_stamp(session)
+        entries = session.query(IngredientCatalog.id, IngredientCatalog.chinese_name, IngredientCatalog.inci_name).all()
+        return cls(entries, fuzzy_threshold=fuzzy_threshold, stamp=stamp)
+
+    def _match(self, position: int, method: str, confidence: float) -> CatalogMatch:
+        return CatalogMatch(int(self.catalog_ids[position]), self.catalog_names[position], method, confidence)
+
+    def resolve(self, chinese_name: Optional[str], inci_name: Optional[str] = None) -> Optional[CatalogMatch]:
+        """解析单个成分，未能匹配时返回None"""
+        if chinese_name and chinese_name in self._exact:
+            return self._match(self._exact[chinese_name], MATCH_EXACT, MATCH_CONFIDENCE[MATCH_EXACT])
+
+        normalized_name = normalize_ingredient_name(chinese_name)
+        if normalized_name in self._normalized:
+            return self._match(self._normalized[normalized_name], MATCH_NORMALIZED, MATCH_CONFIDENCE[MATCH_NORMALIZED])
+
+        normalized_inci = normalize_ingredient_name(inci_name)
+        if normalized_inci in self._inci:
+            return self._match(self._inci[normalized_inci], MATCH_INCI, MATCH_CONFIDENCE[MATCH_INCI])
+
+        return self._fuzzy_match(normalized_name)
+
+    def _fuzzy_match(self, normalized_name: str) -> Optional[CatalogMatch]:
+        """
+        字符二元组模糊匹配：合并名称各二元组的倒排表统计重叠数，Dice = 2·重叠 / (两者二元组数之和)，
+        不与目录逐条比较；只保留数字序列一致的候选，相似度相同时取ID最小者
+        """
+        bigrams = _name_bigrams(normalized_name)
+        lists = [self._bigram_postings[bigram] for bigram in bigrams if bigram in self._bigram_postings]
+        if not lists or self.fuzzy_threshold > 1:
+            return None
+
+        positions, overlaps = np.unique(np.concatenate(lists), return_counts=True)
+        similarities = 2.0 * overlaps / (len(bigrams) + self._bigram_counts[positions])
+        candidates = np.flatnonzero(similarities >= self.fuzzy_threshold)
+        digits = tuple(_DIGITS.findall(normalized_name))
+        candidates = [candidate for candidate in candidates if self._digits[positions[candidate]] == digits]
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda candidate: (similarities[candidate], -positions[candidate]))
+        return self._match(int(positions[best]), MATCH_FUZZY, round(float(similarities[best]), 4))
+
+    def resolve_many(self, ingredients: Sequence[Tuple[Optional[str], Optional[str]]]) -> List[Optional[CatalogMatch]]:
+        """
+        一次解析一个配方的全部成分
+
+        Args:
+            ingredients: (中文名称, INCI名称) 列表
+
+        Returns:
+            与输入顺序对应的匹配结果列表（未匹配为None），重复的成分只解析一次
+        """
+        resolved: Dict[Tuple[Optional[str], Optional[str]], Optional[CatalogMatch]] = {}
+        for key in ingredients:
+            if key not in resolved:
+                resolved[key] = self.resolve(*key)
+        return [resolved[key] for key in ingredients]
+
+    @staticmethod
+    def summarize(ingredients: Sequence[Tuple[Optional[str], Optional[str]]],
+                  matches: Sequence[Optional[CatalogMatch]]) -> Dict:
+        """匹配情况汇总（各匹配方式的数量、未匹配的成分、非精确匹配的明细），用于接口返回"""
+        method_counts = Counter(match.method if match else 'unmatched' for match in matches)
+        return {
+            "method_counts": dict(method_counts),
+            "unmatched_ingredients": list(dict.fromkeys(
+                chinese_name for (chinese_name, _), match in zip(ingredients, matches) if match is None
+            )),
+            "inexact_matches": [
+                {
+                    "ingredient_name": chinese_name,
+                    "catalog_id": match.catalog_id,
+                    "catalog_name": match.catalog_name,
+                    "method": match.method,
+                    "confidence": match.confidence
+                }
+                for (chinese_name, _), match in dict(zip(ingredients, matches)).items()
+                if match is not None and match.method != MATCH_EXACT
+            ]
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+匹配结果缓存与上传文件解析结果缓存
+进程内LRU缓存，按条目数与存活时间（TTL）淘汰，用于重复匹配同一待匹配配方或重复查看同一配方对时
+直接返回已计算的结果；缓存键由调用方组合配方版本、配方库版本与参数摘要，任何一项变化即不再命中。
+解析结果缓存复用同一实现，键为文件内容指纹
+"""
+
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MatchResultCache:
+    """
+    匹配结果LRU缓存（线程安全）
+
+    默认写入与读取时都做深拷贝，调用方修改返回的结果不会影响缓存内容
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 600.0, copy_values: bool = True):
+        """
+        Args:
+            max_entries: 最大条目数，<=0 表示禁用缓存
+            ttl_seconds: 条目存活时间（秒），<=0 表示不按时间过期
+            copy_values: 是否深拷贝缓存值；值引用了不可复制或不应复制的对象（如内存索引）时设为False，
+                         调用方须保证不修改取出的值
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.copy_values = copy_values
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """读取缓存结果，未命中或已过期时返回None"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl_seconds > 0 and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def put(self, key: Hashable, value: Any):
+        """写入缓存结果，超过最大条目数时淘汰最久未使用的条目"""
+        if not self.enabled:
+            return
+
+        if self.copy_values:
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存（配方库变更时调用，及早释放已不可能命中的条目）"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class ParseResultCache(MatchResultCache):
+    """
+    上传文件解析结果LRU缓存（线程安全）
+
+    键为文件内容指纹（SHA-256），内容相同的文件解析结果必然相同，因此默认不按时间过期；
+    值为FormulaParser的解析结果，读写时深拷贝，调用方可以修改取出的成分列表
+    """
+
+    def __init__(self, max_entries: int = 128, ttl_seconds: float = 0.0):
+        """
+        Args:
+            max_entries: 最大条目数，<=0 表示禁用缓存
+            ttl_seconds: 条目存活时间（秒），<=0 表示不按时间过期
+        """
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds)
@@ -0,0 +1,976 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参考配方库常驻内存匹配索引
+启动时将参考配方库预处理为紧凑的数组结构（CSR格式），匹配时直接在内存中计算相似度，
+避免每次匹配都从数据库读取整库并重建配方结构
+"""
+
+import hashlib
+import json
+import logging
+import os
+import copy
+import shutil
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# 标准六分类（顺序即分类编码）
+STANDARD_CATEGORIES = ["防腐剂", "乳化剂", "增稠剂", "抗氧化剂", "表面活性剂", "其他"]
+CATEGORY_CODES = {category: code for code, category in enumerate(STANDARD_CATEGORIES)}
+
+# 快照格式版本：索引数组结构或特征提取规则变化时递增，使旧快照失效
+SNAPSHOT_FORMAT_VERSION = 2
+# 快照中以 .npy 保存（只读内存映射加载）的数组
+SNAPSHOT_ARRAYS = (
+    'formula_ids', 'member_indptr', 'member_identifiers', 'member_categories', 'category_counts',
+    'proportion_indptr', 'proportion_names', 'proportion_values', 'proportion_sums', 'proportion_norms'
+)
+# 快照中以 JSON 保存的字符串表
+SNAPSHOT_STRING_TABLES = ('formula_names', 'product_types', 'customers', 'identifiers', 'ingredient_names')
+# 写入新快照（增量日志）后保留的最新快照目录（增量日志）数量，其余删除；
+# 保留多个版本使增量日志引用的基础段快照在其他进程写入新快照后仍可加载
+SNAPSHOT_RETAINED = 2
+
+# 基础段已删除（墓碑）行占比超过该值、或增量段配方数超过该值时压缩索引
+TOMBSTONE_COMPACTION_RATIO = 0.2
+DELTA_COMPACTION_SIZE = 1024
+
+# 配方匹配特征：(分类 -> 去重后的匹配标识符列表, 成分名称 -> 含量)
+MatchFeatures = Tuple[Dict[str, List[str]], Dict[str, float]]
+
+# 复配签名标识符前缀：复配按全部组成成分的catalog_id集合整体标识
+COMPOUND_SIGNATURE_PREFIX = 'compound_catalog_'
+
+
+def stamp_digest(library_stamp: Dict) -> str:
+    """版本戳摘要（快照目录与增量日志按此命名）"""
+    payload = json.dumps({'format_version': SNAPSHOT_FORMAT_VERSION, 'library_stamp': library_stamp},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def prune_snapshot_entries(directory: str, prefix: str, keep: int = SNAPSHOT_RETAINED):
+    """删除目录中以prefix开头、按修改时间排在最新keep个之后的快照目录或增量日志（已映射旧快照的进程不受影响）"""
+    entries = [os.path.join(directory, entry) for entry in os.listdir(directory) if entry.startswith(prefix)]
+    entries.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0.0, reverse=True)
+    for path in entries[keep:]:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def compound_signature(catalog_ids: Sequence) -> str:
+    """复配签名标识符（catalog_id去重升序后以+连接），组成成分集合相同的复配签名相同"""
+    return COMPOUND_SIGNATURE_PREFIX + '+'.join(str(catalog_id) for catalog_id in sorted(set(catalog_ids)))
+
+
+def parse_compound_signature(identifier: str) -> Optional[frozenset]:
+    """复配签名标识符中的catalog_id集合（字符串形式）；非复配签名标识符返回None"""
+    if not identifier.startswith(COMPOUND_SIGNATURE_PREFIX):
+        return None
+    return frozenset(identifier[len(COMPOUND_SIGNATURE_PREFIX):].split('+'))
+
+
+def compound_jaccard(source_catalog_ids: frozenset, target_catalog_ids: frozenset) -> float:
+    """两个复配组成成分集合的Jaccard相似度"""
+    intersection = len(source_catalog_ids & target_catalog_ids)
+    union = len(source_catalog_ids) + len(target_catalog_ids) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+@dataclass
+class SourceFeatures:
+    """已编码的待匹配配方特征"""
+    # 各分类的匹配标识符数量（含不在索引词表中的标识符）
+    category_counts: np.ndarray
+    # 词表内匹配标识符对应的分类成员矩阵列号
+    member_columns: np.ndarray
+    # 词表内成分名称ID及含量（用于点积）
+    proportion_names: np.ndarray
+    proportion_values: np.ndarray
+    # 全部成分的含量之和与向量范数
+    proportion_sum: float
+    proportion_norm: float
+
+
+@dataclass
+class SourceBatch:
+    """已编码的一批待匹配配方特征（多对多批量打分用，各数组按待匹配配方顺序对齐）"""
+    # 形状为 (批大小, 分类数)
+    category_counts: np.ndarray
+    # 标识符分类列 → (待匹配配方 × 分类) 指示矩阵，形状为 (标识符分类列数, 批大小 × 分类数)
+    membership_selector: sparse.csr_matrix
+    # 成分名称 × 待匹配配方的含量矩阵
+    proportion_vectors: sparse.csr_matrix
+    proportion_sums: np.ndarray
+    proportion_norms: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return len(self.category_counts)
+
+
+class CompoundSignatureIndex:
+    """
+    复配签名倒排索引：catalog_id → 含该成分的复配签名
+
+    查询时合并待匹配复配各成分的倒排表统计重叠成分数，直接得到Jaccard不低于阈值的复配，
+    不与词表中的复配逐一比较
+    """
+
+    def __init__(self, identifiers: Sequence[str]):
+        """
+        Args:
+            identifiers: 匹配标识符词表，其中的复配签名标识符参与索引
+        """
+        identifier_ids: List[int] = []
+        sizes: List[int] = []
+        postings: Dict[str, List[int]] = defaultdict(list)
+        for identifier_id, identifier in enumerate(identifiers):
+            catalog_ids = parse_compound_signature(identifier)
+            if not catalog_ids:
+                continue
+            for catalog_id in catalog_ids:
+                postings[catalog_id].append(len(identifier_ids))
+            identifier_ids.append(identifier_id)
+            sizes.append(len(catalog_ids))
+
+        self.identifier_ids = np.asarray(identifier_ids, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.postings = {catalog_id: np.asarray(positions, dtype=np.int64)
+                         for catalog_id, positions in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.identifier_ids)
+
+    def similar(self, catalog_ids: frozenset, threshold: float) -> np.ndarray:
+        """与给定成分集合至少共享一个成分、且Jaccard不低于threshold的复配签名的标识符ID"""
+        lists = [self.postings[catalog_id] for catalog_id in catalog_ids if catalog_id in self.postings]
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+        positions, overlaps = np.unique(np.concatenate(lists), return_counts=True)
+        jaccard = overlaps / (len(catalog_ids) + self.sizes[positions] - overlaps)
+        return self.identifier_ids[positions[jaccard >= threshold]]
+
+
+class ReferenceLibraryIndex:
+    """
+    参考配方库内存索引
+
+    每个参考配方占一行，行号按配方ID升序排列：
+    - 分类成员（CSR）：member_indptr / member_identifiers / member_categories，
+      即每个配方在各标准分类下去重后的匹配标识符（catalog_/name_/compound_ 前缀字符串已驻留为整数ID）
+    - 复配签名倒排表：词表中的复配签名按组成成分建立的倒排索引，匹配时查找相近复配
+    - 成分比例（CSR）：proportion_indptr / proportion_names / proportion_values，
+      即每个配方的成分名称（复配作为整体）与含量
+    - 墓碑（tombstones）：已删除但尚未压缩掉的行，不再参与召回与打分
+    """
+
+    def __init__(
+            self,
+            formula_ids: np.ndarray,
+            formula_names: List[str],
+            product_types: List[Optional[str]],
+            customers: List[Optional[str]],
+            identifiers: List[str],
+            member_indptr: np.ndarray,
+            member_identifiers: np.ndarray,
+            member_categories: np.ndarray,
+            category_counts: np.ndarray,
+            ingredient_names: List[str],
+            proportion_indptr: np.ndarray,
+            proportion_names: np.ndarray,
+            proportion_values: np.ndarray,
+            proportion_sums: np.ndarray,
+            proportion_norms: np.ndarray,
+            tombstones: Optional[np.ndarray] = None
+    ):
+        self.formula_ids = formula_ids
+        self.formula_names = formula_names
+        self.product_types = product_types
+        self.customers = customers
+
+        self.identifiers = identifiers
+        self.identifier_ids = {identifier: i for i, identifier in enumerate(identifiers)}
+        self.member_indptr = member_indptr
+        self.member_identifiers = member_identifiers
+        self.member_categories = member_categories
+        self.category_counts = category_counts
+
+        self.ingredient_names = ingredient_names
+        self.ingredient_name_ids = {name: i for i, name in enumerate(ingredient_names)}
+        self.proportion_indptr = proportion_indptr
+        self.proportion_names = proportion_names
+        self.proportion_values = proportion_values
+        self.proportion_sums = proportion_sums
+        self.proportion_norms = proportion_norms
+        self.tombstones = np.zeros(len(formula_ids), dtype=bool) if tombstones is None else tombstones
+
+        # 含已删除的行（row_of按墓碑过滤），标记删除时无需复制
+        self._rows_by_formula_id = {int(formula_id): row for row, formula_id in enumerate(formula_ids)}
+        self._live_count = len(formula_ids) - int(np.count_nonzero(self.tombstones))
+
+        # 稀疏矩阵视图（首次使用时构建）
+        self._membership_matrix: Optional[sparse.csr_matrix] = None
+        self._proportion_matrix: Optional[sparse.csr_matrix] = None
+
+        # 倒排表视图（CSC格式，首次使用时构建）
+        self._membership_postings: Optional[sparse.csc_matrix] = None
+        self._proportion_postings: Optional[sparse.csc_matrix] = None
+
+        # 严格模式分区（产品类型 / 产品大类 / 客户 → 行号，首次使用时构建）
+        self._strict_partitions: Optional[Dict[str, Dict[str, np.ndarray]]] = None
+
+        # 复配签名倒排索引（首次使用时构建）
+        self._compound_signatures: Optional[CompoundSignatureIndex] = None
+
+    @property
+    def size(self) -> int:
+        """索引中的配方数量"""
+        return len(self.formula_ids)
+
+    @property
+    def live_count(self) -> int:
+        """未删除的配方数量"""
+        return self._live_count
+
+    @property
+    def tombstone_ratio(self) -> float:
+        """已删除行占索引行数的比例"""
+        return (self.size - self.live_count) / self.size if self.size else 0.0
+
+    def live_rows(self) -> np.ndarray:
+        """未删除的行号（升序）"""
+        return np.flatnonzero(~self.tombstones)
+
+    @classmethod
+    def build(
+            cls,
+            formulas: Sequence[Tuple[int, str, Optional[str], Optional[str]]],
+            features: Dict[int, MatchFeatures]
+    ) -> 'ReferenceLibraryIndex':
+        """
+        由参考配方表头与配方匹配特征构建索引
+
+        Args:
+            formulas: (配方ID, 配方名称, 产品类型, 客户) 列表
+            features: {配方ID: 匹配特征}，缺失的配方视为无成分
+        """
+        formulas = sorted(formulas, key=lambda f: f[0])
+
+        identifier_ids: Dict[str, int] = {}
+        name_ids: Dict[str, int] = {}
+
+        member_indptr = [0]
+        member_identifiers: List[int] = []
+        member_categories: List[int] = []
+        category_counts = np.zeros((len(formulas), len(STANDARD_CATEGORIES)), dtype=np.int32)
+
+        proportion_indptr = [0]
+        proportion_names: List[int] = []
+        proportion_values: List[float] = []
+
+        for row, (formula_id, _, _, _) in enumerate(formulas):
+            category_identifiers, proportions = features.get(formula_id) or ({}, {})
+
+            for category, identifiers in category_identifiers.items():
+                code = CATEGORY_CODES.get(category, CATEGORY_CODES["其他"])
+                for identifier in identifiers:
+                    member_identifiers.append(identifier_ids.setdefault(identifier, len(identifier_ids)))
+                    member_categories.append(code)
+                category_counts[row, code] += len(identifiers)
+            member_indptr.append(len(member_identifiers))
+
+            for name, content in proportions.items():
+                proportion_names.append(name_ids.setdefault(name, len(name_ids)))
+                proportion_values.append(content)
+            proportion_indptr.append(len(proportion_names))
+
+        proportion_indptr = np.asarray(proportion_indptr, dtype=np.int64)
+        proportion_values = np.asarray(proportion_values, dtype=np.float64)
+        row_of_value = np.repeat(np.arange(len(formulas)), np.diff(proportion_indptr))
+        proportion_sums = np.bincount(row_of_value, weights=proportion_values, minlength=len(formulas))
+        proportion_norms = np.sqrt(np.bincount(row_of_value, weights=proportion_values ** 2,
+                                               minlength=len(formulas)))
+
+        return cls(
+            formula_ids=np.asarray([f[0] for f in formulas], dtype=np.int64),
+            formula_names=[f[1] for f in formulas],
+            product_types=[f[2] for f in formulas],
+            customers=[f[3] for f in formulas],
+            identifiers=list(identifier_ids.keys()),
+            member_indptr=np.asarray(member_indptr, dtype=np.int64),
+            member_identifiers=np.asarray(member_identifiers, dtype=np.int32),
+            member_categories=np.asarray(member_categories, dtype=np.int8),
+            category_counts=category_counts,
+            ingredient_names=list(name_ids.keys()),
+            proportion_indptr=proportion_indptr,
+            proportion_names=np.asarray(proportion_names, dtype=np.int32),
+            proportion_values=proportion_values,
+            proportion_sums=proportion_sums,
+            proportion_norms=proportion_norms
+        )
+
+    @staticmethod
+    def snapshot_path(directory: str, library_stamp: Dict) -> str:
+        """版本戳对应的快照目录（snapshot-<摘要>）"""
+        return os.path.join(directory, f"snapshot-{stamp_digest(library_stamp)}")
+
+    def save_snapshot(self, directory: str, library_stamp: Dict) -> str:
+        """
+        将索引写入磁盘快照：每个数组一个 .npy 文件，字符串表写入 strings.json，最后写 manifest.json
+
+        先写入临时目录再重命名为正式目录，多进程并发写入同一版本时以先完成者为准；
+        写入成功后只保留最新的 SNAPSHOT_RETAINED 个版本（已映射旧快照的进程不受影响）
+
+        Returns:
+            快照目录
+        """
+        target = self.snapshot_path(directory, library_stamp)
+        if os.path.exists(os.path.join(target, 'manifest.json')):
+            return target
+
+        os.makedirs(directory, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=directory)
+        try:
+            for name in SNAPSHOT_ARRAYS:
+                np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+            with open(os.path.join(staging, 'strings.json'), 'w', encoding='utf-8') as f:
+                json.dump({name: getattr(self, name) for name in SNAPSHOT_STRING_TABLES}, f, ensure_ascii=False)
+            with open(os.path.join(staging, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'format_version': SNAPSHOT_FORMAT_VERSION,
+                    'library_stamp': library_stamp,
+                    'size': self.size,
+                    'created_at': datetime.now().isoformat()
+                }, f, ensure_ascii=False, indent=2)
+            os.rename(staging, target)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            if os.path.exists(os.path.join(target, 'manifest.json')):
+                return target
+            raise
+
+        prune_snapshot_entries(directory, 'snapshot-')
+
+        logger.info(f"匹配索引快照已写入: {target}")
+        return target
+
+    @classmethod
+    def load_snapshot(cls, directory: str, library_stamp: Dict) -> Optional['ReferenceLibraryIndex']:
+        """
+        以只读内存映射方式加载与版本戳一致的快照，多个工作进程通过系统页缓存共享同一份数据
+
+        Returns:
+            索引；快照不存在、格式版本或版本戳不一致时返回None
+        """
+        target = cls.snapshot_path(directory, library_stamp)
+        manifest_path = os.path.join(target, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION or \
+                manifest.get('library_stamp') != library_stamp:
+            return None
+
+        arrays = {name: np.load(os.path.join(target, f"{name}.npy"), mmap_mode='r') for name in SNAPSHOT_ARRAYS}
+        with open(os.path.join(target, 'strings.json'), 'r', encoding='utf-8') as f:
+            string_tables = json.load(f)
+
+        index = cls(**arrays, **string_tables)
+        logger.info(f"已映射匹配索引快照: {target} ({index.size} 个配方)")
+        return index
+
+    def row_of(self, formula_id: int) -> Optional[int]:
+        """配方ID对应的索引行号，不存在或已删除时返回None"""
+        row = self._rows_by_formula_id.get(formula_id)
+        return None if row is None or self.tombstones[row] else row
+
+    @property
+    def compound_signatures(self) -> CompoundSignatureIndex:
+        """词表中复配签名标识符的倒排索引"""
+        if self._compound_signatures is None:
+            self._compound_signatures = CompoundSignatureIndex(self.identifiers)
+        return self._compound_signatures
+
+    def similar_compound_columns(self, identifier: str, code: int, compound_threshold: float) -> np.ndarray:
+        """同一分类下与复配签名相近（组成成分Jaccard不低于compound_threshold）的复配所在的成员矩阵列号"""
+        catalog_ids = parse_compound_signature(identifier)
+        if not catalog_ids:
+            return np.empty(0, dtype=np.int64)
+        return self.compound_signatures.similar(catalog_ids, compound_threshold) * len(STANDARD_CATEGORIES) + code
+
+    def encode_source(self, category_identifiers: Dict[str, List[str]], proportions: Dict[str, float],
+                      compound_threshold: Optional[float] = None) -> SourceFeatures:
+        """
+        按索引词表编码待匹配配方特征
+
+        指定compound_threshold时，待匹配配方的复配同时命中同一分类下组成成分Jaccard不低于该阈值的参考复配
+        （成员列中加入这些复配所在的列）；为None时复配只按签名精确命中
+        """
+        counts = np.zeros(len(STANDARD_CATEGORIES), dtype=np.int32)
+        member_columns = [np.empty(0, dtype=np.int64)]
+        for category, identifiers in category_identifiers.items():
+            code = CATEGORY_CODES.get(category, CATEGORY_CODES["其他"])
+            counts[code] += len(identifiers)
+            for identifier in identifiers:
+                identifier_id = self.identifier_ids.get(identifier)
+                if identifier_id is not None:
+                    member_columns.append(np.asarray([identifier_id * len(STANDARD_CATEGORIES) + code]))
+                if compound_threshold is not None:
+                    member_columns.append(self.similar_compound_columns(identifier, code, compound_threshold))
+
+        proportion_names = []
+        proportion_values = []
+        for name, content in proportions.items():
+            name_id = self.ingredient_name_ids.get(name)
+            if name_id is not None:
+                proportion_names.append(name_id)
+                proportion_values.append(content)
+
+        values = np.asarray(list(proportions.values()), dtype=np.float64)
+        return SourceFeatures(
+            category_counts=counts,
+            member_columns=np.unique(np.concatenate(member_columns)).astype(np.int64),
+            proportion_names=np.asarray(proportion_names, dtype=np.int64),
+            proportion_values=np.asarray(proportion_values, dtype=np.float64),
+            proportion_sum=float(np.sum(values)),
+            proportion_norm=float(np.sqrt(np.sum(values ** 2)))
+        )
+
+    @property
+    def membership_matrix(self) -> sparse.csr_matrix:
+        """
+        分类成员稀疏矩阵（配方 × 标识符分类列）
+
+        列号 = 标识符ID × 分类数 + 分类编码，即同一标识符在不同分类下是不同的列
+        """
+        if self._membership_matrix is None:
+            columns = self.member_identifiers.astype(np.int64) * len(STANDARD_CATEGORIES) + self.member_categories
+            self._membership_matrix = sparse.csr_matrix(
+                (np.ones(len(columns), dtype=np.float64), columns, self.member_indptr),
+                shape=(self.size, len(self.identifiers) * len(STANDARD_CATEGORIES))
+            )
+        return self._membership_matrix
+
+    @property
+    def proportion_matrix(self) -> sparse.csr_matrix:
+        """成分比例稀疏矩阵（配方 × 成分名称），值为含量"""
+        if self._proportion_matrix is None:
+            self._proportion_matrix = sparse.csr_matrix(
+                (self.proportion_values, self.proportion_names, self.proportion_indptr),
+                shape=(self.size, len(self.ingredient_names))
+            )
+        return self._proportion_matrix
+
+    @property
+    def membership_postings(self) -> sparse.csc_matrix:
+        """匹配标识符倒排表：每一列（标识符分类列）的行号即包含该标识符的配方"""
+        if self._membership_postings is None:
+            self._membership_postings = self.membership_matrix.tocsc()
+        return self._membership_postings
+
+    @property
+    def proportion_postings(self) -> sparse.csc_matrix:
+        """成分名称倒排表：每一列（成分名称）的行号即含有该成分的配方"""
+        if self._proportion_postings is None:
+            self._proportion_postings = self.proportion_matrix.tocsc()
+        return self._proportion_postings
+
+    def candidate_rows(self, source: SourceFeatures, scope: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        与待匹配配方至少共享一个匹配标识符或成分名称的配方行号（升序）
+
+        不在候选集中的配方各分类交集与比例点积均为0，其相似度必为0
+
+        Args:
+            scope: 限定的行号范围（升序），None表示整个配方库
+        """
+        return self.batch_candidate_rows([source], scope)
+
+    def batch_candidate_rows(self, sources: Sequence[SourceFeatures], scope: Optional[np.ndarray] = None) -> np.ndarray:
+        """与一批待匹配配方中至少一个共享匹配标识符或成分名称的配方行号（升序），其余配方与这批配方的相似度均为0"""
+        mask = np.zeros(self.size, dtype=bool)
+        for source in sources:
+            for postings, columns in ((self.membership_postings, source.member_columns),
+                                      (self.proportion_postings, source.proportion_names)):
+                for column in columns:
+                    mask[postings.indices[postings.indptr[column]:postings.indptr[column + 1]]] = True
+        mask &= ~self.tombstones
+        if scope is not None:
+            scope_mask = np.zeros(self.size, dtype=bool)
+            scope_mask[scope] = True
+            mask &= scope_mask
+        return np.flatnonzero(mask)
+
+    @property
+    def strict_partitions(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        按产品类型、产品大类、客户预先分区的行号（各分区升序，含已删除的行）
+
+        - product_type: 完整产品类型（"大类-细分类型" 或旧格式的大类）
+        - major_type: 产品大类，即第一个 "-" 之前的部分（旧格式即其本身）
+        - customer: 客户，空值与空字符串同属 "" 分区
+        """
+        if self._strict_partitions is None:
+            partitions = {'product_type': defaultdict(list), 'major_type': defaultdict(list),
+                          'customer': defaultdict(list)}
+            for row, (product_type, customer) in enumerate(zip(self.product_types, self.customers)):
+                if product_type:
+                    partitions['product_type'][product_type].append(row)
+                    partitions['major_type'][product_type.split('-', 1)[0]].append(row)
+                partitions['customer'][customer or ""].append(row)
+            self._strict_partitions = {
+                key: {value: np.asarray(rows, dtype=np.int64) for value, rows in partition.items()}
+                for key, partition in partitions.items()
+            }
+        return self._strict_partitions
+
+    def strict_scope_rows(self, product_type: Optional[str], customer: Optional[str]) -> np.ndarray:
+        """
+        严格模式候选行号（升序，不含已删除的行），与原严格模式数据库查询的筛选规则一致：
+
+        - 产品类型含 "-"（大类-细分类型）时精确匹配；只有大类时匹配该大类下的全部配方（兼容新旧格式）
+        - 客户精确匹配；待匹配配方没有客户信息时只匹配同样没有客户信息的配方
+        """
+        partitions = self.strict_partitions
+        empty = np.empty(0, dtype=np.int64)
+
+        rows = partitions['customer'].get(customer or "", empty)
+        if product_type:
+            partition = partitions['product_type'] if '-' in product_type else partitions['major_type']
+            rows = np.intersect1d(rows, partition.get(product_type, empty), assume_unique=True)
+        return rows[~self.tombstones[rows]]
+
+    def row_features(self, row: int, compound_threshold: Optional[float] = None) -> SourceFeatures:
+        """索引行自身的特征（参考配方库内部两两比较时作为待匹配配方，compound_threshold同encode_source）"""
+        member_start, member_end = self.member_indptr[row], self.member_indptr[row + 1]
+        proportion_start, proportion_end = self.proportion_indptr[row], self.proportion_indptr[row + 1]
+        member_identifiers = self.member_identifiers[member_start:member_end].astype(np.int64)
+        member_categories = self.member_categories[member_start:member_end]
+        member_columns = member_identifiers * len(STANDARD_CATEGORIES) + member_categories
+        if compound_threshold is not None:
+            member_columns = np.unique(np.concatenate([member_columns] + [
+                self.similar_compound_columns(self.identifiers[identifier_id], int(code), compound_threshold)
+                for identifier_id, code in zip(member_identifiers, member_categories)
+            ]))
+        return SourceFeatures(
+            category_counts=np.asarray(self.category_counts[row], dtype=np.int32),
+            member_columns=member_columns,
+            proportion_names=np.asarray(self.proportion_names[proportion_start:proportion_end], dtype=np.int64),
+            proportion_values=np.asarray(self.proportion_values[proportion_start:proportion_end], dtype=np.float64),
+            proportion_sum=float(self.proportion_sums[row]),
+            proportion_norm=float(self.proportion_norms[row])
+        )
+
+    def row_match_features(self, row: int) -> MatchFeatures:
+        """由索引行还原的匹配特征（在其他索引段的词表下重新编码时使用）"""
+        member_start, member_end = self.member_indptr[row], self.member_indptr[row + 1]
+        proportion_start, proportion_end = self.proportion_indptr[row], self.proportion_indptr[row + 1]
+        category_identifiers: Dict[str, List[str]] = defaultdict(list)
+        for identifier_id, code in zip(self.member_identifiers[member_start:member_end],
+                                       self.member_categories[member_start:member_end]):
+            category_identifiers[STANDARD_CATEGORIES[code]].append(self.identifiers[identifier_id])
+        proportions = {self.ingredient_names[name_id]: float(value) for name_id, value in zip(
+            self.proportion_names[proportion_start:proportion_end],
+            self.proportion_values[proportion_start:proportion_end]
+        )}
+        return dict(category_identifiers), proportions
+
+    def overlapping_rows(self, source: SourceFeatures, after_row: int = -1) -> np.ndarray:
+        """
+        行号大于after_row、且与给定特征至少共享一个匹配标识符或成分名称的未删除行（升序）
+
+        只合并相关倒排表，不构造整库掩码，适合逐行遍历整个配方库的自连接
+        """
+        slices = [np.empty(0, dtype=np.int64)]
+        for postings, columns in ((self.membership_postings, source.member_columns),
+                                  (self.proportion_postings, source.proportion_names)):
+            for column in columns:
+                slices.append(postings.indices[postings.indptr[column]:postings.indptr[column + 1]])
+        rows = np.unique(np.concatenate(slices))
+        rows = rows[rows > after_row]
+        return rows[~self.tombstones[rows]]
+
+    def category_intersections(self, source: SourceFeatures, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        待匹配配方与各参考配方在每个分类上的交集数量
+
+        一次稀疏矩阵乘法完成：成员矩阵 × (源配方标识符列 → 分类) 指示矩阵，即参考配方中被命中的标识符数；
+        一个源复配可能命中多个相近的参考复配，交集不超过源配方在该分类的标识符数
+
+        Returns:
+            形状为 (行数, 分类数) 的数组
+        """
+        matrix = self.membership_matrix if rows is None else self.membership_matrix[rows]
+        columns = source.member_columns
+        selector = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.float64), (columns, columns % len(STANDARD_CATEGORIES))),
+            shape=(matrix.shape[1], len(STANDARD_CATEGORIES))
+        )
+        return np.minimum((matrix @ selector).toarray(), source.category_counts)
+
+    def proportion_dots(self, source: SourceFeatures, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """待匹配配方比例向量与各参考配方比例向量的点积"""
+        matrix = self.proportion_matrix if rows is None else self.proportion_matrix[rows]
+        vector = np.zeros(matrix.shape[1], dtype=np.float64)
+        vector[source.proportion_names] = source.proportion_values
+        return matrix @ vector
+
+    def encode_source_batch(self, sources: Sequence[SourceFeatures]) -> SourceBatch:
+        """将多个已编码的待匹配配方堆叠为稀疏矩阵，供分块矩阵-矩阵打分使用"""
+        category_count = len(STANDARD_CATEGORIES)
+        member_counts = [len(source.member_columns) for source in sources]
+        member_columns = np.concatenate([source.member_columns for source in sources] + [np.empty(0, np.int64)])
+        member_sources = np.repeat(np.arange(len(sources)), member_counts)
+        membership_selector = sparse.csr_matrix(
+            (np.ones(len(member_columns), dtype=np.float64),
+             (member_columns, member_sources * category_count + member_columns % category_count)),
+            shape=(len(self.identifiers) * category_count, len(sources) * category_count)
+        )
+
+        proportion_counts = [len(source.proportion_names) for source in sources]
+        proportion_vectors = sparse.csr_matrix(
+            (np.concatenate([source.proportion_values for source in sources] + [np.empty(0, np.float64)]),
+             (np.concatenate([source.proportion_names for source in sources] + [np.empty(0, np.int64)]),
+              np.repeat(np.arange(len(sources)), proportion_counts))),
+            shape=(len(self.ingredient_names), len(sources))
+        )
+
+        return SourceBatch(
+            category_counts=np.asarray([source.category_counts for source in sources],
+                                       dtype=np.int32).reshape(len(sources), category_count),
+            membership_selector=membership_selector,
+            proportion_vectors=proportion_vectors,
+            proportion_sums=np.asarray([source.proportion_sum for source in sources], dtype=np.float64),
+            proportion_norms=np.asarray([source.proportion_norm for source in sources], dtype=np.float64)
+        )
+
+    def batch_category_intersections(self, batch: SourceBatch, rows: np.ndarray) -> np.ndarray:
+        """
+        一批待匹配配方与指定参考配方行在每个分类上的交集数量
+
+        一次稀疏矩阵-矩阵乘法完成：成员矩阵 × 批量指示矩阵
+
+        Returns:
+            形状为 (批大小, 行数, 分类数) 的数组
+        """
+        category_count = len(STANDARD_CATEGORIES)
+        products = (self.membership_matrix[rows] @ batch.membership_selector).toarray()
+        intersections = products.reshape(len(rows), batch.size, category_count).transpose(1, 0, 2)
+        return np.minimum(intersections, batch.category_counts[:, np.newaxis, :])
+
+    def batch_proportion_dots(self, batch: SourceBatch, rows: np.ndarray) -> np.ndarray:
+        """一批待匹配配方与指定参考配方行的比例向量点积，形状为 (批大小, 行数)"""
+        return (self.proportion_matrix[rows] @ batch.proportion_vectors).toarray().T
+
+    @classmethod
+    def merge(cls, parts: Sequence[Tuple['ReferenceLibraryIndex', np.ndarray]]) -> 'ReferenceLibraryIndex':
+        """
+        将多个索引段中的指定行合并为一个新索引（直接拼接数组，无需重新提取特征）
+
+        Args:
+            parts: (索引段, 保留的行号) 列表，各段配方ID不应重复；结果不保留墓碑
+
+        Returns:
+            行按配方ID升序排列、词表为各段并集的新索引
+        """
+        identifier_ids: Dict[str, int] = {}
+        name_ids: Dict[str, int] = {}
+        pieces = []
+        for index, rows in parts:
+            rows = np.asarray(rows, dtype=np.int64)
+            identifier_map = np.asarray([identifier_ids.setdefault(identifier, len(identifier_ids))
+                                         for identifier in index.identifiers], dtype=np.int32)
+            name_map = np.asarray([name_ids.setdefault(name, len(name_ids))
+                                   for name in index.ingredient_names], dtype=np.int32)
+            member_indptr, member_positions = _gather_csr(index.member_indptr, rows)
+            proportion_indptr, proportion_positions = _gather_csr(index.proportion_indptr, rows)
+            pieces.append({
+                'formula_ids': index.formula_ids[rows],
+                'formula_names': [index.formula_names[row] for row in rows],
+                'product_types': [index.product_types[row] for row in rows],
+                'customers': [index.customers[row] for row in rows],
+                'member_lengths': np.diff(member_indptr),
+                'member_identifiers': identifier_map[index.member_identifiers[member_positions]],
+                'member_categories': index.member_categories[member_positions],
+                'category_counts': index.category_counts[rows],
+                'proportion_lengths': np.diff(proportion_indptr),
+                'proportion_names': name_map[index.proportion_names[proportion_positions]],
+                'proportion_values': index.proportion_values[proportion_positions],
+                'proportion_sums': index.proportion_sums[rows],
+                'proportion_norms': index.proportion_norms[rows]
+            })
+
+        def concat(key, dtype):
+            arrays = [piece[key] for piece in pieces]
+            return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype=dtype)
+
+        def concat_list(key):
+            return [value for piece in pieces for value in piece[key]]
+
+        formula_ids = concat('formula_ids', np.int64)
+        order = np.argsort(formula_ids, kind='stable')
+
+        member_indptr = np.concatenate([[0], np.cumsum(concat('member_lengths', np.int64))])
+        proportion_indptr = np.concatenate([[0], np.cumsum(concat('proportion_lengths', np.int64))])
+        sorted_member_indptr, member_positions = _gather_csr(member_indptr, order)
+        sorted_proportion_indptr, proportion_positions = _gather_csr(proportion_indptr, order)
+
+        formula_names = concat_list('formula_names')
+        product_types = concat_list('product_types')
+        customers = concat_list('customers')
+        category_counts = np.concatenate([piece['category_counts'] for piece in pieces]) if pieces else \
+            np.zeros((0, len(STANDARD_CATEGORIES)), dtype=np.int32)
+
+        return cls(
+            formula_ids=formula_ids[order],
+            formula_names=[formula_names[row] for row in order],
+            product_types=[product_types[row] for row in order],
+            customers=[customers[row] for row in order],
+            identifiers=list(identifier_ids.keys()),
+            member_indptr=sorted_member_indptr,
+            member_identifiers=concat('member_identifiers', np.int32)[member_positions],
+            member_categories=concat('member_categories', np.int8)[member_positions],
+            category_counts=category_counts.astype(np.int32, copy=False)[order],
+            ingredient_names=list(name_ids.keys()),
+            proportion_indptr=sorted_proportion_indptr,
+            proportion_names=concat('proportion_names', np.int32)[proportion_positions],
+            proportion_values=concat('proportion_values', np.float64)[proportion_positions],
+            proportion_sums=concat('proportion_sums', np.float64)[order],
+            proportion_norms=concat('proportion_norms', np.float64)[order]
+        )
+
+    def with_tombstones(self, formula_ids: Sequence[int]) -> 'ReferenceLibraryIndex':
+        """
+        标记删除指定配方，返回新索引（与原索引共享全部数组、配方ID映射与稀疏矩阵视图，只复制墓碑掩码）
+
+        原索引保持不变，正在使用原索引的匹配不受影响
+        """
+        rows = sorted({row for row in (self.row_of(int(formula_id)) for formula_id in formula_ids)
+                       if row is not None})
+        if not rows:
+            return self
+
+        index = copy.copy(self)
+        index.tombstones = self.tombstones.copy()
+        index.tombstones[rows] = True
+        index._live_count = self._live_count - len(rows)
+        return index
+
+    def without_tombstones(self) -> 'ReferenceLibraryIndex':
+        """清除全部墓碑，返回新索引（与原索引共享全部数组），即构建或加载时的原始索引"""
+        if self._live_count == self.size:
+            return self
+        index = copy.copy(self)
+        index.tombstones = np.zeros(self.size, dtype=bool)
+        index._live_count = self.size
+        return index
+
+
+def _gather_csr(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    CSR按行抽取：返回抽取后的indptr以及各元素在原数据数组中的位置
+
+    Returns:
+        (新indptr, 原数组位置)
+    """
+    indptr = np.asarray(indptr, dtype=np.int64)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    new_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    positions = np.arange(new_indptr[-1], dtype=np.int64) - np.repeat(new_indptr[:-1] - starts, lengths)
+    return new_indptr, positions
+
+
+class SegmentedLibraryIndex:
+    """
+    可增量维护的参考配方库索引：只读基础段（删除的配方以墓碑标记） + 增量段
+
+    - 新增或替换的配方写入增量段，只重新编码增量段（代价与变更配方及增量段规模相关，与整库规模无关）
+    - 删除或被替换的基础段配方以墓碑标记，不再参与匹配
+    - 匹配时各段分别召回、打分，再按相似度合并结果（同分按配方ID升序，与整库构建的排序一致）
+    - 增量段或墓碑累积超过阈值后由compact()合并为新的基础段
+    - 磁盘快照：基础段快照 + 增量日志（基础段墓碑与增量段配方），其他工作进程按版本戳加载
+    每次变更都返回新对象（共享基础段数组），正在进行的匹配始终看到一致的索引
+    """
+
+    def __init__(
+            self,
+            base: ReferenceLibraryIndex,
+            delta_entries: Optional[Dict[int, Tuple[Tuple[int, str, Optional[str], Optional[str]],
+                                                    MatchFeatures]]] = None,
+            base_stamp: Optional[Dict] = None
+    ):
+        """
+        Args:
+            base: 基础段
+            delta_entries: 增量段配方 {配方ID: ((配方ID, 配方名称, 产品类型, 客户), 匹配特征)}
+            base_stamp: 基础段（不含墓碑）磁盘快照的版本戳，None表示基础段尚未写入快照
+        """
+        self.base = base
+        self.base_stamp = base_stamp
+        self.delta_entries = delta_entries or {}
+        self.delta = ReferenceLibraryIndex.build(
+            [meta for meta, _ in self.delta_entries.values()],
+            {formula_id: features for formula_id, (_, features) in self.delta_entries.items()}
+        ) if self.delta_entries else None
+
+    @property
+    def segments(self) -> List[ReferenceLibraryIndex]:
+        """参与匹配的索引段（基础段在前）"""
+        return [self.base] if self.delta is None else [self.base, self.delta]
+
+    @property
+    def live_count(self) -> int:
+        """参与匹配的配方数量"""
+        return self.base.live_count + len(self.delta_entries)
+
+    @property
+    def needs_compaction(self) -> bool:
+        """增量段规模或基础段墓碑占比超过阈值"""
+        return len(self.delta_entries) > DELTA_COMPACTION_SIZE or \
+            self.base.tombstone_ratio > TOMBSTONE_COMPACTION_RATIO
+
+    def locate(self, formula_id: int) -> Optional[Tuple[ReferenceLibraryIndex, int]]:
+        """配方所在的索引段与行号，不存在或已删除时返回None"""
+        for segment in reversed(self.segments):
+            row = segment.row_of(formula_id)
+            if row is not None:
+                return segment, row
+        return None
+
+    def apply_changes(
+            self,
+            upserts: Sequence[Tuple[Tuple[int, str, Optional[str], Optional[str]], Optional[MatchFeatures]]] = (),
+            removals: Sequence[int] = ()
+    ) -> 'SegmentedLibraryIndex':
+        """
+        新增/替换与删除配方，返回新的索引对象（原对象保持不变）
+
+        Args:
+            upserts: (配方表头, 匹配特征) 列表，配方已存在时替换；匹配特征为None视为无成分
+            removals: 待删除的配方ID
+        """
+        changed_ids = [int(formula_id) for formula_id in removals] + [int(meta[0]) for meta, _ in upserts]
+        delta_entries = dict(self.delta_entries)
+        for formula_id in changed_ids:
+            delta_entries.pop(formula_id, None)
+        for meta, features in upserts:
+            delta_entries[int(meta[0])] = (tuple(meta), features or ({}, {}))
+        return SegmentedLibraryIndex(self.base.with_tombstones(changed_ids), delta_entries, self.base_stamp)
+
+    def compact(self) -> 'SegmentedLibraryIndex':
+        """将基础段未删除的行与增量段合并为新的基础段"""
+        parts = [(self.base, self.base.live_rows())]
+        if self.delta is not None:
+            parts.append((self.delta, np.arange(self.delta.size)))
+        merged = ReferenceLibraryIndex.merge(parts)
+        logger.info(f"匹配索引已压缩: 清除 {self.base.size - self.base.live_count} 个墓碑, "
+                    f"合并 {len(self.delta_entries)} 个增量配方, 当前 {merged.size} 个配方")
+        return SegmentedLibraryIndex(merged)
+
+    @staticmethod
+    def journal_path(directory: str, library_stamp: Dict) -> str:
+        """版本戳对应的增量日志（delta-<摘要>.json）"""
+        return os.path.join(directory, f"delta-{stamp_digest(library_stamp)}.json")
+
+    def save_snapshot(self, directory: str, library_stamp: Dict) -> str:
+        """
+        将索引写入磁盘快照，供其他工作进程按版本戳加载
+
+        - 没有增量段与墓碑（全量构建或压缩后）时写入基础段快照，并记录为基础段快照版本
+        - 否则只写入增量日志：基础段快照版本 + 基础段墓碑配方ID + 增量段配方，代价与增量规模相关，与整库规模无关
+
+        Returns:
+            快照目录或增量日志路径
+
+        Raises:
+            ValueError: 基础段尚未写入快照，无法写入增量日志
+        """
+        if self.delta is None and self.base.live_count == self.base.size:
+            target = self.base.save_snapshot(directory, library_stamp)
+            self.base_stamp = library_stamp
+            return target
+        if self.base_stamp is None:
+            raise ValueError("基础段尚未写入快照，无法写入增量日志")
+
+        target = self.journal_path(directory, library_stamp)
+        journal = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'library_stamp': library_stamp,
+            'base_stamp': self.base_stamp,
+            'removals': self.base.formula_ids[self.base.tombstones].tolist(),
+            'upserts': [[list(meta), category_identifiers, proportions]
+                        for meta, (category_identifiers, proportions) in self.delta_entries.values()]
+        }
+        os.makedirs(directory, exist_ok=True)
+        fd, staging = tempfile.mkstemp(prefix='.staging-', suffix='.json', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(journal, f, ensure_ascii=False)
+            os.replace(staging, target)
+        except OSError:
+            if os.path.exists(staging):
+                os.remove(staging)
+            raise
+
+        prune_snapshot_entries(directory, 'delta-')
+        logger.info(f"匹配索引增量日志已写入: {target} (墓碑 {len(journal['removals'])} 个, "
+                    f"增量配方 {len(journal['upserts'])} 个)")
+        return target
+
+    @classmethod
+    def load_snapshot(cls, directory: str, library_stamp: Dict,
+                      current: Optional['SegmentedLibraryIndex'] = None) -> Optional['SegmentedLibraryIndex']:
+        """
+        加载与版本戳一致的快照：优先基础段快照，其次增量日志（引用的基础段快照 + 墓碑 + 增量段配方）
+
+        Args:
+            current: 当前内存索引，其基础段与增量日志引用的基础段快照相同时直接复用，不重新映射
+
+        Returns:
+            索引；快照与增量日志均不存在或已过期时返回None
+        """
+        base = ReferenceLibraryIndex.load_snapshot(directory, library_stamp)
+        if base is not None:
+            return cls(base, base_stamp=library_stamp)
+
+        try:
+            with open(cls.journal_path(directory, library_stamp), 'r', encoding='utf-8') as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            return None
+        if journal.get('format_version') != SNAPSHOT_FORMAT_VERSION or journal.get('library_stamp') != library_stamp:
+            return None
+
+        base_stamp = journal['base_stamp']
+        if current is not None and current.base_stamp == base_stamp:
+            base = current.base.without_tombstones()
+        else:
+            base = ReferenceLibraryIndex.load_snapshot(directory, base_stamp)
+            if base is None:
+                return None
+        index = cls(base, base_stamp=base_stamp).apply_changes(
+            [(tuple(meta), (category_identifiers, proportions))
+             for meta, category_identifiers, proportions in journal['upserts']],
+            journal['removals']
+        )
+        logger.info(f"已按增量日志加载匹配索引: 墓碑 {len(journal['removals'])} 个, "
+                    f"增量配方 {len(journal['upserts'])} 个, 当前 {index.live_count} 个配方")
+        return index
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步匹配任务
+将一个或多个待匹配配方的匹配提交为后台任务，由有界线程池执行，HTTP请求只负责提交与查询；
+任务逐个配方调用匹配引擎并保存匹配记录，支持进度查询、取消与结果读取（任务信息保存在进程内存中）
+"""
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, List, Optional
+
+from src.backend.sql.mysql_models import DualFormulaLibraryHandler
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_JOB_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+
+@dataclass
+class MatchJob:
+    """匹配任务（results/failures由工作线程逐个配方写入，运行期间可读取已完成的部分）"""
+    job_id: str
+    source_formula_ids: List[int]
+    strict_mode: bool = False
+    retrieval_mode: Optional[str] = None
+    max_results: Optional[int] = None
+    created_by: Optional[str] = None
+    status: str = JOB_PENDING
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    parameters: Optional[object] = None
+    results: Dict[int, List] = field(default_factory=dict)
+    failures: Dict[int, str] = field(default_factory=dict)
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    future: Optional[Future] = None
+
+    @property
+    def completed_count(self) -> int:
+        return len(self.results) + len(self.failures)
+
+    def to_dict(self) -> Dict:
+        """任务状态与进度（不含匹配结果）"""
+        total_count = len(self.source_formula_ids)
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "strict_mode": self.strict_mode,
+            "retrieval_mode": self.retrieval_mode,
+            "max_results": self.max_results,
+            "created_by": self.created_by,
+            "total_count": total_count,
+            "completed_count": self.completed_count,
+            "succeeded_count": len(self.results),
+            "failed_count": len(self.failures),
+            "progress": round(self.completed_count / total_count, 4) if total_count else 1.0,
+            "failures": {str(source_id): message for source_id, message in self.failures.items()},
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class MatchJobManager:
+    """
+    匹配任务管理器（线程安全）
+
+    同时运行的任务数不超过max_workers，其余任务排队；已结束的任务超过max_finished_jobs时按创建时间淘汰
+    """
+
+    def __init__(self, matching_engine, session_factory: Callable, max_workers: int = 2,
+                 max_finished_jobs: int = 100):
+        """
+        Args:
+            matching_engine: DualLibraryMatchingEngine实例
+            session_factory: 创建数据库会话的工厂（工作线程使用独立会话）
+            max_workers: 后台工作线程数
+            max_finished_jobs: 保留的已结束任务数量上限
+        """
+        self.matching_engine = matching_engine
+        self.session_factory = session_factory
+        self.max_finished_jobs = max_finished_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='match-job')
+        self._jobs: Dict[str, MatchJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, source_formula_ids: List[int], strict_mode: bool = False,
+               retrieval_mode: Optional[str] = None, max_results: Optional[int] = None,
+               created_by: Optional[str] = None) -> MatchJob:
+        """提交匹配任务（重复的配方ID只匹配一次；max_results为None时使用系统配置的结果数量）"""
+        job = MatchJob(
+            job_id=uuid.uuid4().hex,
+            source_formula_ids=list(dict.fromkeys(source_formula_ids)),
+            strict_mode=strict_mode,
+            retrieval_mode=retrieval_mode,
+            max_results=max_results,
+            created_by=created_by
+        )
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune_finished_jobs()
+        job.future = self._executor.submit(self._run_job, job)
+        logger.info(f"提交匹配任务 {job.job_id}: {len(job.source_formula_ids)} 个待匹配配方")
+        return job
+
+    def get(self, job_id: str) -> Optional[MatchJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[MatchJob]:
+        """全部任务（按创建时间倒序）"""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[MatchJob]:
+        """
+        取消任务：排队中的任务直接取消；运行中的任务在当前配方匹配完成后停止，已完成的结果保留
+        """
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED_JOB_STATUSES:
+            return job
+
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+        logger.info(f"取消匹配任务 {job_id}")
+        return job
+
+    def shutdown(self):
+        """取消排队中的任务并等待运行中的任务停止"""
+        for job in self.list_jobs():
+            job.cancel_event.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _prune_finished_jobs(self):
+        """淘汰最早创建的已结束任务（调用方持有锁）"""
+        finished = sorted((job for job in self._jobs.values() if job.status in FINISHED_JOB_STATUSES),
+                          key=lambda job: job.created_at)
+        for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job.job_id]
+
+    def _run_job(self, job: MatchJob):
+        """工作线程：逐个配方匹配并保存匹配记录，每个配方单独提交"""
+        if job.cancel_event.is_set():
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            return
+
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        try:
+            with self.session_factory() as session:
+                # 整个任务使用同一份参数快照
+                parameters = self.matching_engine.get_parameters(session)
+                if job.max_results is not None:
+                    parameters = replace(parameters, max_results=job.max_results)
+                job.parameters = parameters
+                for source_id in job.source_formula_ids:
+                    if job.cancel_event.is_set():
+                        break
+                    try:
+                        match_results = self.matching_engine.match_formula_against_library(
+                            source_id, session, strict_mode=job.strict_mode,
+                            retrieval_mode=job.retrieval_mode, parameters=parameters
+                        )
+                        DualFormulaLibraryHandler.save_match_records(session, source_id, match_results)
+                        session.commit()
+                        job.results[source_id] = match_results
+                    except Exception as e:
+                        session.rollback()
+                        logger.error(f"匹配任务 {job.job_id} 中配方 {source_id} 匹配失败: {e}")
+                        job.failures[source_id] = str(e)
+
+            cancelled = job.cancel_event.is_set() and job.completed_count < len(job.source_formula_ids)
+            job.status = JOB_CANCELLED if cancelled else JOB_COMPLETED
+        except Exception as e:
+            logger.error(f"匹配任务 {job.job_id} 执行失败: {e}")
+            job.status = JOB_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            logger.info(f"匹配任务 {job.job_id} 结束: {job.status}, "
+                        f"成功 {len(job.results)} 个, 失败 {len(job.failures)} 个")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MinHash/LSH 近似候选召回
+为超大参考配方库提供可选的近似检索模式：对每个配方的匹配标识符集合计算MinHash签名，
+按分段（band）写入LSH哈希表，查询时只召回至少有一段签名完全相同的配方，再用精确两段式算法重排
+"""
+
+import copy
+import logging
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+
+from src.backend.matching_index import ReferenceLibraryIndex
+
+logger = logging.getLogger(__name__)
+
+# 哈希函数 h(x) = (a * x + b) mod P，P为小于2^32的最大素数，保证uint64运算不溢出
+_HASH_PRIME = np.uint64(4294967291)
+_EMPTY_SIGNATURE = np.iinfo(np.uint64).max
+_BAND_KEY_MULTIPLIER = np.uint64(1099511628211)
+
+# 签名长度（bands × rows）上限：签名矩阵占用 配方数 × bands × rows × 8 字节
+MAX_NUM_PERMUTATIONS = 512
+
+
+@dataclass
+class LSHParameters:
+    """LSH参数：bands越多、rows越少召回率越高，候选集也越大"""
+    bands: int = 32
+    rows: int = 3
+    seed: int = 1
+
+    @property
+    def num_permutations(self) -> int:
+        return self.bands * self.rows
+
+    @property
+    def similarity_threshold(self) -> float:
+        """S曲线拐点的近似Jaccard相似度 (1/b)^(1/r)"""
+        return (1.0 / self.bands) ** (1.0 / self.rows)
+
+
+def identifier_key(identifier: str) -> int:
+    """匹配标识符的稳定32位哈希（跨进程一致）"""
+    return zlib.crc32(identifier.encode('utf-8'))
+
+
+class MinHashLSHIndex:
+    """
+    参考配方库的MinHash/LSH索引
+
+    签名基于每个配方全部分类下匹配标识符的并集；每个band的签名片段压缩为一个64位键，
+    各band内按键排序存储行号，查询时二分查找相同键的行
+    """
+
+    def __init__(self, library_index: ReferenceLibraryIndex, parameters: LSHParameters):
+        self.library_index = library_index
+        self.parameters = parameters
+
+        rng = np.random.RandomState(parameters.seed)
+        self._hash_a = rng.randint(1, int(_HASH_PRIME), size=parameters.num_permutations).astype(np.uint64)
+        self._hash_b = rng.randint(0, int(_HASH_PRIME), size=parameters.num_permutations).astype(np.uint64)
+
+        signatures = self._library_signatures()
+        self._band_keys = []
+        self._band_rows = []
+        non_empty = np.flatnonzero(signatures[:, 0] != _EMPTY_SIGNATURE)
+        for band in range(parameters.bands):
+            keys = self._band_key(signatures[non_empty, band * parameters.rows:(band + 1) * parameters.rows])
+            order = np.argsort(keys, kind='stable')
+            self._band_keys.append(keys[order])
+            self._band_rows.append(non_empty[order])
+
+        logger.info(f"MinHash/LSH索引构建完成: {library_index.size} 个配方, "
+                    f"{parameters.bands} bands × {parameters.rows} rows, "
+                    f"近似阈值 {parameters.similarity_threshold:.3f}")
+
+    def rebind(self, library_index: ReferenceLibraryIndex) -> 'MinHashLSHIndex':
+        """绑定到行结构相同（仅墓碑不同）的新内存索引，复用已计算的band表"""
+        lsh_index = copy.copy(self)
+        lsh_index.library_index = library_index
+        return lsh_index
+
+    def _library_signatures(self) -> np.ndarray:
+        """按CSR成员数组逐个哈希函数计算所有配方的MinHash签名"""
+        index = self.library_index
+        identifier_keys = np.asarray([identifier_key(identifier) for identifier in index.identifiers],
+                                     dtype=np.uint64)
+        member_keys = identifier_keys[index.member_identifiers]
+
+        signatures = np.full((index.size, self.parameters.num_permutations), _EMPTY_SIGNATURE, dtype=np.uint64)
+        lengths = np.diff(index.member_indptr)
+        non_empty = np.flatnonzero(lengths > 0)
+        if len(non_empty) == 0:
+            return signatures
+
+        starts = index.member_indptr[:-1][non_empty]
+        for j in range(self.parameters.num_permutations):
+            hashed = (self._hash_a[j] * member_keys + self._hash_b[j]) % _HASH_PRIME
+            signatures[non_empty, j] = np.minimum.reduceat(hashed, starts)
+        return signatures
+
+    def signature(self, identifiers: Iterable[str]) -> Optional[np.ndarray]:
+        """计算任意标识符集合的MinHash签名（空集合返回None）"""
+        keys = np.asarray(sorted({identifier_key(identifier) for identifier in identifiers}), dtype=np.uint64)
+        if len(keys) == 0:
+            return None
+        hashed = (self._hash_a[:, np.newaxis] * keys[np.newaxis, :] + self._hash_b[:, np.newaxis]) % _HASH_PRIME
+        return hashed.min(axis=1)
+
+    @staticmethod
+    def _band_key(band_signatures: np.ndarray) -> np.ndarray:
+        """将band内的签名片段压缩为64位键（uint64溢出回绕即为取模）"""
+        keys = np.zeros(band_signatures.shape[:-1], dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for column in range(band_signatures.shape[-1]):
+                keys = keys * _BAND_KEY_MULTIPLIER + band_signatures[..., column]
+        return keys
+
+    def query(self, identifiers: Iterable[str]) -> np.ndarray:
+        """召回至少有一个band签名相同的配方行号（升序，不含已删除的配方）"""
+        signature = self.signature(identifiers)
+        if signature is None:
+            return np.empty(0, dtype=np.int64)
+
+        rows = self.parameters.rows
+        band_keys = self._band_key(signature.reshape(self.parameters.bands, rows))
+        mask = np.zeros(self.library_index.size, dtype=bool)
+        for band, key in enumerate(band_keys):
+            keys = self._band_keys[band]
+            start = np.searchsorted(keys, key, side='left')
+            end = np.searchsorted(keys, key, side='right')
+            mask[self._band_rows[band][start:end]] = True
+        mask &= ~self.library_index.tombstones
+        return np.flatnonzero(mask)
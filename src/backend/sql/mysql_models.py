@@ -9,10 +9,16 @@ from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime,
     DECIMAL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from collections import Counter
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List, Optional
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import json
 import os
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -188,6 +194,62 @@ class FormulaMatchRecord(Base):
     target_formula = relationship("Formulas", foreign_keys=[target_formula_id])
 
 
+class FormulaMatchFeatures(Base):
+    """配方匹配特征表（上传/编辑时计算一次，匹配时直接读取）"""
+    __tablename__ = 'formula_match_features'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_type = Column(String(20), nullable=False, comment='配方库类型: reference/to_be_matched')
+    formula_id = Column(Integer, nullable=False, comment='配方ID(对应配方库主表)')
+    feature_version = Column(Integer, nullable=False, comment='特征提取规则版本')
+    category_identifiers = Column(Text, nullable=False,
+                                  comment='标准分类 -> 去重后的匹配标识符列表JSON(含复配签名)')
+    proportions = Column(Text, nullable=False, comment='成分名称(复配作为整体) -> 含量JSON')
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, comment='计算时间')
+
+    __table_args__ = (
+        Index('idx_match_features_formula', 'table_type', 'formula_id', unique=True),
+    )
+
+
+class FormulaSourceFile(Base):
+    """配方来源文件指纹（上传时记录，用于识别由同一文件创建的配方）"""
+    __tablename__ = 'formula_source_files'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_type = Column(String(20), nullable=False, comment='配方库类型: reference/to_be_matched')
+    formula_id = Column(Integer, nullable=False, comment='配方ID(对应配方库主表)')
+    content_hash = Column(String(64), nullable=False, comment='文件内容SHA-256')
+    file_name = Column(String(500), comment='上传时的文件名')
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, comment='上传时间')
+
+    __table_args__ = (
+        Index('idx_source_file_formula', 'table_type', 'formula_id', unique=True),
+        Index('idx_source_file_hash', 'content_hash'),
+    )
+
+
+class FormulaDuplicatePair(Base):
+    """参考配方近似重复对（重复检测的结果，每次检测整体替换）"""
+    __tablename__ = 'formula_duplicate_pairs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cluster_id = Column(Integer, nullable=False, comment='重复簇编号(按簇大小降序从1开始)')
+    formula_id = Column(Integer, nullable=False, comment='参考配方ID(较小的一方)')
+    duplicate_formula_id = Column(Integer, nullable=False, comment='与之近似重复的参考配方ID')
+    similarity_score = Column(DECIMAL(8, 6), comment='总相似度得分')
+    composition_similarity = Column(DECIMAL(8, 6), comment='成分组成相似度')
+    proportion_similarity = Column(DECIMAL(8, 6), comment='成分比例相似度')
+    threshold = Column(DECIMAL(8, 6), comment='检测使用的相似度阈值')
+    detected_at = Column(DateTime, default=datetime.now, comment='检测时间')
+
+    __table_args__ = (
+        Index('idx_duplicate_pairs_cluster', 'cluster_id'),
+        Index('idx_duplicate_pairs_formula', 'formula_id'),
+        Index('idx_duplicate_pairs_duplicate', 'duplicate_formula_id'),
+    )
+
+
 # ==================== 系统支持表组 ====================
 
 class SystemConfig(Base):
@@ -204,53 +266,101 @@ class SystemConfig(Base):
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 
+# 数据版本号配置键：每次变更在同一事务内递增，多个工作进程比较版本号判断进程内缓存是否过期
+LIBRARY_VERSION_KEY = 'reference_library_version'
+MATCHING_CONFIG_VERSION_KEY = 'matching_config_version'
+DATA_VERSION_DESCRIPTIONS = {
+    LIBRARY_VERSION_KEY: '参考配方库版本号(配方、成分或匹配特征变更时递增)',
+    MATCHING_CONFIG_VERSION_KEY: '匹配配置版本号(分类权重或匹配参数变更时递增)'
+}
+
+
 # ==================== 双配方库处理工具类 ====================
 
+# 分类权重默认值
+DEFAULT_CATEGORY_WEIGHTS = {
+    '防腐剂': 0.35,
+    '乳化剂': 0.15,
+    '增稠剂': 0.15,
+    '抗氧化剂': 0.1,
+    '表面活性剂': 0.1,
+    '其他': 0.15
+}
+
+# 匹配算法参数默认值
+DEFAULT_MATCHING_PARAMETERS = {
+    'composition_weight': 0.8,
+    'proportion_weight': 0.2,
+    'compound_threshold': 0.6,
+    'min_similarity_threshold': 0.0,
+    'max_results': 5
+}
+
+
+@dataclass(frozen=True)
+class MatchingConfigSnapshot:
+    """
+    匹配配置快照：版本号在每次重新加载后递增，版本相同则配置内容相同
+
+    config_stamp为加载时数据库中的匹配配置版本号，与当前版本号不同说明其他工作进程修改了配置
+    """
+    version: int
+    category_weights: Dict[str, float]
+    matching_parameters: Dict[str, float]
+    config_stamp: Optional[Dict[str, object]] = None
+
+
+# 进程内匹配配置快照缓存（本进程设置分类权重/匹配参数时失效，其他进程的修改按数据库版本号发现）
+_matching_config_snapshot: Optional[MatchingConfigSnapshot] = None
+_matching_config_version = 0
+_matching_config_checked_at = 0.0
+_matching_config_lock = threading.Lock()
+
+
+def _safe_float(value) -> float:
+    """安全转换Decimal为float"""
+    if value is None:
+        return 0.0
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
 class SystemConfigManager:
     """系统配置管理器"""
 
+    @staticmethod
+    def _load_float_configs(session, prefix: str, defaults: Dict[str, float]) -> Dict[str, float]:
+        """一次查询读取一组浮点型配置（键为 prefix + 名称），缺失或无法解析时使用默认值"""
+        config_keys = {f"{prefix}{name}": name for name in defaults}
+        rows = session.query(SystemConfig.config_key, SystemConfig.config_value).filter(
+            SystemConfig.config_key.in_(list(config_keys)),
+            SystemConfig.is_active == True
+        ).all()
+
+        values = dict(defaults)
+        for config_key, config_value in rows:
+            try:
+                values[config_keys[config_key]] = float(config_value)
+            except (ValueError, TypeError):
+                pass
+        return values
+
     @staticmethod
     def get_category_weights(session) -> Dict[str, float]:
         """获取分类权重配置"""
         try:
-            default_weights = {
-                '防腐剂': 0.35,
-                '乳化剂': 0.15,
-                '增稠剂': 0.15,
-                '抗氧化剂': 0.1,
-                '表面活性剂': 0.1,
-                '其他': 0.15
-            }
-
-            weights = {}
-            for category, default_value in default_weights.items():
-                config_key = f"category_weight_{category}"
-                config = session.query(SystemConfig).filter(
-                    SystemConfig.config_key == config_key,
-                    SystemConfig.is_active == True
-                ).first()
-
-                if config:
-                    try:
-                        weights[category] = float(config.config_value)
-                    except (ValueError, TypeError):
-                        weights[category] = default_value
-                else:
-                    weights[category] = default_value
-
-            return weights
+            return SystemConfigManager._load_float_configs(session, "category_weight_", DEFAULT_CATEGORY_WEIGHTS)
 
         except Exception as e:
             logger.error(f"获取分类权重配置失败: {e}")
             # 返回默认权重
-            return {
-                '防腐剂': 0.35,
-                '乳化剂': 0.15,
-                '增稠剂': 0.15,
-                '抗氧化剂': 0.1,
-                '表面活性剂': 0.1,
-                '其他': 0.15
-            }
+            return dict(DEFAULT_CATEGORY_WEIGHTS)
 
     @staticmethod
     def set_category_weights(session, weights: Dict[str, float]):
@@ -274,7 +384,9 @@ class SystemConfigManager:
                     )
                     session.add(config)
 
+            SystemConfigManager.bump_data_version(session, MATCHING_CONFIG_VERSION_KEY)
             session.commit()
+            SystemConfigManager.invalidate_matching_config()
             logger.info(f"分类权重配置已更新: {weights}")
 
         except Exception as e:
@@ -286,39 +398,73 @@ class SystemConfigManager:
     def get_matching_parameters(session) -> Dict[str, float]:
         """获取匹配算法参数"""
         try:
-            default_params = {
-                'composition_weight': 0.8,
-                'proportion_weight': 0.2,
-                'compound_threshold': 0.6,
-                'min_similarity_threshold': 0.0
-            }
-
-            params = {}
-            for param_key, default_value in default_params.items():
-                config_key = f"matching_{param_key}"
-                config = session.query(SystemConfig).filter(
-                    SystemConfig.config_key == config_key,
-                    SystemConfig.is_active == True
-                ).first()
+            return SystemConfigManager._load_float_configs(session, "matching_", DEFAULT_MATCHING_PARAMETERS)
 
-                if config:
-                    try:
-                        params[param_key] = float(config.config_value)
-                    except (ValueError, TypeError):
-                        params[param_key] = default_value
-                else:
-                    params[param_key] = default_value
+        except Exception as e:
+            logger.error(f"获取匹配参数配置失败: {e}")
+            return dict(DEFAULT_MATCHING_PARAMETERS)
 
-            return params
+    @staticmethod
+    def get_matching_config_snapshot(session, check_interval: float = 0.0) -> 'MatchingConfigSnapshot':
+        """
+        获取进程内缓存的匹配配置快照（分类权重 + 匹配算法参数）
+
+        距上次比较不足check_interval秒时直接返回缓存，不访问数据库；否则按唯一键读取匹配配置版本号，
+        与快照加载时的版本号相同则继续使用缓存，不同（其他工作进程修改了配置）或缓存失效时
+        用一次查询重新加载并递增进程内版本号
+        """
+        global _matching_config_snapshot, _matching_config_version, _matching_config_checked_at
+        snapshot = _matching_config_snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - _matching_config_checked_at < check_interval:
+            return snapshot
 
+        try:
+            config_stamp = SystemConfigManager.get_data_version(session, MATCHING_CONFIG_VERSION_KEY)
         except Exception as e:
-            logger.error(f"获取匹配参数配置失败: {e}")
-            return {
-                'composition_weight': 0.8,
-                'proportion_weight': 0.2,
-                'compound_threshold': 0.6,
-                'min_similarity_threshold': 0.0
-            }
+            config_stamp = None
+            logger.warning(f"读取匹配配置版本号失败: {e}")
+        if snapshot is not None and (config_stamp is None or config_stamp == snapshot.config_stamp):
+            _matching_config_checked_at = now
+            return snapshot
+
+        with _matching_config_lock:
+            snapshot = _matching_config_snapshot
+            if snapshot is not None and (config_stamp is None or config_stamp == snapshot.config_stamp):
+                return snapshot
+
+            defaults = {f"category_weight_{name}": value for name, value in DEFAULT_CATEGORY_WEIGHTS.items()}
+            defaults.update({f"matching_{name}": value for name, value in DEFAULT_MATCHING_PARAMETERS.items()})
+            try:
+                values = SystemConfigManager._load_float_configs(session, "", defaults)
+            except Exception as e:
+                # 加载失败时不缓存，下次请求重试
+                logger.error(f"加载匹配配置快照失败，使用默认配置: {e}")
+                return MatchingConfigSnapshot(
+                    version=0,
+                    category_weights=dict(DEFAULT_CATEGORY_WEIGHTS),
+                    matching_parameters=dict(DEFAULT_MATCHING_PARAMETERS)
+                )
+
+            _matching_config_version += 1
+            _matching_config_snapshot = MatchingConfigSnapshot(
+                version=_matching_config_version,
+                category_weights={name: values[f"category_weight_{name}"] for name in DEFAULT_CATEGORY_WEIGHTS},
+                matching_parameters={name: values[f"matching_{name}"] for name in DEFAULT_MATCHING_PARAMETERS},
+                config_stamp=config_stamp
+            )
+            _matching_config_checked_at = now
+            logger.info(f"匹配配置快照已加载 (版本 {_matching_config_version}) - "
+                        f"分类权重: {_matching_config_snapshot.category_weights}, "
+                        f"匹配参数: {_matching_config_snapshot.matching_parameters}")
+            return _matching_config_snapshot
+
+    @staticmethod
+    def invalidate_matching_config():
+        """分类权重或匹配参数变更后使匹配配置快照失效，下次读取时重新加载"""
+        global _matching_config_snapshot
+        with _matching_config_lock:
+            _matching_config_snapshot = None
 
     @staticmethod
     def set_matching_parameters(session, params: Dict[str, float]):
@@ -328,7 +474,8 @@ class SystemConfigManager:
                 'composition_weight': '成分组成相似度权重',
                 'proportion_weight': '成分比例相似度权重',
                 'compound_threshold': '复配匹配成功阈值',
-                'min_similarity_threshold': '最小相似度阈值'
+                'min_similarity_threshold': '最小相似度阈值',
+                'max_results': '默认返回的匹配结果数量'
             }
 
             for param_key, value in params.items():
@@ -345,11 +492,13 @@ class SystemConfigManager:
                         config_key=config_key,
                         config_value=str(value),
                         description=param_descriptions.get(param_key, f'{param_key}参数'),
-                        config_type='float'
+                        config_type='int' if param_key == 'max_results' else 'float'
                     )
                     session.add(config)
 
+            SystemConfigManager.bump_data_version(session, MATCHING_CONFIG_VERSION_KEY)
             session.commit()
+            SystemConfigManager.invalidate_matching_config()
             logger.info(f"匹配算法参数已更新: {params}")
 
         except Exception as e:
@@ -422,10 +571,47 @@ class SystemConfigManager:
             logger.error(f"设置产品类型配置失败: {e}")
             raise e
 
+    @staticmethod
+    def get_data_version(session, config_key: str) -> Dict[str, object]:
+        """
+        读取数据版本号（按唯一键查询一行，开销与数据量无关）
+
+        Returns:
+            {'version': 版本号, 'created_at': 版本号行的创建时间}，创建时间用于区分重建后的数据库
+        """
+        row = session.query(SystemConfig.config_value, SystemConfig.created_at).filter(
+            SystemConfig.config_key == config_key
+        ).first()
+        if row is None:
+            return {'version': 0, 'created_at': None}
+        return {'version': int(row.config_value or 0),
+                'created_at': row.created_at.isoformat() if row.created_at else None}
+
+    @staticmethod
+    def bump_data_version(session, config_key: str):
+        """
+        在当前事务内递增数据版本号（锁定版本号行至事务结束），由调用方提交事务
+
+        本会话递增的次数记录在session.info中，供写入方判断期间是否有其他工作进程写入
+        """
+        row = session.query(SystemConfig).filter(SystemConfig.config_key == config_key).with_for_update().first()
+        if row is None:
+            row = SystemConfig(config_key=config_key, config_value='0', config_type='int',
+                               description=DATA_VERSION_DESCRIPTIONS.get(config_key))
+            session.add(row)
+        row.config_value = str(int(row.config_value or 0) + 1)
+        session.info.setdefault('data_version_bumps', Counter())[config_key] += 1
+
+    @staticmethod
+    def pop_data_version_bumps(session, config_key: str) -> int:
+        """取出并清零本会话递增该版本号的次数（含已回滚事务中的递增）"""
+        return session.info.get('data_version_bumps', Counter()).pop(config_key, 0)
+
     @staticmethod
     def initialize_default_config(session):
         """初始化默认配置"""
         try:
+            matching_config_added = False
             # 初始化分类权重
             default_category_weights = {
                 '防腐剂': 0.35,
@@ -443,6 +629,7 @@ class SystemConfigManager:
                 ).first()
 
                 if not existing:
+                    matching_config_added = True
                     config = SystemConfig(
                         config_key=config_key,
                         config_value=str(weight),
@@ -456,14 +643,16 @@ class SystemConfigManager:
                 'composition_weight': 0.8,
                 'proportion_weight': 0.2,
                 'compound_threshold': 0.6,
-                'min_similarity_threshold': 0.0
+                'min_similarity_threshold': 0.0,
+                'max_results': 5
             }
 
             param_descriptions = {
                 'composition_weight': '成分组成相似度权重',
                 'proportion_weight': '成分比例相似度权重',
                 'compound_threshold': '复配匹配成功阈值',
-                'min_similarity_threshold': '最小相似度阈值'
+                'min_similarity_threshold': '最小相似度阈值',
+                'max_results': '默认返回的匹配结果数量'
             }
 
             for param_key, value in default_matching_params.items():
@@ -473,11 +662,12 @@ class SystemConfigManager:
                 ).first()
 
                 if not existing:
+                    matching_config_added = True
                     config = SystemConfig(
                         config_key=config_key,
                         config_value=str(value),
                         description=param_descriptions.get(param_key, f'{param_key}参数'),
-                        config_type='float'
+                        config_type='int' if param_key == 'max_results' else 'float'
                     )
                     session.add(config)
 
@@ -504,7 +694,17 @@ class SystemConfigManager:
                 )
                 session.add(config)
 
+            # 初始化数据版本号（预先创建，避免并发首次递增时重复插入）
+            for config_key, description in DATA_VERSION_DESCRIPTIONS.items():
+                existing = session.query(SystemConfig).filter(SystemConfig.config_key == config_key).first()
+                if not existing:
+                    session.add(SystemConfig(config_key=config_key, config_value='0', description=description,
+                                             config_type='int'))
+            if matching_config_added:
+                SystemConfigManager.bump_data_version(session, MATCHING_CONFIG_VERSION_KEY)
+
             session.commit()
+            SystemConfigManager.invalidate_matching_config()
             logger.info("默认配置初始化完成")
 
         except Exception as e:
@@ -743,35 +943,250 @@ class SystemConfigManager:
 class DualFormulaLibraryHandler:
     """双配方库处理工具"""
 
+    # IN查询单批ID数量上限，避免超长SQL
+    IN_CLAUSE_CHUNK_SIZE = 1000
+
+    @staticmethod
+    def get_library_stamp(session) -> Dict[str, object]:
+        """
+        参考配方库版本戳（system_config中的参考配方库版本号）
+
+        配方的新增、编辑、删除、批量导入、重新关联原料目录以及参考配方匹配特征的写入都在同一事务内递增版本号，
+        用于判断内存索引、索引快照与匹配结果缓存是否仍然有效
+        """
+        return SystemConfigManager.get_data_version(session, LIBRARY_VERSION_KEY)
+
+    @staticmethod
+    def bump_library_version(session):
+        """参考配方库变更：在当前事务内递增参考配方库版本号，由调用方提交事务"""
+        SystemConfigManager.bump_data_version(session, LIBRARY_VERSION_KEY)
+
+    @staticmethod
+    def get_match_features(formula_ids: Optional[List[int]], session, table_type: str,
+                           feature_version: int) -> Dict[int, tuple]:
+        """
+        批量读取已持久化的配方匹配特征
+
+        Args:
+            formula_ids: 配方ID列表，为None时读取该配方库的全部特征
+            feature_version: 特征提取规则版本，版本不一致的记录视为不存在
+
+        Returns:
+            {配方ID: (分类 -> 匹配标识符列表, 成分名称 -> 含量)}
+        """
+        columns = (FormulaMatchFeatures.formula_id, FormulaMatchFeatures.category_identifiers,
+                   FormulaMatchFeatures.proportions)
+        query = session.query(*columns).filter(
+            FormulaMatchFeatures.table_type == table_type,
+            FormulaMatchFeatures.feature_version == feature_version
+        )
+
+        if formula_ids is None:
+            rows = query.all()
+        else:
+            formula_ids = list(dict.fromkeys(formula_ids))
+            rows = []
+            chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+            for i in range(0, len(formula_ids), chunk_size):
+                rows.extend(query.filter(FormulaMatchFeatures.formula_id.in_(formula_ids[i:i + chunk_size])).all())
+
+        return {
+            formula_id: (json.loads(category_identifiers), json.loads(proportions))
+            for formula_id, category_identifiers, proportions in rows
+        }
+
+    @staticmethod
+    def save_match_features(session, table_type: str, features: Dict[int, tuple], feature_version: int):
+        """写入（替换）配方匹配特征，由调用方提交事务"""
+        if not features:
+            return
+        if table_type == 'reference':
+            # 参考配方的匹配特征是内存索引的内容
+            DualFormulaLibraryHandler.bump_library_version(session)
+        DualFormulaLibraryHandler.delete_match_features(session, table_type, list(features))
+        session.add_all([
+            FormulaMatchFeatures(
+                table_type=table_type,
+                formula_id=formula_id,
+                feature_version=feature_version,
+                category_identifiers=json.dumps(category_identifiers, ensure_ascii=False),
+                proportions=json.dumps(proportions, ensure_ascii=False)
+            )
+            for formula_id, (category_identifiers, proportions) in features.items()
+        ])
+
+    @staticmethod
+    def delete_match_features(session, table_type: str, formula_ids: List[int]):
+        """删除配方匹配特征（配方删除时调用），由调用方提交事务"""
+        chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+        for i in range(0, len(formula_ids), chunk_size):
+            session.query(FormulaMatchFeatures).filter(
+                FormulaMatchFeatures.table_type == table_type,
+                FormulaMatchFeatures.formula_id.in_(formula_ids[i:i + chunk_size])
+            ).delete(synchronize_session=False)
+
+    @staticmethod
+    def save_source_files(session, table_type: str, source_files: Dict[int, Tuple[str, Optional[str]]]):
+        """写入（替换）配方来源文件指纹（{配方ID: (内容哈希, 文件名)}），由调用方提交事务"""
+        if not source_files:
+            return
+        DualFormulaLibraryHandler.delete_source_files(session, table_type, list(source_files))
+        session.bulk_insert_mappings(FormulaSourceFile, [
+            {'table_type': table_type, 'formula_id': formula_id, 'content_hash': content_hash, 'file_name': file_name}
+            for formula_id, (content_hash, file_name) in source_files.items()
+        ])
+
+    @staticmethod
+    def delete_source_files(session, table_type: str, formula_ids: List[int]):
+        """删除配方来源文件指纹（配方删除时调用），由调用方提交事务"""
+        chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+        for i in range(0, len(formula_ids), chunk_size):
+            session.query(FormulaSourceFile).filter(
+                FormulaSourceFile.table_type == table_type,
+                FormulaSourceFile.formula_id.in_(formula_ids[i:i + chunk_size])
+            ).delete(synchronize_session=False)
+
+    @staticmethod
+    def find_formulas_by_source_hashes(session, content_hashes: List[str]) -> Dict[str, List[Dict]]:
+        """
+        查找由相同内容文件创建的配方（两个配方库）
+
+        Returns:
+            {内容哈希: [{"table_type", "formula_id", "formula_name", "file_name"}]}，只包含有配方的哈希
+        """
+        found: Dict[str, List[Dict]] = {}
+        chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+        for table_type, formula_model in (('reference', Formulas), ('to_be_matched', FormulasToBeMatched)):
+            for i in range(0, len(content_hashes), chunk_size):
+                rows = session.query(
+                    FormulaSourceFile.content_hash, FormulaSourceFile.file_name,
+                    formula_model.id, formula_model.formula_name
+                ).join(formula_model, formula_model.id == FormulaSourceFile.formula_id).filter(
+                    FormulaSourceFile.table_type == table_type,
+                    FormulaSourceFile.content_hash.in_(content_hashes[i:i + chunk_size])
+                ).order_by(formula_model.id).all()
+                for content_hash, file_name, formula_id, formula_name in rows:
+                    found.setdefault(content_hash, []).append({
+                        "table_type": table_type,
+                        "formula_id": formula_id,
+                        "formula_name": formula_name,
+                        "file_name": file_name
+                    })
+        return found
+
+    @staticmethod
+    def save_match_records(session, source_formula_id: int, match_results: List,
+                           algorithm_version: str = "dual_library_v1.0"):
+        """保存一次匹配的结果记录（DualLibraryMatchResult列表），由调用方提交事务"""
+        DualFormulaLibraryHandler.save_batch_match_records(
+            session, {source_formula_id: match_results}, algorithm_version
+        )
+
+    @staticmethod
+    def save_batch_match_records(session, results_by_source: Dict[int, List],
+                                 algorithm_version: str = "dual_library_v1.0"):
+        """批量写入多个待匹配配方的匹配记录（{待匹配配方ID: 匹配结果列表}），由调用方提交事务"""
+        session.bulk_insert_mappings(FormulaMatchRecord, [
+            {
+                'source_formula_id': source_formula_id,
+                'target_formula_id': result.target_formula_id,
+                'similarity_score': result.similarity_score,
+                'composition_similarity': result.composition_similarity,
+                'proportion_similarity': result.proportion_similarity,
+                'common_ingredients_count': result.common_ingredients_count,
+                'total_ingredients_count': result.total_ingredients_count,
+                'match_details': json.dumps({
+                    "composition_similarity": result.composition_similarity,
+                    "proportion_similarity": result.proportion_similarity,
+                    "category_similarities": result.category_similarities,
+                    "common_ingredients": result.common_ingredients,
+                    "common_ingredients_count": result.common_ingredients_count,
+                    "total_ingredients_count": result.total_ingredients_count,
+                    "match_details": result.match_details
+                }, ensure_ascii=False),
+                'algorithm_version': algorithm_version
+            }
+            for source_formula_id, match_results in results_by_source.items()
+            for result in match_results
+        ])
+
+    @staticmethod
+    def save_duplicate_pairs(session, pairs: List[Dict], threshold: float):
+        """
+        替换参考配方近似重复检测结果，由调用方提交事务
+
+        Args:
+            pairs: [{'cluster_id', 'formula_id', 'duplicate_formula_id', 'similarity_score',
+                     'composition_similarity', 'proportion_similarity'}]
+        """
+        session.query(FormulaDuplicatePair).delete(synchronize_session=False)
+        detected_at = datetime.now()
+        session.bulk_insert_mappings(FormulaDuplicatePair, [
+            dict(pair, threshold=threshold, detected_at=detected_at) for pair in pairs
+        ])
+
+    @staticmethod
+    def delete_duplicate_pairs(session, formula_ids: List[int]):
+        """删除涉及指定参考配方的近似重复对（配方删除时调用），由调用方提交事务"""
+        chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+        for i in range(0, len(formula_ids), chunk_size):
+            chunk = formula_ids[i:i + chunk_size]
+            session.query(FormulaDuplicatePair).filter(
+                (FormulaDuplicatePair.formula_id.in_(chunk)) |
+                (FormulaDuplicatePair.duplicate_formula_id.in_(chunk))
+            ).delete(synchronize_session=False)
+
     @staticmethod
     def get_formula_structure(formula_id: int, session, table_type='reference') -> dict:
         """获取配方的完整结构（单配+复配）"""
-        from decimal import Decimal
-        
-        def safe_float(value):
-            """安全转换Decimal为float"""
-            if value is None:
-                return 0.0
-            if isinstance(value, Decimal):
-                return float(value)
-            if isinstance(value, (int, float)):
-                return float(value)
-            try:
-                return float(value)
-            except (ValueError, TypeError):
-                return 0.0
-                
-        # 根据表类型选择对应的模型
-        if table_type == 'reference':
-            IngredientModel = FormulaIngredients
-        else:  # to_be_matched
-            IngredientModel = FormulaIngredientsToBeMatched
+        structures = DualFormulaLibraryHandler.get_formula_structures([formula_id], session, table_type)
+        return structures[formula_id]
 
-        # 获取所有配料
-        all_ingredients = session.query(IngredientModel).filter(
-            IngredientModel.formula_id == formula_id
-        ).order_by(IngredientModel.ingredient_id, IngredientModel.ingredient_sequence).all()
+    @staticmethod
+    def get_formula_structures(formula_ids: Optional[List[int]], session, table_type='reference') -> Dict[int, dict]:
+        """
+        批量获取配方结构，按集合查询一次性加载成分，避免逐个配方往返数据库
+
+        Args:
+            formula_ids: 配方ID列表，为None时加载整个配方库
+            session: 数据库会话
+            table_type: 'reference' 或 'to_be_matched'
+
+        Returns:
+            {配方ID: 配方结构}，结构格式与get_formula_structure一致；
+            指定ID但没有成分记录的配方返回空结构
+        """
+        IngredientModel = DualFormulaLibraryHandler._get_ingredient_model(table_type)
+        ordering = (IngredientModel.formula_id, IngredientModel.ingredient_id, IngredientModel.ingredient_sequence)
+
+        if formula_ids is None:
+            all_ingredients = session.query(IngredientModel).order_by(*ordering).all()
+        else:
+            formula_ids = list(dict.fromkeys(formula_ids))
+            all_ingredients = []
+            chunk_size = DualFormulaLibraryHandler.IN_CLAUSE_CHUNK_SIZE
+            for i in range(0, len(formula_ids), chunk_size):
+                chunk = formula_ids[i:i + chunk_size]
+                all_ingredients.extend(session.query(IngredientModel).filter(
+                    IngredientModel.formula_id.in_(chunk)
+                ).order_by(*ordering).all())
+
+        # 按配方ID分组（查询已按配方ID排序，组内保持配料ID、序号顺序）
+        ingredients_by_formula = {}
+        if formula_ids is not None:
+            for formula_id in formula_ids:
+                ingredients_by_formula[formula_id] = []
+        for ingredient in all_ingredients:
+            ingredients_by_formula.setdefault(ingredient.formula_id, []).append(ingredient)
+
+        return {
+            formula_id: DualFormulaLibraryHandler.build_formula_structure(formula_id, ingredients, table_type)
+            for formula_id, ingredients in ingredients_by_formula.items()
+        }
 
+    @staticmethod
+    def build_formula_structure(formula_id: int, all_ingredients: List, table_type='reference') -> dict:
+        """由已加载的成分记录构建配方结构（成分需按配料ID、配料序号排序）"""
         # 按配料ID分组
         ingredients_dict = {}
         for ingredient in all_ingredients:
@@ -798,8 +1213,8 @@ class DualFormulaLibraryHandler:
                     'type': 'single',
                     'chinese_name': component.standard_chinese_name or '',
                     'inci_name': component.inci_name or '',
-                    'content': safe_float(component.ingredient_content),  # 修复：安全转换Decimal
-                    'actual_content': safe_float(component.actual_component_content),  # 修复：安全转换Decimal
+                    'content': _safe_float(component.ingredient_content),  # 修复：安全转换Decimal
+                    'actual_content': _safe_float(component.actual_component_content),  # 修复：安全转换Decimal
                     'purpose': component.purpose or '其他',  # 添加purpose字段
                     'catalog_id': component.catalog_id  # 添加catalog_id字段
                 }
@@ -809,7 +1224,7 @@ class DualFormulaLibraryHandler:
                 compound_data = {
                     'ingredient_id': ingredient_id,
                     'type': 'compound',
-                    'total_content': safe_float(components[0].ingredient_content),  # 修复：安全转换Decimal
+                    'total_content': _safe_float(components[0].ingredient_content),  # 修复：安全转换Decimal
                     'purpose': components[0].purpose or '其他',  # 添加复配的purpose字段
                     'components': []
                 }
@@ -819,8 +1234,8 @@ class DualFormulaLibraryHandler:
                         'sequence': component.ingredient_sequence,
                         'chinese_name': component.standard_chinese_name or '',
                         'inci_name': component.inci_name or '',
-                        'component_content': safe_float(component.component_content),  # 修复：安全转换Decimal
-                        'actual_content': safe_float(component.actual_component_content),  # 修复：安全转换Decimal
+                        'component_content': _safe_float(component.component_content),  # 修复：安全转换Decimal
+                        'actual_content': _safe_float(component.actual_component_content),  # 修复：安全转换Decimal
                         'catalog_id': component.catalog_id  # 添加catalog_id字段
                     }
                     compound_data['components'].append(component_data)
@@ -832,6 +1247,13 @@ class DualFormulaLibraryHandler:
 
         return formula_structure
 
+    @staticmethod
+    def _get_ingredient_model(table_type: str):
+        """根据表类型选择对应的成分模型"""
+        if table_type == 'reference':
+            return FormulaIngredients
+        return FormulaIngredientsToBeMatched  # to_be_matched
+
 
 def create_updated_database_schema(database_url: str):
     """创建更新的数据库架构"""
@@ -592,6 +592,14 @@ function showImportModal() {
 
 // 监听文件夹选择
 document.addEventListener('DOMContentLoaded', function () {
+    const archiveInput = document.getElementById('importArchive');
+    if (archiveInput) {
+        archiveInput.addEventListener('change', function (e) {
+            // 选择压缩包时直接导入，目录结构由服务端解析
+            document.getElementById('startImportBtn').disabled = !(e.target.files && e.target.files.length > 0);
+        });
+    }
+
     const folderInput = document.getElementById('importFolder');
     if (folderInput) {
         folderInput.addEventListener('change', function (e) {
@@ -764,21 +772,47 @@ function displayImportPreview({structure, excelFiles}) {
 
 
 
-// 开始批量导入
+// 批量导入每次请求上传的文件数（服务端单个请求的文件数与表单字段数上限均为1000）
+const IMPORT_CHUNK_SIZE = 300;
+// 批量导入任务状态轮询间隔（毫秒）
+const IMPORT_POLL_INTERVAL = 1000;
+// 导入完成后最多显示的失败文件数
+const IMPORT_FAILURE_DISPLAY_LIMIT = 50;
+
+// 开始批量导入：选择zip压缩包时整体上传，选择文件夹时分批上传；解析与写入由服务端后台任务完成
 async function startBatchImport() {
     const folderInput = document.getElementById('importFolder');
+    const archiveInput = document.getElementById('importArchive');
+    const archive = archiveInput && archiveInput.files.length > 0 ? archiveInput.files[0] : null;
     const files = folderInput.files;
 
-    if (!files || files.length === 0) {
-        showAlert('warning', '请先选择文件夹');
+    if (!archive && (!files || files.length === 0)) {
+        showAlert('warning', '请先选择文件夹或zip压缩包');
         return;
     }
 
-    const {structure, excelFiles} = analyzeFolderStructure(files);
+    const requests = [];
+    if (archive) {
+        const formData = new FormData();
+        formData.append('archive', archive);
+        requests.push(formData);
+    } else {
+        const {excelFiles} = analyzeFolderStructure(files);
 
-    if (excelFiles.length === 0) {
-        showAlert('warning', '未找到有效的Excel文件');
-        return;
+        if (excelFiles.length === 0) {
+            showAlert('warning', '未找到有效的Excel文件');
+            return;
+        }
+
+        for (let i = 0; i < excelFiles.length; i += IMPORT_CHUNK_SIZE) {
+            const formData = new FormData();
+            excelFiles.slice(i, i + IMPORT_CHUNK_SIZE).forEach(fileInfo => {
+                formData.append('files', fileInfo.file);
+                formData.append('paths', fileInfo.path);  // 相对路径带主文件夹
+            });
+            formData.append('has_root_folder', 'true');
+            requests.push(formData);
+        }
     }
 
     // 显示进度条
@@ -788,67 +822,126 @@ async function startBatchImport() {
     const progressBar = document.querySelector('#importProgress .progress-bar');
     const statusDiv = document.getElementById('importStatus');
 
-    let successCount = 0;
-    let errorCount = 0;
-
-    for (let i = 0; i < excelFiles.length; i++) {
-        const fileInfo = excelFiles[i];
-        const progress = ((i + 1) / excelFiles.length) * 100;
-
-        progressBar.style.width = `${progress}%`;
-        statusDiv.textContent = `正在导入: ${fileInfo.formulaName} (${i + 1}/${excelFiles.length})`;
-
-        try {
-            await importSingleFile(fileInfo);
-            successCount++;
-        } catch (error) {
-            console.error(`导入文件失败: ${fileInfo.formulaName}`, error);
-            errorCount++;
+    try {
+        const jobIds = [];
+        for (let i = 0; i < requests.length; i++) {
+            statusDiv.textContent = `正在上传: 第 ${i + 1}/${requests.length} 批`;
+            const data = await submitImportJob(requests[i]);
+            jobIds.push(data.job.job_id);
         }
 
-        // 添加短暂延迟，避免过快的请求
-        await new Promise(resolve => setTimeout(resolve, 100));
+        const jobs = await pollImportJobs(jobIds, progressBar, statusDiv);
+        displayImportSummary(jobs, statusDiv);
+    } catch (error) {
+        console.error('批量导入失败:', error);
+        statusDiv.textContent = `批量导入失败: ${error.message}`;
+        document.getElementById('startImportBtn').disabled = false;
+        return;
     }
 
-    statusDiv.innerHTML = `
-                        导入完成！成功: ${successCount} 个，失败: ${errorCount} 个
-                        <br><small class="text-muted">页面将在3秒后自动刷新</small>
-                    `;
-
-    // 3秒后关闭模态框并刷新页面
-    setTimeout(() => {
-        bootstrap.Modal.getInstance(document.getElementById('importModal')).hide();
-        // 刷新页面以显示最新数据
+    // 关闭模态框时刷新页面以显示最新数据
+    document.getElementById('importModal').addEventListener('hidden.bs.modal', () => {
         window.location.reload();
-    }, 3000);
+    }, {once: true});
 }
 
-// 导入单个文件
-async function importSingleFile(fileInfo) {
-    const formData = new FormData();
-    formData.append('file', fileInfo.file);
-    formData.append('formula_name', fileInfo.formulaName);  // 使用已经去除扩展名的配方名称
-    formData.append('customer', fileInfo.customer);
-    formData.append('product_type', fileInfo.productType);
-    formData.append('target_library', 'reference');
-
-    const response = await fetch('/api/v1/upload-formula', {
+// 提交批量导入任务
+async function submitImportJob(formData) {
+    const response = await fetch('/api/v1/reference-formulas/bulk-import', {
         method: 'POST',
         body: formData
     });
 
     const data = await response.json();
 
-    if (!response.ok) {
-        // 处理HTTP错误，包括400(同名冲突)等
+    if (!response.ok || !data.success) {
         throw new Error(data.detail || data.message || `HTTP ${response.status}: ${response.statusText}`);
     }
 
-    if (!data.success) {
-        throw new Error(data.message || data.detail || '未知错误');
+    return data;
+}
+
+// 轮询批量导入任务直到全部结束，期间更新进度条
+async function pollImportJobs(jobIds, progressBar, statusDiv) {
+    const finishedStatuses = ['completed', 'failed', 'cancelled'];
+
+    while (true) {
+        const jobs = [];
+        for (const jobId of jobIds) {
+            const response = await fetch(`/api/v1/reference-formulas/bulk-import/${jobId}`);
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.detail || `HTTP ${response.status}: ${response.statusText}`);
+            }
+            jobs.push(data.job);
+        }
+
+        const totalCount = jobs.reduce((sum, job) => sum + job.total_count, 0);
+        const completedCount = jobs.reduce((sum, job) => sum + job.completed_count, 0);
+        const importedCount = jobs.reduce((sum, job) => sum + job.imported_count, 0);
+        const progress = totalCount ? (completedCount / totalCount) * 100 : 0;
+
+        progressBar.style.width = `${progress}%`;
+        if (jobs.some(job => job.phase === 'extracting' && job.status === 'running')) {
+            statusDiv.textContent = '正在解压压缩包...';
+        } else {
+            statusDiv.textContent = `正在导入: 已处理 ${completedCount}/${totalCount} 个文件，成功 ${importedCount} 个`;
+        }
+
+        if (jobs.every(job => finishedStatuses.includes(job.status))) {
+            return jobs;
+        }
+        await new Promise(resolve => setTimeout(resolve, IMPORT_POLL_INTERVAL));
     }
+}
 
-    return data;
+// 显示批量导入结果与失败文件
+function displayImportSummary(jobs, statusDiv) {
+    const importedCount = jobs.reduce((sum, job) => sum + job.imported_count, 0);
+    const failures = jobs.flatMap(job => job.failures);
+    const jobErrors = jobs.filter(job => job.error).map(job => job.error);
+
+    statusDiv.innerHTML = '';
+    const summary = document.createElement('div');
+    summary.textContent = `导入完成！成功: ${importedCount} 个，失败: ${failures.length} 个`;
+    statusDiv.appendChild(summary);
+
+    // 与已有配方内容完全相同的文件（同一文件以不同名称重复导入）
+    const sameFileCount = jobs.reduce((sum, job) => sum + job.same_file_formulas.length, 0);
+    if (sameFileCount > 0) {
+        const sameFileElement = document.createElement('div');
+        sameFileElement.className = 'text-warning';
+        sameFileElement.textContent = `其中 ${sameFileCount} 个文件与配方库中已有配方的文件内容完全相同`;
+        statusDiv.appendChild(sameFileElement);
+    }
+
+    jobErrors.forEach(error => {
+        const errorElement = document.createElement('div');
+        errorElement.className = 'text-danger';
+        errorElement.textContent = `导入任务失败: ${error}`;
+        statusDiv.appendChild(errorElement);
+    });
+
+    if (failures.length > 0) {
+        const failureList = document.createElement('ul');
+        failureList.className = 'small text-danger mt-2';
+        failures.slice(0, IMPORT_FAILURE_DISPLAY_LIMIT).forEach(failure => {
+            const listItem = document.createElement('li');
+            listItem.textContent = `${failure.path}: ${failure.error}`;
+            failureList.appendChild(listItem);
+        });
+        if (failures.length > IMPORT_FAILURE_DISPLAY_LIMIT) {
+            const listItem = document.createElement('li');
+            listItem.textContent = `……另有 ${failures.length - IMPORT_FAILURE_DISPLAY_LIMIT} 个文件失败`;
+            failureList.appendChild(listItem);
+        }
+        statusDiv.appendChild(failureList);
+    }
+
+    const hint = document.createElement('small');
+    hint.className = 'text-muted';
+    hint.textContent = '关闭窗口后页面将自动刷新';
+    statusDiv.appendChild(hint);
 }
 
 
@@ -145,7 +145,8 @@ async function saveMatchingParams() {
             composition_weight: parseFloat(document.getElementById('composition_weight').value) || 0,
             proportion_weight: parseFloat(document.getElementById('proportion_weight').value) || 0,
             compound_threshold: parseFloat(document.getElementById('compound_threshold').value) || 0,
-            min_similarity_threshold: parseFloat(document.getElementById('min_similarity_threshold').value) || 0
+            min_similarity_threshold: parseFloat(document.getElementById('min_similarity_threshold').value) || 0,
+            max_results: parseInt(document.getElementById('max_results').value) || 5
         };
 
         const response = await fetch('/api/v1/config/matching-parameters', {
@@ -326,21 +326,48 @@ async function submitUploadForm() {
 // 显示提示消息 - 使用共享组件
 // showAlert 已在common.js中定义，可直接使用
 
-// 匹配配方
+// 匹配配方（渐进式：逐行读取NDJSON事件，先显示临时结果，全部分区完成后显示最终结果）
 function matchFormula(formulaId) {
     document.getElementById('matchResults').innerHTML = '匹配中，请稍候...';
 
     // 获取严格模式设置
     const strictMode = document.getElementById('strictMatchMode').checked;
 
-    fetch(`/api/v1/match-formula/${formulaId}?strict_mode=${strictMode}`, {
+    fetch(`/api/v1/match-formula/${formulaId}/stream?strict_mode=${strictMode}`, {
         method: 'POST'
     })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                displayMatchResults(data);
-            } else {
+        .then(async response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let finished = false;
+
+            while (true) {
+                const {done, value} = await reader.read();
+                buffer += decoder.decode(value || new Uint8Array(), {stream: !done});
+
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const data = JSON.parse(line);
+                    if (data.event === 'progress') {
+                        displayProvisionalResults(data);
+                    } else if (data.event === 'final') {
+                        finished = true;
+                        displayMatchResults(data);
+                    } else if (data.event === 'error') {
+                        throw new Error(data.detail);
+                    }
+                }
+                if (done) break;
+            }
+
+            if (!finished) {
                 document.getElementById('matchResults').innerHTML = '<p class="text-danger">匹配失败</p>';
             }
         })
@@ -349,6 +376,34 @@ function matchFormula(formulaId) {
         });
 }
 
+// 显示渐进式匹配的临时结果
+function displayProvisionalResults(data) {
+    const progressPercent = data.total_count ? Math.round(data.scored_count * 100 / data.total_count) : 0;
+
+    let html = `
+                        <div class="card">
+                            <div class="card-header">
+                                <h6><i class="fas fa-spinner fa-spin"></i> 匹配中：已计算 ${data.scored_count} / ${data.total_count} 个配方</h6>
+                                <div class="progress" style="height: 6px;">
+                                    <div class="progress-bar" role="progressbar" style="width: ${progressPercent}%"></div>
+                                </div>
+                            </div>
+                            <div class="card-body">
+                                <small class="text-muted">临时结果，全部计算完成后更新为最终排名</small>
+                                <ol class="mt-2 mb-0">
+                    `;
+    data.results.forEach(result => {
+        html += `<li>${result.target_formula_name} <span class="badge bg-secondary ms-2">${formatPercentage(result.similarity_score * 100)}</span></li>`;
+    });
+    html += `
+                                </ol>
+                            </div>
+                        </div>
+                    `;
+
+    document.getElementById('matchResults').innerHTML = html;
+}
+
 // 显示详细匹配结果
 function displayMatchResults(data) {
     const strictMode = document.getElementById('strictMatchMode').checked;
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量导入路径解析与压缩包解压测试（目录层级、主文件夹判断、路径穿越、GBK编码的成员名称）
+"""
+
+import os
+import zipfile
+
+import pytest
+
+from src.backend.formula_import import extract_archive, parse_library_path, strip_root_folder
+
+
+class _RawNameZipInfo(zipfile.ZipInfo):
+    """按给定字节写入成员名称且不设置UTF-8标志，模拟中文Windows创建的压缩包"""
+
+    def __init__(self, raw_name: bytes):
+        super().__init__(raw_name.decode('cp437'))
+        self.raw_name = raw_name
+
+    def _encodeFilenameFlags(self):
+        return self.raw_name, self.flag_bits
+
+
+def _write_zip(path, members):
+    """members: [(成员名称或ZipInfo, 内容)]"""
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, content in members:
+            archive.writestr(name, content)
+    return str(path)
+
+
+def _extracted(sources):
+    """[(库内相对路径, 文件内容)]"""
+    result = []
+    for relative_path, local_path in sources:
+        with open(local_path, 'rb') as source:
+            result.append((relative_path, source.read()))
+    return result
+
+
+@pytest.mark.parametrize('relative_path, expected', [
+    ('甲公司/驻留类/护肤水/保湿水.xlsx', ('甲公司', '驻留类-护肤水', '保湿水')),
+    ('甲公司/淋洗类/洗发水.xls', ('甲公司', '淋洗类', '洗发水')),
+    ('甲公司/驻留类/护肤水/2024/样品/保湿水.v2.xlsx', ('甲公司', '驻留类-护肤水', '保湿水.v2')),
+    ('甲公司/ 驻留类  "新" /护肤:水?/保湿水.xlsx', ('甲公司', '驻留类 新-护肤水', '保湿水')),
+    ('甲公司/"?"/保湿水.xlsx', ('甲公司', '其他类', '保湿水')),
+])
+def test_parse_library_path(relative_path, expected):
+    assert parse_library_path(relative_path) == expected
+
+
+@pytest.mark.parametrize('relative_path', ['保湿水.xlsx', '甲公司/保湿水.xlsx'])
+def test_parse_library_path_requires_customer_and_category(relative_path):
+    with pytest.raises(ValueError):
+        parse_library_path(relative_path)
+
+
+@pytest.mark.parametrize('paths, has_root_folder, expected', [
+    # 同一顶层文件夹且存在五级路径：自动去除主文件夹
+    (['库/甲公司/驻留类/护肤水/a.xlsx', '库/乙公司/淋洗类/b.xlsx'], None,
+     ['甲公司/驻留类/护肤水/a.xlsx', '乙公司/淋洗类/b.xlsx']),
+    # 同一顶层文件夹但最多四级：顶层即客户
+    (['甲公司/驻留类/护肤水/a.xlsx', '甲公司/淋洗类/b.xlsx'], None,
+     ['甲公司/驻留类/护肤水/a.xlsx', '甲公司/淋洗类/b.xlsx']),
+    # 多个顶层文件夹：不去除
+    (['甲公司/驻留类/护肤水/霜/a.xlsx', '乙公司/淋洗类/b.xlsx'], None,
+     ['甲公司/驻留类/护肤水/霜/a.xlsx', '乙公司/淋洗类/b.xlsx']),
+    # 显式指定
+    (['库/甲公司/淋洗类/b.xlsx'], True, ['甲公司/淋洗类/b.xlsx']),
+    (['库/甲公司/驻留类/护肤水/a.xlsx'], False, ['库/甲公司/驻留类/护肤水/a.xlsx']),
+    ([], None, []),
+])
+def test_strip_root_folder(paths, has_root_folder, expected):
+    assert strip_root_folder(paths, has_root_folder) == expected
+
+
+def test_extract_archive_skips_unsafe_and_non_excel_members(tmp_path):
+    archive_path = _write_zip(tmp_path / 'library.zip', [
+        ('库/甲公司/驻留类/护肤水/a.xlsx', b'a'),
+        ('库/乙公司/淋洗类/b.XLS', b'b'),
+        ('库/../../evil.xlsx', b'evil'),
+        ('../evil.xlsx', b'evil'),
+        ('/tmp/evil.xlsx', b'evil'),
+        ('库\\丙公司\\淋洗类\\c.xlsx', b'c'),
+        ('__MACOSX/库/甲公司/驻留类/护肤水/._a.xlsx', b'meta'),
+        ('库/甲公司/驻留类/护肤水/~$a.xlsx', b'lock'),
+        ('库/甲公司/驻留类/护肤水/说明.txt', b'note'),
+    ])
+    staging_dir = tmp_path / 'staging'
+    staging_dir.mkdir()
+
+    sources = extract_archive(archive_path, str(staging_dir))
+    assert _extracted(sources) == [
+        ('丙公司/淋洗类/c.xlsx', b'c'),
+        ('乙公司/淋洗类/b.XLS', b'b'),
+        ('甲公司/驻留类/护肤水/a.xlsx', b'a'),
+    ]
+    # 只在暂存目录内按序号写入文件
+    assert sorted(os.listdir(staging_dir)) == ['000000.xlsx', '000001.xls', '000002.xlsx']
+    assert not (tmp_path / 'evil.xlsx').exists()
+
+
+def test_extract_archive_decodes_gbk_member_names(tmp_path):
+    archive_path = _write_zip(tmp_path / 'gbk.zip', [
+        (_RawNameZipInfo('甲公司/驻留类/护肤水/保湿水.xlsx'.encode('gbk')), b'gbk'),
+        (_RawNameZipInfo('乙公司/淋洗类/洗发水.xlsx'.encode('utf-8')), b'utf8'),
+        ('丙公司/淋洗类/沐浴露.xlsx', b'flagged'),
+    ])
+    with zipfile.ZipFile(archive_path) as archive:
+        assert [info.flag_bits & 0x800 for info in archive.infolist()] == [0, 0, 0x800]
+
+    sources = extract_archive(archive_path, str(tmp_path))
+    assert _extracted(sources) == [
+        ('丙公司/淋洗类/沐浴露.xlsx', b'flagged'),
+        ('乙公司/淋洗类/洗发水.xlsx', b'utf8'),
+        ('甲公司/驻留类/护肤水/保湿水.xlsx', b'gbk'),
+    ]
+    assert [parse_library_path(relative_path)[1] for relative_path, _ in sources] == ['淋洗类', '淋洗类',
+                                                                                    '驻留类-护肤水']
+
+
+def test_extract_archive_rejects_oversized_and_invalid_archives(tmp_path):
+    archive_path = _write_zip(tmp_path / 'large.zip', [('甲公司/淋洗类/a.xlsx', b'x' * 2048),
+                                                      ('甲公司/淋洗类/说明.txt', b'x' * 4096)])
+    with pytest.raises(ValueError):
+        extract_archive(archive_path, str(tmp_path), max_total_bytes=2047)
+    # 只统计需要解压的Excel成员
+    assert len(extract_archive(archive_path, str(tmp_path), max_total_bytes=2048)) == 1
+
+    invalid_path = tmp_path / 'invalid.zip'
+    invalid_path.write_bytes(b'not a zip file')
+    with pytest.raises(ValueError):
+        extract_archive(str(invalid_path), str(tmp_path))
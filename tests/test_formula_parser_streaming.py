@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式解析与pandas模式解析结果一致性测试
+"""
+
+import random
+
+import openpyxl
+import pytest
+
+import src.backend.formula_parser as formula_parser
+from src.backend.formula_parser import FormulaParser
+
+HEADER = ['序号', '标准中文名称', 'INCI名称', '原料含量(%)', '原料中成份含量', '实际成份含量', '使用目的', '备注']
+
+
+def _write_sheet(path, rows, title='某某化妆品配方表'):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    if title:
+        sheet.append([title])
+    sheet.append(HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return str(path)
+
+
+def _parse(path, streaming):
+    result = FormulaParser(streaming=streaming).parse_file(path)
+    return result['name'], result['header_row'], result['ingredients']
+
+
+@pytest.fixture(params=[1, 2, 4096], ids=lambda size: f"chunk{size}")
+def chunk_rows(request, monkeypatch):
+    """分别以极小的块与默认块大小解析，覆盖跨块的向前填充与序号沿用"""
+    monkeypatch.setattr(formula_parser, 'EXTRACTION_CHUNK_ROWS', request.param)
+    return request.param
+
+
+def test_blank_sequence_uses_previous_numeric_sequence(tmp_path, chunk_rows):
+    path = _write_sheet(tmp_path / 'compound.xlsx', [
+        [1, '水', 'AQUA', 80, 100, 80, '溶剂'],
+        [2, '复配防腐剂A', 'PHENOXYETHANOL', 0.5, 90, 0.45, '防腐'],
+        [' ', '复配防腐剂B', 'ETHYLHEXYLGLYCERIN', None, 10, 0.05, '防腐'],
+        [3, '甘油', 'GLYCERIN', 5, 100, 5, '保湿'],
+    ])
+
+    streamed = _parse(path, streaming=True)
+    assert streamed == _parse(path, streaming=False)
+    assert [(item['sequence'], item['chinese_name']) for item in streamed[2]] == [
+        (1, '水'), (2, '复配防腐剂A'), (2, '复配防腐剂B'), (3, '甘油')
+    ]
+
+
+@pytest.mark.parametrize('rows', [
+    # 数值列中的布尔值被pandas转换为1/0
+    [[1, '水', 'AQUA', True], [True, '甘油', 'GLYCERIN', 2.5]],
+    # object列中布尔值统一为先出现的相等值
+    [[1, '水', 'AQUA', 10], ['复配', '甘油', True, 5], [True, '丁二醇', 1, 'abc'], [False, '戊二醇', 0, 1]],
+    # 含空值的数值列作为文本使用时按浮点数格式化
+    [[1, '水', 'AQUA', 10, None, None, None, 5], [2, '甘油', 'GLYCERIN', 5, None, None, None, None]],
+    # 布尔字符串列被pandas转换为布尔值
+    [[1, '水', 'AQUA', 10, None, None, 'TRUE'], [2, '甘油', 'GLYCERIN', 5, None, None, 'false']],
+], ids=['numeric-bool', 'object-bool', 'float-text', 'bool-text'])
+def test_pandas_column_type_conversion(tmp_path, chunk_rows, rows):
+    path = _write_sheet(tmp_path / 'types.xlsx', rows)
+    assert _parse(path, streaming=True) == _parse(path, streaming=False)
+
+
+def test_random_sheets_match_pandas(tmp_path, chunk_rows):
+    pools = [
+        [1, 2, 3, 2.0, 4.5, None, ' ', '', '5', 'x', True, False, '复配'],
+        ['水', '复配防腐剂A', '甘油', None, ' ', 5, True, '无', 'TRUE'],
+        ['AQUA', None, 12, 'GLYCERIN', True],
+        [1.5, 2, None, '3%', True, 'abc', '#N/A'],
+        [10, None, 0.5, False],
+        [None, 1, 2.25],
+        ['保湿', None, 3, 'true', 'FALSE'],
+        [None, 5, 'note', 7.5, True],
+    ]
+    rng = random.Random(chunk_rows)
+    for index in range(60):
+        column_pools = [rng.sample(pool, k=rng.randint(1, len(pool))) for pool in pools]
+        rows = [[] if rng.random() < 0.1 else [rng.choice(pool) for pool in column_pools]
+                for _ in range(rng.randint(0, 12))]
+        path = _write_sheet(tmp_path / f'random{index}.xlsx', rows, title=rng.choice([None, '某某化妆品配方表']))
+        assert _parse(path, streaming=True) == _parse(path, streaming=False), rows
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+原料目录解析器匹配顺序（精确 → 规范化 → INCI → 模糊）与数字序列保护测试
+"""
+
+import pytest
+
+from src.backend.ingredient_catalog import (
+    MATCH_EXACT, MATCH_FUZZY, MATCH_INCI, MATCH_NORMALIZED, IngredientCatalogResolver
+)
+
+CATALOG = [
+    (3, '甘油', 'GLYCERIN'),
+    (1, '丁二醇', 'BUTYLENE GLYCOL'),
+    (5, '丁二醇', '1,3-BUTANEDIOL'),
+    (7, 'PEG-40氢化蓖麻油', 'PEG-40 HYDROGENATED CASTOR OIL'),
+    (8, 'PEG-400氢化蓖麻油', None),
+    (9, 'C12-15醇苯甲酸酯', 'C12-15 ALKYL BENZOATE'),
+    (10, '透明质酸钠(低分子)', None),
+    (12, '水', 'AQUA'),
+    (14, '椰油酰胺丙基甜菜碱', 'COCAMIDOPROPYL BETAINE'),
+    (20, 'GLYCERIN', None),
+]
+
+
+@pytest.fixture(scope='module')
+def resolver():
+    return IngredientCatalogResolver(CATALOG)
+
+
+@pytest.mark.parametrize('chinese_name, inci_name, expected', [
+    # 精确匹配优先于其他方式；同名条目取ID最小者
+    ('甘油', 'AQUA', (3, MATCH_EXACT, 1.0)),
+    ('GLYCERIN', 'AQUA', (20, MATCH_EXACT, 1.0)),
+    ('丁二醇', None, (1, MATCH_EXACT, 1.0)),
+    # 规范化匹配（空白、全角、括号样式）优先于INCI匹配
+    (' 甘 油 ', 'AQUA', (3, MATCH_NORMALIZED, 0.95)),
+    ('ＰＥＧ－４０氢化蓖麻油', None, (7, MATCH_NORMALIZED, 0.95)),
+    ('透明质酸钠【低分子】', None, (10, MATCH_NORMALIZED, 0.95)),
+    ('glycerin', None, (20, MATCH_NORMALIZED, 0.95)),
+    # INCI匹配（规范化后比较）优先于模糊匹配
+    ('丙三醇', 'glycerin', (3, MATCH_INCI, 0.9)),
+    ('柠檬酸', ' Butylene  Glycol ', (1, MATCH_INCI, 0.9)),
+    ('椰油酰胺丙基甜菜硷', 'COCAMIDOPROPYL BETAINE', (14, MATCH_INCI, 0.9)),
+    # 模糊匹配，置信度为名称相似度
+    ('椰油酰胺丙基甜菜硷', None, (14, MATCH_FUZZY, 0.875)),
+    ('椰油酰胺丙基甜菜碱溶液', None, (14, MATCH_FUZZY, 0.8889)),
+    ('C12-15醇苯甲酸脂', None, (9, MATCH_FUZZY, 0.9)),
+    # 未匹配
+    ('C16-18醇苯甲酸酯', None, None),
+    ('未知原料', 'UNKNOWN', None),
+    (None, None, None),
+    ('', '', None),
+])
+def test_resolve_order(resolver, chinese_name, inci_name, expected):
+    match = resolver.resolve(chinese_name, inci_name)
+    assert (match and (match.catalog_id, match.method, match.confidence)) == expected
+
+
+@pytest.mark.parametrize('catalog_ids, chinese_name, expected_id', [
+    # 目录同时含PEG-40与PEG-400时，笔误名称按数字序列匹配到对应条目
+    ((7, 8), 'PEG-400氢化篦麻油', 8),
+    ((7, 8), 'PEG-40氢化篦麻油', 7),
+    # 只有数字序列不同的条目时不模糊匹配
+    ((7,), 'PEG-400氢化篦麻油', None),
+    ((7,), 'PEG-400氢化蓖麻油', None),
+    ((8,), 'PEG-40氢化蓖麻油', None),
+    ((8,), 'PEG-4000氢化蓖麻油', None),
+    ((9,), 'C16-18醇苯甲酸酯', None),
+    ((9,), 'C12-15醇苯甲酸盐', 9),
+])
+def test_fuzzy_match_requires_same_digits(catalog_ids, chinese_name, expected_id):
+    entries = [entry for entry in CATALOG if entry[0] in catalog_ids]
+    match = IngredientCatalogResolver(entries, fuzzy_threshold=0.7).resolve(chinese_name)
+    assert (match and match.catalog_id) == expected_id
+    if match:
+        assert match.method == MATCH_FUZZY
+
+
+def test_fuzzy_match_tie_takes_smallest_id():
+    resolver = IngredientCatalogResolver([(30, '生育酚乙酸酯A', None), (21, '生育酚乙酸酯B', None)],
+                                         fuzzy_threshold=0.7)
+    assert resolver.resolve('生育酚乙酸酯C').catalog_id == 21
+
+
+def test_fuzzy_threshold_above_one_disables_fuzzy_match():
+    resolver = IngredientCatalogResolver(CATALOG, fuzzy_threshold=1.01)
+    assert resolver.resolve('C12-15醇苯甲酸脂') is None
+    assert resolver.resolve('甘 油').method == MATCH_NORMALIZED
+
+
+def test_resolve_many_keeps_input_order(resolver):
+    ingredients = [('水', None), ('未知原料', None), ('甘油', None), ('水', None)]
+    assert [match and match.catalog_id for match in resolver.resolve_many(ingredients)] == [12, None, 3, 12]
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参考配方库内存索引打分与逐对打分（_score_feature_pair）一致性测试
+"""
+
+import dataclasses
+import math
+import random
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, or_
+from sqlalchemy.orm import sessionmaker
+
+from src.backend.dual_library_matching_engine import DualLibraryMatchingEngine
+from src.backend.matching_index import (
+    STANDARD_CATEGORIES, CompoundSignatureIndex, ReferenceLibraryIndex, SegmentedLibraryIndex, compound_jaccard,
+    compound_signature, parse_compound_signature
+)
+from src.backend.sql.mysql_models import Base, Formulas
+
+INGREDIENT_NAMES = ['水', '甘油', '丁二醇', '苯氧乙醇', '卡波姆', '生育酚', '椰油酰胺丙基甜菜碱', '香精']
+PROPORTION_VALUES = [0, 0.5, 1, 2.5, 10, 30]
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return DualLibraryMatchingEngine()
+
+
+def _parameters(engine, **changes):
+    return dataclasses.replace(engine._get_default_parameters(), **changes)
+
+
+def _random_features(rng):
+    """随机匹配特征：目录/名称标识符与少量成分重叠的复配签名，含量含0（比例相似度无效）"""
+    identifier_pool = [f'catalog_{i}' for i in range(1, 9)] + [f'name_{name}' for name in INGREDIENT_NAMES[:4]]
+    category_identifiers = {}
+    for category in rng.sample(STANDARD_CATEGORIES, rng.randint(0, 4)):
+        identifiers = rng.sample(identifier_pool, rng.randint(0, 3))
+        identifiers += [compound_signature(rng.sample(range(1, 9), rng.randint(2, 4)))
+                        for _ in range(rng.randint(0, 2))]
+        category_identifiers[category] = list(dict.fromkeys(identifiers))
+    proportions = {name: rng.choice(PROPORTION_VALUES)
+                   for name in rng.sample(INGREDIENT_NAMES, rng.randint(0, 5))}
+    return category_identifiers, proportions
+
+
+def _random_library(rng, size, product_types=(None,), customers=(None,)):
+    """随机参考配方库：(配方表头列表, {配方ID: 匹配特征})，部分配方复制已有特征以制造同分"""
+    formulas, features = [], {}
+    for formula_id in rng.sample(range(1, size * 3), size):
+        formulas.append((formula_id, f'配方{formula_id}', rng.choice(product_types), rng.choice(customers)))
+        features[formula_id] = features[rng.choice(list(features))] if features and rng.random() < 0.2 \
+            else _random_features(rng)
+    return formulas, features
+
+
+@pytest.mark.parametrize('compound_threshold', [0.0, 0.5, 0.6, 1.0])
+def test_index_scores_match_pairwise_scores(engine, compound_threshold):
+    rng = random.Random(compound_threshold)
+    parameters = _parameters(engine, compound_threshold=compound_threshold)
+    formulas, features = _random_library(rng, 60)
+    index = ReferenceLibraryIndex.build(formulas, features)
+
+    for _ in range(20):
+        source = _random_features(rng)
+        encoded = index.encode_source(*source, compound_threshold=compound_threshold)
+        scores = engine._score_index_rows(parameters, index, encoded)
+        for i, formula_id in enumerate(index.formula_ids):
+            row, (total, composition, proportion, categories) = scores.scores_at(i)
+            assert row == i
+            expected = engine._score_feature_pair(parameters, source, features[int(formula_id)])
+            assert (total, composition, proportion) == pytest.approx(expected[:3], abs=1e-9), (source, formula_id)
+            assert categories == pytest.approx(expected[3], abs=1e-9)
+
+
+def _full_sort_top_k(engine, parameters, index, encoded, rows, k):
+    """整库打分后按 (相似度降序, 行号升序) 稳定排序，取不低于阈值的前K个"""
+    scores = engine._score_index_rows(parameters, index, encoded, rows)
+    ranked = sorted((scores.scores_at(i) for i in range(len(rows))), key=lambda item: (-item[1][0], item[0]))
+    return [item for item in ranked if item[1][0] >= parameters.min_similarity_threshold][:k]
+
+
+@pytest.mark.parametrize('min_similarity_threshold', [0.0, 0.2, 0.45])
+@pytest.mark.parametrize('block_size', [1, 3, 2048])
+def test_pruned_top_k_equals_full_sort(engine, monkeypatch, min_similarity_threshold, block_size):
+    monkeypatch.setattr(DualLibraryMatchingEngine, 'TOP_K_BLOCK_SIZE', block_size)
+    rng = random.Random(block_size)
+    parameters = _parameters(engine, min_similarity_threshold=min_similarity_threshold)
+    formulas, features = _random_library(rng, 80, product_types=('驻留类-护肤水', '淋洗类-洗发水'))
+    index = ReferenceLibraryIndex.build(formulas, features)
+
+    for _ in range(15):
+        # 一半查询直接取库中配方的特征，使完全相同的配方产生同分
+        source = features[rng.choice(list(features))] if rng.random() < 0.5 else _random_features(rng)
+        encoded = index.encode_source(*source, compound_threshold=parameters.compound_threshold)
+        scope = index.strict_scope_rows('驻留类-护肤水', None) if rng.random() < 0.3 else None
+        rows = index.live_rows() if scope is None else scope
+        for k in (1, 3, 10, len(rows) + 5):
+            expected = _full_sort_top_k(engine, parameters, index, encoded, rows, k)
+            assert engine._top_k_index_rows(parameters, index, encoded, scope, k) == expected
+
+
+def _sql_strict_mode_ids(session, product_type, customer):
+    """原严格模式数据库查询（相同产品类型与客户）返回的配方ID"""
+    query = session.query(Formulas.id)
+    if product_type:
+        if '-' in product_type:
+            query = query.filter(Formulas.product_type == product_type)
+        else:
+            query = query.filter(or_(Formulas.product_type == product_type,
+                                     Formulas.product_type.like(f"{product_type}-%")))
+    if customer:
+        query = query.filter(Formulas.customer == customer)
+    else:
+        query = query.filter(or_(Formulas.customer == "", Formulas.customer.is_(None)))
+    return [row[0] for row in query.order_by(Formulas.id).all()]
+
+
+def test_strict_scope_rows_match_sql_filter():
+    product_types = ['驻留类-护肤水', '驻留类-凝胶', '驻留类', '淋洗类-洗发水', '淋洗类', '其他类', '', None]
+    customers = ['甲公司', '乙公司', '', None]
+    rng = random.Random(17)
+    formulas, features = _random_library(rng, 120, product_types=product_types, customers=customers)
+    deleted_ids = [formula_id for formula_id, _, _, _ in rng.sample(formulas, 15)]
+    index = ReferenceLibraryIndex.build(formulas, features).with_tombstones(deleted_ids)
+
+    db_engine = create_engine('sqlite://')
+    Base.metadata.create_all(db_engine)
+    with sessionmaker(bind=db_engine)() as session:
+        session.add_all(Formulas(id=formula_id, formula_name=name, product_type=product_type, customer=customer)
+                        for formula_id, name, product_type, customer in formulas if formula_id not in deleted_ids)
+        session.commit()
+
+        for product_type in product_types + ['驻留', '驻留类-', '不存在类-护肤水']:
+            for customer in customers + ['丙公司']:
+                expected = [index.row_of(formula_id)
+                            for formula_id in _sql_strict_mode_ids(session, product_type, customer)]
+                rows = index.strict_scope_rows(product_type, customer)
+                assert rows.tolist() == expected, (product_type, customer)
+
+
+# 待匹配复配 {1,2,3,4} 与各参考复配的Jaccard：0.8、0.75、0.5、0.2、0（不共享成分）
+SOURCE_COMPOUND = compound_signature([1, 2, 3, 4])
+TARGET_COMPOUNDS = {
+    compound_signature([1, 2, 3, 4, 5]): 0.8,
+    compound_signature([1, 2, 3]): 0.75,
+    compound_signature([1, 2, 3, 5, 6]): 0.5,
+    compound_signature([4, 5, 6, 7, 8]): 0.125,
+    compound_signature([5, 6]): 0.0,
+}
+# 每个Jaccard取值本身（恰好达到阈值）及其紧邻的上下浮点数
+BOUNDARY_THRESHOLDS = sorted({edge for jaccard in TARGET_COMPOUNDS.values() if jaccard > 0
+                              for edge in (math.nextafter(jaccard, 0.0), jaccard, math.nextafter(jaccard, 1.0))})
+
+
+def _compound_hit(jaccard, threshold):
+    """复配匹配成功：至少共享一个成分，且Jaccard不低于阈值"""
+    return jaccard > 0 and jaccard >= threshold
+
+
+@pytest.mark.parametrize('threshold', BOUNDARY_THRESHOLDS)
+def test_compound_signature_index_threshold_boundaries(threshold):
+    identifiers = ['catalog_1', SOURCE_COMPOUND, 'name_水'] + list(TARGET_COMPOUNDS)
+    signatures = CompoundSignatureIndex(identifiers)
+    source_catalog_ids = parse_compound_signature(SOURCE_COMPOUND)
+
+    expected = [identifier_id for identifier_id, identifier in enumerate(identifiers)
+                if identifier.startswith('compound_catalog_')
+                and _compound_hit(compound_jaccard(source_catalog_ids, parse_compound_signature(identifier)),
+                                        threshold)]
+    assert sorted(signatures.similar(source_catalog_ids, threshold).tolist()) == expected
+    for identifier, jaccard in TARGET_COMPOUNDS.items():
+        assert (identifiers.index(identifier) in expected) == _compound_hit(jaccard, threshold)
+
+
+@pytest.mark.parametrize('threshold', BOUNDARY_THRESHOLDS)
+def test_category_intersections_at_compound_threshold(engine, threshold):
+    parameters = _parameters(engine, compound_threshold=threshold)
+    # 每个参考配方在防腐剂分类含一个参考复配，另有一个配方把最相近的复配放在乳化剂分类
+    features = {formula_id: ({'防腐剂': [identifier, 'catalog_9']}, {})
+                for formula_id, identifier in enumerate(TARGET_COMPOUNDS, start=1)}
+    features[len(features) + 1] = ({'乳化剂': [compound_signature([1, 2, 3, 4, 5])]}, {})
+    formulas = [(formula_id, f'配方{formula_id}', None, None) for formula_id in features]
+    index = ReferenceLibraryIndex.build(formulas, features)
+
+    source = ({'防腐剂': [SOURCE_COMPOUND, 'catalog_9']}, {})
+    encoded = index.encode_source(*source, compound_threshold=threshold)
+    intersections = index.category_intersections(encoded)
+    preservative = STANDARD_CATEGORIES.index('防腐剂')
+    for row, formula_id in enumerate(index.formula_ids):
+        target_categories = features[int(formula_id)][0]
+        expected = np.zeros(len(STANDARD_CATEGORIES))
+        for category, identifiers in target_categories.items():
+            expected[STANDARD_CATEGORIES.index(category)] = engine._match_category_identifiers(
+                parameters, set(source[0].get(category, [])), set(identifiers)
+            )[0]
+        assert intersections[row].tolist() == expected.tolist()
+
+    for row, jaccard in enumerate(TARGET_COMPOUNDS.values()):
+        assert intersections[row, preservative] == (2 if _compound_hit(jaccard, threshold) else 1)
+    # 分类不同的相近复配不计入交集
+    assert intersections[len(TARGET_COMPOUNDS)].sum() == 0
+
+
+def _segmented_top_k(engine, parameters, library_index, source, strict_scope, k):
+    """在分段索引上逐段检索并合并前K名（与_rank_library_rows的精确召回一致），返回 (配方ID, 打分结果)"""
+    ranking = []
+    for segment in library_index.segments:
+        scope = segment.strict_scope_rows(*strict_scope) if strict_scope else None
+        encoded = segment.encode_source(*source, compound_threshold=parameters.compound_threshold)
+        segment_top = engine._top_k_index_rows(parameters, segment, encoded, scope, k)
+        ranking = engine._merge_top_scored(ranking, segment, segment_top, k)
+    return ranking
+
+
+def test_incremental_index_matches_fresh_build(engine):
+    rng = random.Random(7)
+    product_types = ['驻留类-护肤水', '淋洗类-洗发水', '驻留类']
+    customers = ['甲公司', None]
+    parameters = _parameters(engine, max_results=8)
+    formulas, features = _random_library(rng, 60, product_types=product_types, customers=customers)
+    library = {meta[0]: (meta, features[meta[0]]) for meta in formulas}
+    segmented = SegmentedLibraryIndex(ReferenceLibraryIndex.build(formulas, features))
+    next_id = max(library) + 1
+    removed_ids = []
+
+    for _ in range(8):
+        upserts = []
+        # 重新写入曾删除的配方ID，以及新增配方
+        for formula_id in removed_ids[:1]:
+            upserts.append(((formula_id, f'配方{formula_id}', rng.choice(product_types), None), _random_features(rng)))
+        for _ in range(rng.randint(0, 4)):
+            upserts.append(((next_id, f'配方{next_id}', rng.choice(product_types), rng.choice(customers)),
+                            _random_features(rng)))
+            next_id += 1
+        # 编辑已有配方（特征与表头均可能变化，基础段与增量段中的配方都会被选中）
+        for formula_id in rng.sample(sorted(set(library) - {meta[0] for meta, _ in upserts}), 4):
+            upserts.append(((formula_id, f'配方{formula_id}（修订）', rng.choice(product_types),
+                             rng.choice(customers)), _random_features(rng)))
+        # 删除配方（不与本轮编辑重复）
+        edited_ids = {meta[0] for meta, _ in upserts}
+        removals = rng.sample(sorted(set(library) - edited_ids), 3)
+
+        segmented = segmented.apply_changes(upserts, removals)
+        for meta, formula_features in upserts:
+            library[meta[0]] = (meta, formula_features)
+        for formula_id in removals:
+            del library[formula_id]
+        removed_ids = removals
+
+        fresh = ReferenceLibraryIndex.build([meta for meta, _ in library.values()],
+                                            {formula_id: entry[1] for formula_id, entry in library.items()})
+        assert segmented.live_count == fresh.size
+        assert segmented.locate(removals[0]) is None
+
+        for library_index in (segmented, segmented.compact()):
+            for _ in range(10):
+                source = rng.choice(list(library.values()))[1] if rng.random() < 0.5 else _random_features(rng)
+                strict_scope = (rng.choice(product_types), rng.choice(customers)) if rng.random() < 0.4 else None
+                encoded = fresh.encode_source(*source, compound_threshold=parameters.compound_threshold)
+                scope = fresh.strict_scope_rows(*strict_scope) if strict_scope else None
+                expected = [(int(fresh.formula_ids[row]), scores) for row, scores in
+                            engine._top_k_index_rows(parameters, fresh, encoded, scope, parameters.max_results)]
+                actual = _segmented_top_k(engine, parameters, library_index, source, strict_scope,
+                                          parameters.max_results)
+                assert actual == expected
+
+        # 部分轮次在压缩后的基础段上继续增量更新
+        if rng.random() < 0.4:
+            segmented = segmented.compact()